@@ -335,7 +335,7 @@ def _parse_global_templates(name, regulators, polynomial_names,
                             real_parameters, complex_parameters, form_optimization_level,
                             form_setup, form_insertion_depth, requested_orders,
                             contour_deformation_polynomial, nested_series_type,
-                            enforce_complex):
+                            enforce_complex, disteval_fuse_orders, disteval_group_sectors):
     '''
     Create the `target_directory` (given by `name`) and return the two
     optional arguments passed to :func:`parse_template_tree`.
@@ -374,7 +374,9 @@ def _parse_global_templates(name, regulators, polynomial_names,
                                      pySecDec_git_id = git_id,
                                      contrib_dirname = pySecDecContrib.dirname,
                                      date_time = strftime("%a %d %b %Y %H:%M"),
-                                     enforce_complex_return_type=int(bool(enforce_complex)) # make sure that this is either ``0`` or ``1``
+                                     enforce_complex_return_type=int(bool(enforce_complex)), # make sure that this is either ``0`` or ``1``
+                                     disteval_fuse_orders=int(bool(disteval_fuse_orders)),
+                                     disteval_group_sectors=int(disteval_group_sectors or 0) # ``0`` if not grouped
                                 )
 
     # configure template parser
@@ -594,17 +596,63 @@ def _make_sector_cpp_files(sector_index, sector_order_names, contour_deformation
         files += [f"src/optimize_deformation_parameters_sector_{s}_{o}.cpp" for s, o in orders]
     return " \\\n\t".join(files)
 
-def _make_sector_distsrc_files(sector_order_names):
+def _make_sector_distsrc_files(sector_index, sector_order_names, fuse_orders, group_sectors):
     """
     Produce a Makefile-formatted list of source files that
     export_sector will produce for a given sector for the
     distributed evaluator.
     """
-    orders = sector_order_names.values()
-    files = [f"distsrc/sector_{s}_{o}.cpp" for s, o in orders] + \
-            [f"distsrc/sector_{s}_{o}.cu" for s, o in orders]
+    if group_sectors:
+        # written for the whole group, see _make_sector_group_rules
+        files = []
+    elif fuse_orders:
+        files = [f"distsrc/sector_{sector_index}.cpp", f"distsrc/sector_{sector_index}.cu"]
+    else:
+        orders = sector_order_names.values()
+        files = [f"distsrc/sector_{s}_{o}.cpp" for s, o in orders] + \
+                [f"distsrc/sector_{s}_{o}.cu" for s, o in orders]
     return " \\\n\t".join(files)
 
+def _sector_group(sector_index, group_sectors):
+    """
+    Return the index of the group of consecutive sectors that
+    shares a distributed evaluator kernel.
+    """
+    return (sector_index - 1) // group_sectors + 1
+
+def _make_sector_group_rules(sector_index, group_sectors):
+    """
+    Produce the Makefile lines that add a given sector to its
+    group of sectors for the distributed evaluator.
+    """
+    if not group_sectors:
+        return ""
+    group = _sector_group(sector_index, group_sectors)
+    return f"DIST_GROUPS += {group}\nDIST_GROUP{group}_SECTORS += {sector_index}"
+
+def _make_kernel_components(sector_orders, group_sectors):
+    """
+    Return the components of each distributed evaluator kernel
+    with fused orders, given the (sector, order name) pairs of
+    each order: with fused orders each sector is one kernel, and
+    its components are the orders, sorted by the regulator
+    powers; with grouped sectors, the kernel of a group has the
+    orders of all of its sectors.
+
+    Please keep this synchronized with fused_kernel() in
+    export_sector, which lists the parts of a kernel the same
+    way.
+    """
+    sector_components = {}
+    for powers, order_names in sorted(sector_orders.items()):
+        for s, o in order_names:
+            sector_components.setdefault(s, []).append(f"sector_{s}_order_{o}")
+    kernel_components = {}
+    for s in sorted(sector_components):
+        kernel = f"group_{_sector_group(s, group_sectors)}" if group_sectors else f"sector_{s}"
+        kernel_components.setdefault(kernel, []).extend(sector_components[s])
+    return kernel_components
+
 def _derivative_muliindex_to_name(basename, multiindex):
     '''
     Convert a derivative multiindex as returned by
@@ -1355,7 +1403,8 @@ def _process_secondary_sector(environment):
     # generate the definitions of the FORM preprocessor variables "shiftedRegulator`regulatorIndex'PowerOrder`shiftedOrderIndex'"
     sector_order_names = _make_sector_order_names(sector_index, regulator_powers, highest_poles_current_sector)
     sector_cpp_files = _make_sector_cpp_files(sector_index, sector_order_names, contour_deformation_polynomial is not None)
-    sector_distsrc_files = _make_sector_distsrc_files(sector_order_names)
+    sector_distsrc_files = _make_sector_distsrc_files(sector_index, sector_order_names,
+            template_replacements['disteval_fuse_orders'], template_replacements['disteval_group_sectors'])
     regulator_powers = _make_FORM_shifted_orders(regulator_powers)
 
     # parse template file "sector.h"
@@ -1374,6 +1423,7 @@ def _process_secondary_sector(environment):
     template_replacements['sector_cpp_files'] = sector_cpp_files
     template_replacements['sector_hpp_files'] = sector_cpp_files.replace(".cpp", ".hpp")
     template_replacements['sector_distsrc_files'] = sector_distsrc_files
+    template_replacements['sector_group_rules'] = _make_sector_group_rules(sector_index, template_replacements['disteval_group_sectors'])
     template_replacements['sector_codegen_sources'] = \
             "codegen/sector%i.h" % sector_index if contour_deformation_polynomial is None else \
             "codegen/sector%i.h codegen/contour_deformation_sector%i.h" % (sector_index, sector_index)
@@ -1386,7 +1436,7 @@ def _process_secondary_sector(environment):
                         template_replacements)
     for key in 'functions', 'cal_I_derivatives', 'decomposed_polynomial_derivatives','insert_cal_I_procedure','insert_other_procedure','insert_decomposed_procedure', \
             'integrand_definition_procedure','highest_regulator_poles','required_orders','regulator_powers','number_of_orders', \
-            'sector_index', 'sector_cpp_files', 'sector_hpp_files', 'sector_distsrc_files', 'sector_codegen_sources':
+            'sector_index', 'sector_cpp_files', 'sector_hpp_files', 'sector_distsrc_files', 'sector_group_rules', 'sector_codegen_sources':
         del template_replacements[key]
 
     if contour_deformation_polynomial is not None:
@@ -1440,7 +1490,8 @@ def make_package(name, integration_variables, regulators, requested_orders,
                  form_insertion_depth=5, contour_deformation_polynomial=None, positive_polynomials=[],
                  decomposition_method='iterative_no_primary', normaliz_executable=None,
                  enforce_complex=False, split=False, ibp_power_goal=-1, use_iterative_sort=True,
-                 use_light_Pak=True, use_dreadnaut=False, use_Pak=True, processes=None, pylink_qmc_transforms=['korobov3x3']):
+                 use_light_Pak=True, use_dreadnaut=False, use_Pak=True, processes=None, pylink_qmc_transforms=['korobov3x3'],
+                 disteval_fuse_orders=False, disteval_group_sectors=None):
     r'''
     Decompose, subtract and expand an expression.
     Return it as c++ package.
@@ -1749,9 +1800,32 @@ def make_package(name, integration_variables, regulators, requested_orders,
 
         `New in version 1.5`.
         Default: ``['korobov3x3']``
+
+    :param disteval_fuse_orders:
+        bool, optional;
+        Whether the distributed evaluator should use one
+        kernel per sector that computes all of its expansion
+        orders in a single pass, sharing the common
+        subexpressions, instead of one kernel per order.
+        Default: ``False``
+
+    :param disteval_group_sectors:
+        integer or None, optional;
+        If given, the distributed evaluator puts this many
+        consecutive sectors (which all have the same
+        dimension) into one kernel that computes all of their
+        orders at each lattice point, so that many small
+        sectors are integrated in one job; the sectors share
+        the lattice and the contour deformation parameters.
+        The value of each order of each sector is still
+        tracked separately.
+        Default: ``None``
     '''
     print('running "make_package" for "' + name + '"')
 
+    if disteval_group_sectors is not None and int(disteval_group_sectors) < 1:
+        raise ValueError('`disteval_group_sectors` must be a positive integer or ``None``, not %s.' % disteval_group_sectors)
+
     # convert input data types to the data types we need
     name, integration_variables, ibp_power_goal, regulators, \
     requested_orders, polynomials_to_decompose, polynomial_names, \
@@ -1780,7 +1854,7 @@ def make_package(name, integration_variables, regulators, requested_orders,
         real_parameters, complex_parameters, form_optimization_level,
         form_setup, form_insertion_depth, requested_orders,
         contour_deformation_polynomial, nested_series_type,
-        enforce_complex
+        enforce_complex, disteval_fuse_orders, disteval_group_sectors
     )
 
     # get the highest poles from the ``prefactor``
@@ -2218,6 +2292,8 @@ def make_package(name, integration_variables, regulators, requested_orders,
 
     expanded_prefactor = expanded_prefactor.denest()
     os.mkdir(os.path.join(name, "disteval"))
+    group_sectors = template_replacements['disteval_group_sectors']
+    kernel_components = _make_kernel_components(sector_orders, group_sectors)
     descr = {
             "name": name,
             "type": "integral",
@@ -2239,7 +2315,7 @@ def make_package(name, integration_variables, regulators, requested_orders,
                 for e, c in zip(expanded_prefactor.expolist, expanded_prefactor.coeffs)
             ],
             "lowest_orders": list(map(int, lowest_orders)),
-            "kernels": [
+            "kernels": list(kernel_components) if disteval_fuse_orders or group_sectors else [
                 f"sector_{s}_order_{o}"
                 for powers, order_names in sector_orders.items()
                 for s, o in order_names
@@ -2252,6 +2328,8 @@ def make_package(name, integration_variables, regulators, requested_orders,
                 for powers, order_names in sector_orders.items()
             ]
     }
+    if disteval_fuse_orders or group_sectors:
+        descr["kernel_components"] = kernel_components
     with open(os.path.join(name, "disteval", name + ".json"), "w") as f:
         json.dump(descr, f, indent=2)
     template_replacements["description"] = descr
@@ -28,25 +28,16 @@ builtin__gauge( // sunset, nu=(1,2,3), realp=(q2, m1sq, m2sq, m3sq), sector=1, o
     uint64_t index = index1;
     int_t li_x0 = mulmod(genvec[0], index, lattice);
     int_t li_x1 = mulmod(genvec[1], index, lattice);
-    for (; index < index2; index += 4) {
-        int_t li_x0_0 = li_x0; li_x0 = warponce_i(li_x0 + genvec[0], lattice);
-        int_t li_x0_1 = li_x0; li_x0 = warponce_i(li_x0 + genvec[0], lattice);
-        int_t li_x0_2 = li_x0; li_x0 = warponce_i(li_x0 + genvec[0], lattice);
-        int_t li_x0_3 = li_x0; li_x0 = warponce_i(li_x0 + genvec[0], lattice);
-        realvec_t x0 = {{ li_x0_0*invlattice, li_x0_1*invlattice, li_x0_2*invlattice, li_x0_3*invlattice }};
+    for (; index < index2; index += VECSIZE) {
+        realvec_t x0 = lattice_points(li_x0, genvec[0], lattice, invlattice);
         x0 = warponce(x0 + shift[0], 1);
-        int_t li_x1_0 = li_x1; li_x1 = warponce_i(li_x1 + genvec[1], lattice);
-        int_t li_x1_1 = li_x1; li_x1 = warponce_i(li_x1 + genvec[1], lattice);
-        int_t li_x1_2 = li_x1; li_x1 = warponce_i(li_x1 + genvec[1], lattice);
-        int_t li_x1_3 = li_x1; li_x1 = warponce_i(li_x1 + genvec[1], lattice);
-        realvec_t x1 = {{ li_x1_0*invlattice, li_x1_1*invlattice, li_x1_2*invlattice, li_x1_3*invlattice }};
+        realvec_t x1 = lattice_points(li_x1, genvec[1], lattice, invlattice);
         x1 = warponce(x1 + shift[1], 1);
         auto w_x0 = korobov3x3_w(x0);
         auto w_x1 = korobov3x3_w(x1);
         auto w = w_x0*w_x1;
-        if (unlikely(index + 1 >= index2)) w.x[1] = 0;
-        if (unlikely(index + 2 >= index2)) w.x[2] = 0;
-        if (unlikely(index + 3 >= index2)) w.x[3] = 0;
+        for (int k = 1; k < VECSIZE; k++)
+            if (unlikely(index + k >= index2)) w.x[k] = 0;
         x0 = korobov3x3_f(x0);
         x1 = korobov3x3_f(x1);
         auto tmp1_1 = -q2 + m2sq + m3sq + m1sq;
@@ -28,15 +28,24 @@ typedef std::complex<real_t> complex_t;
 #define HAVE_GNU_VECTORS        ((GNUC_VERSION >= 409) || (CLANG_VERSION >= 305) || (APPLE_CLANG_VERSION >= 600)) || (ICC_VERSION >= 1800)
 #define HAVE_GNU_VECTOR_TERNARY ((GNUC_VERSION >= 409) || (CLANG_VERSION >= 1000) || (APPLE_CLANG_VERSION >= 1200))
 
+// The number of lanes in a vector. The default of 4 doubles fits
+// AVX2; the build compiles extra copies of the kernels with other
+// widths (2 for SSE2, 8 for AVX-512) by predefining VECSIZE.
+
+#ifndef VECSIZE
+    #define VECSIZE 4
+#endif
+#define VECBYTES (VECSIZE*8)
+
 #if HAVE_GNU_VECTORS
-    struct alignas(32) realvec_t { real_t x __attribute__((vector_size(32))); };
-    struct alignas(32) complexvec_t { realvec_t re, im; };
+    struct alignas(VECBYTES) realvec_t { real_t x __attribute__((vector_size(VECBYTES))); };
+    struct alignas(VECBYTES) complexvec_t { realvec_t re, im; };
     #define likely(x) __builtin_expect((x), 1)
     #define unlikely(x) __builtin_expect((x), 0)
     #define restrict __restrict__
 #else
-    struct alignas(32) realvec_t { real_t x[4]; };
-    struct alignas(32) complexvec_t { realvec_t re, im; };
+    struct alignas(VECBYTES) realvec_t { real_t x[VECSIZE]; };
+    struct alignas(VECBYTES) complexvec_t { realvec_t re, im; };
     #define likely(x) (x)
     #define unlikely(x) (x)
     #define restrict
@@ -84,7 +93,10 @@ INT_COMPLEX(/)
 
 // Real vectors
 
-#define REALVEC_CONST(c) (realvec_t{{c,c,c,c}})
+mathfn realvec_t realvec_const(const real_t c)
+{ realvec_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = c; return r; }
+
+#define REALVEC_CONST(c) (realvec_const(c))
 #define REALVEC_ZERO REALVEC_CONST(0)
 
 #if HAVE_GNU_VECTORS
@@ -103,17 +115,17 @@ INT_COMPLEX(/)
 
     #define DEF_OPERATOR1(ret_t, fname, arg1_t, op) \
         mathfn ret_t fname(const arg1_t &a) \
-        { return ret_t{{ op a.x[0], op a.x[1], op a.x[2], op a.x[3] }}; }
+        { ret_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = op a.x[k]; return r; }
 
     #define DEF_OPERATOR(ret_t, fname, arg1_t, arg2_t, op) \
         mathfn ret_t fname(const arg1_t &a, const arg2_t &b) \
-        { return ret_t{{ a.x[0] op b.x[0], a.x[1] op b.x[1], a.x[2] op b.x[2], a.x[3] op b.x[3] }}; }
+        { ret_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = a.x[k] op b.x[k]; return r; }
 
     #define DEF_SCALAR_OPERATOR(ret_t, fname, vec_t, scalar_t, op) \
         mathfn ret_t fname(const scalar_t &a, const vec_t &b) \
-        { return ret_t{{ a op b.x[0], a op b.x[1], a op b.x[2], a op b.x[3] }}; } \
+        { ret_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = a op b.x[k]; return r; } \
         mathfn ret_t fname(const vec_t &a, const scalar_t &b) \
-        { return ret_t{{ a.x[0] op b, a.x[1] op b, a.x[2] op b, a.x[3] op b }}; }
+        { ret_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = a.x[k] op b; return r; }
 
 #endif
 
@@ -142,26 +154,30 @@ DEF_SCALAR_OPERATOR(realvec_t, operator /, realvec_t, real_t, /)
 #else
 
     mathfn realvec_t vec_max(const realvec_t &a, const realvec_t &b)
-    { return realvec_t{{ a.x[0] > b.x[0] ? a.x[0] : b.x[0],
-                         a.x[1] > b.x[1] ? a.x[1] : b.x[1],
-                         a.x[2] > b.x[2] ? a.x[2] : b.x[2],
-                         a.x[3] > b.x[3] ? a.x[3] : b.x[3] }}; }
+    { realvec_t r;
+      for (int k = 0; k < VECSIZE; k++) r.x[k] = a.x[k] > b.x[k] ? a.x[k] : b.x[k];
+      return r; }
 
     mathfn realvec_t vec_min(const realvec_t &a, const realvec_t &b)
-    { return realvec_t{{ a.x[0] < b.x[0] ? a.x[0] : b.x[0],
-                         a.x[1] < b.x[1] ? a.x[1] : b.x[1],
-                         a.x[2] < b.x[2] ? a.x[2] : b.x[2],
-                         a.x[3] < b.x[3] ? a.x[3] : b.x[3] }}; }
+    { realvec_t r;
+      for (int k = 0; k < VECSIZE; k++) r.x[k] = a.x[k] < b.x[k] ? a.x[k] : b.x[k];
+      return r; }
 
     mathfn realvec_t warponce(const realvec_t &a, const real_t b)
     { realvec_t ab = a - b;
-      return realvec_t{{ ab.x[0] >= 0 ? ab.x[0] : a.x[0],
-                         ab.x[1] >= 0 ? ab.x[1] : a.x[1],
-                         ab.x[2] >= 0 ? ab.x[2] : a.x[2],
-                         ab.x[3] >= 0 ? ab.x[3] : a.x[3] }}; }
+      for (int k = 0; k < VECSIZE; k++) ab.x[k] = ab.x[k] >= 0 ? ab.x[k] : a.x[k];
+      return ab; }
 
 #endif
 
+// Lattice points index..index+VECSIZE-1 along one dimension;
+// li is the integer coordinate of the first, and is advanced
+// past the last.
+mathfn realvec_t lattice_points(int_t &li, const int_t g, const int_t lattice, const real_t invlattice)
+{ realvec_t r;
+  for (int k = 0; k < VECSIZE; k++) { r.x[k] = li*invlattice; li = warponce_i(li + g, lattice); }
+  return r; }
+
 mathfn realvec_t vec_max(const realvec_t &a, const real_t &b)
 { return vec_max(a, REALVEC_CONST(b)); }
 mathfn realvec_t vec_max(const real_t &a, const realvec_t &b)
@@ -174,19 +190,21 @@ mathfn realvec_t vec_min(const real_t &a, const realvec_t &b)
 
 #define DEF_FUNCTION(ret_t, fname, arg_t, f) \
     mathfn ret_t fname(const arg_t &a) \
-    { return ret_t{{ f(a.x[0]), f(a.x[1]), f(a.x[2]), f(a.x[3]) }}; }
+    { ret_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = f(a.x[k]); return r; }
 
 #define DEF_SCALAR_BOOL_OPERATOR(fname, vec_t, scalar_t, op, redop) \
     mathfn bool fname(const vec_t &a, const scalar_t &b) \
-    { return (a.x[0] op b) redop (a.x[1] op b) redop (a.x[2] op b) redop (a.x[3] op b); }
+    { bool r = (a.x[0] op b); \
+      for (int k = 1; k < VECSIZE; k++) r = r redop (a.x[k] op b); \
+      return r; }
 
 #define DEF_RR_FUNCTION(fname, fn) \
     static inline realvec_t fname(const realvec_t &a) \
-    { return realvec_t{{ fn(a.x[0]), fn(a.x[1]), fn(a.x[2]), fn(a.x[3]) }}; }
+    { realvec_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = fn(a.x[k]); return r; }
 
 #define DEF_RR_FUNCTION_1(fname, fn, a1decl, a1) \
     static inline realvec_t fname(const realvec_t &a, a1decl a1) \
-    { return realvec_t{{ fn(a.x[0], a1), fn(a.x[1], a1), fn(a.x[2], a1), fn(a.x[3], a1) }}; }
+    { realvec_t r; for (int k = 0; k < VECSIZE; k++) r.x[k] = fn(a.x[k], a1); return r; }
 
 DEF_SCALAR_BOOL_OPERATOR(operator >, realvec_t, real_t, >, ||)
 DEF_SCALAR_BOOL_OPERATOR(operator <, realvec_t, real_t, <, ||)
@@ -196,12 +214,14 @@ mathfn realvec_t SecDecInternalRealPart(const realvec_t &a) { return a; }
 mathfn realvec_t SecDecInternalImagPart(const realvec_t &a) { return REALVEC_ZERO; }
 
 mathfn real_t componentsum(const realvec_t &a)
-{ return a.x[0] + a.x[1] + a.x[2] + a.x[3]; }
+{ real_t s = a.x[0];
+  for (int k = 1; k < VECSIZE; k++) s += a.x[k];
+  return s; }
 
 mathfn real_t componentmin(const realvec_t &a)
-{ real_t m1 = a.x[0] < a.x[1] ? a.x[0] : a.x[1];
-  real_t m2 = a.x[2] < a.x[3] ? a.x[2] : a.x[3];
-  return m1 < m2 ? m1 : m2; }
+{ real_t m = a.x[0];
+  for (int k = 1; k < VECSIZE; k++) m = a.x[k] < m ? a.x[k] : m;
+  return m; }
 
 mathfn realvec_t clamp01(const realvec_t &a)
 { return vec_max(vec_min(a, REALVEC_CONST(1)), REALVEC_CONST(0)); }
@@ -321,47 +341,39 @@ mathfn realvec_t SecDecInternalImagPart(const complexvec_t &a) { return a.im; }
 
 #define DEF_CC_FUNCTION(fname, fn) \
     static inline complexvec_t fname(const complexvec_t &a) { \
-        complex_t c0 = fn(complex_t{a.re.x[0], a.im.x[0]}); \
-        complex_t c1 = fn(complex_t{a.re.x[1], a.im.x[1]}); \
-        complex_t c2 = fn(complex_t{a.re.x[2], a.im.x[2]}); \
-        complex_t c3 = fn(complex_t{a.re.x[3], a.im.x[3]}); \
-        return complexvec_t{ \
-            {{c0.real(), c1.real(), c2.real(), c3.real()}}, \
-            {{c0.imag(), c1.imag(), c2.imag(), c3.imag()}} \
-        }; \
+        complexvec_t r; \
+        for (int k = 0; k < VECSIZE; k++) { \
+            complex_t c = fn(complex_t{a.re.x[k], a.im.x[k]}); \
+            r.re.x[k] = c.real(); r.im.x[k] = c.imag(); \
+        } \
+        return r; \
     }
 #define DEF_CR_FUNCTION(fname, fn) \
     static inline complexvec_t fname(const realvec_t &a) { \
-        complex_t c0 = fn(a.x[0]); \
-        complex_t c1 = fn(a.x[1]); \
-        complex_t c2 = fn(a.x[2]); \
-        complex_t c3 = fn(a.x[3]); \
-        return complexvec_t{ \
-            {{c0.real(), c1.real(), c2.real(), c3.real()}}, \
-            {{c0.imag(), c1.imag(), c2.imag(), c3.imag()}} \
-        }; \
+        complexvec_t r; \
+        for (int k = 0; k < VECSIZE; k++) { \
+            complex_t c = fn(a.x[k]); \
+            r.re.x[k] = c.real(); r.im.x[k] = c.imag(); \
+        } \
+        return r; \
     }
 #define DEF_CC_FUNCTION_1(fname, fn, a1decl, a1) \
     static inline complexvec_t fname(const complexvec_t &a, a1decl a1) { \
-        complex_t c0 = fn(complex_t{a.re.x[0], a.im.x[0]}, a1); \
-        complex_t c1 = fn(complex_t{a.re.x[1], a.im.x[1]}, a1); \
-        complex_t c2 = fn(complex_t{a.re.x[2], a.im.x[2]}, a1); \
-        complex_t c3 = fn(complex_t{a.re.x[3], a.im.x[3]}, a1); \
-        return complexvec_t{ \
-            {{c0.real(), c1.real(), c2.real(), c3.real()}}, \
-            {{c0.imag(), c1.imag(), c2.imag(), c3.imag()}} \
-        }; \
+        complexvec_t r; \
+        for (int k = 0; k < VECSIZE; k++) { \
+            complex_t c = fn(complex_t{a.re.x[k], a.im.x[k]}, a1); \
+            r.re.x[k] = c.real(); r.im.x[k] = c.imag(); \
+        } \
+        return r; \
     }
 #define DEF_CR_FUNCTION_1(fname, fn, a1decl, a1) \
     static inline complexvec_t fname(const realvec_t &a, a1decl a1) { \
-        complex_t c0 = fn(a.x[0], a1); \
-        complex_t c1 = fn(a.x[1], a1); \
-        complex_t c2 = fn(a.x[2], a1); \
-        complex_t c3 = fn(a.x[3], a1); \
-        return complexvec_t{ \
-            {{c0.real(), c1.real(), c2.real(), c3.real()}}, \
-            {{c0.imag(), c1.imag(), c2.imag(), c3.imag()}} \
-        }; \
+        complexvec_t r; \
+        for (int k = 0; k < VECSIZE; k++) { \
+            complex_t c = fn(a.x[k], a1); \
+            r.re.x[k] = c.real(); r.im.x[k] = c.imag(); \
+        } \
+        return r; \
     }
 
 mathfn complexvec_t SecDecInternalI(const realvec_t &a)
@@ -3,10 +3,12 @@ from .make_package import _convert_input, _make_FORM_definition, \
                           _make_FORM_function_definition, _make_FORM_list, \
                           _derivative_muliindex_to_name, _make_FORM_shifted_orders, \
                           _validate, _make_prefactor_function, \
-                          _make_CXX_function_declaration
+                          _make_CXX_function_declaration, _make_sector_distsrc_files, \
+                          _make_sector_group_rules, _make_kernel_components
 from ..algebra import Function, Polynomial, Product, ProductRule, Sum
 from ..misc import sympify_expression
-import sys, shutil
+import sys, shutil, os
+import importlib.machinery, importlib.util
 import unittest
 import pytest
 
@@ -457,6 +459,20 @@ class TestMiscellaneous(unittest.TestCase):
 
         self.assertEqual(FORM_code, target_FORM_code)
 
+    #@pytest.mark.active
+    def test_make_sector_distsrc_files(self):
+        order_names = {(-1,): (3, 'n1'), (0,): (3, '0')}
+
+        self.assertEqual(_make_sector_distsrc_files(3, order_names, False, 0),
+            'distsrc/sector_3_n1.cpp \\\n\tdistsrc/sector_3_0.cpp \\\n\tdistsrc/sector_3_n1.cu \\\n\tdistsrc/sector_3_0.cu')
+        self.assertEqual(_make_sector_distsrc_files(3, order_names, True, 0),
+            'distsrc/sector_3.cpp \\\n\tdistsrc/sector_3.cu')
+        self.assertEqual(_make_sector_distsrc_files(3, order_names, True, 2), '')
+
+        self.assertEqual(_make_sector_group_rules(3, 0), '')
+        self.assertEqual(_make_sector_group_rules(3, 2), 'DIST_GROUPS += 2\nDIST_GROUP2_SECTORS += 3')
+        self.assertEqual(_make_sector_group_rules(4, 2), 'DIST_GROUPS += 2\nDIST_GROUP2_SECTORS += 4')
+
 class TestWriteCppCodePrefactor(unittest.TestCase):
     #@pytest.mark.active
     def test_one_regulator(self):
@@ -724,3 +740,148 @@ class TestMaxDegreeFunction(unittest.TestCase):
             MaxDegreeFunction.get_maxdegrees(self.exponentiated_polynomial, ignore_subclass=True, indices=[1]),
             (np.inf,self.target_maxdegrees[1],np.inf)
         )
+
+def load_export_sector():
+    # export_sector is a script without the .py extension.
+    import pySecDecContrib
+    path = os.path.join(pySecDecContrib.dirname, 'bin', 'export_sector')
+    loader = importlib.machinery.SourceFileLoader('export_sector', path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('export_sector', loader))
+    loader.exec_module(module)
+    return module
+
+def make_sector_info(sector, orders, integration_variables='x0,x1,x2'):
+    # A sector<N>.info dictionary with the given (name, powers,
+    # integration variables, deformation parameters, integrand,
+    # deformation parameter optimization, contour deformation
+    # polynomial) of each order.
+    info = {'sector': str(sector), 'numOrders': str(len(orders)),
+            'integrationVariables': integration_variables, 'contourDeformation': '1'}
+    for o, (name, powers, ivars, deformp, integrand, maxdeformp, fpoly) in enumerate(orders, 1):
+        info.update({
+            'order%i_name' % o: name,
+            'order%i_regulatorPowers' % o: powers,
+            'order%i_integrationVariables' % o: ivars,
+            'order%i_deformationParameters' % o: deformp,
+            'order%i_integrandBody' % o: integrand,
+            'order%i_optimizeDeformationParametersBody' % o: maxdeformp,
+            'order%i_contourDeformationPolynomialBody' % o: fpoly
+        })
+    return info
+
+class TestExportSector(unittest.TestCase):
+    def setUp(self):
+        self.export_sector = load_export_sector()
+
+    #@pytest.mark.active
+    def test_merge_code_declarations(self):
+        code = self.export_sector.merge_code([
+            'auto a = x*y;\nauto b = a + 1;\nacc[0] = acc[0] + (b);',
+            'auto a = x*y;\nreal_t b = x*y;\nauto c = a*b;\nacc[1] = acc[1] + (c);'
+        ])
+        self.assertEqual(code, [
+            'auto a_o0 = x*y;',
+            'auto b_o0 = a_o0 + 1;',
+            'acc[0] = acc[0] + (b_o0);',
+            # not the same declaration as `auto a`
+            'real_t b_o1 = x*y;',
+            'auto c_o1 = a_o0*b_o1;',
+            'acc[1] = acc[1] + (c_o1);'
+        ])
+
+    #@pytest.mark.active
+    def test_merge_code_other_lines(self):
+        code = self.export_sector.merge_code([
+            'auto a = x*y;\nif (unlikely(a > 0)) return 1;\nif (unlikely(x > 0)) return 1;',
+            'auto a = x*y;\nif (unlikely(a > 0)) return 1;\nif (unlikely(y > 0)) return 1;'
+        ])
+        self.assertEqual(code, [
+            'auto a_o0 = x*y;',
+            'if (unlikely(a_o0 > 0)) return 1;',
+            'if (unlikely(x > 0)) return 1;',
+            'if (unlikely(y > 0)) return 1;'
+        ])
+
+    #@pytest.mark.active
+    def test_fused_kernel(self):
+        # The second order only has the variables x1 and x2, and
+        # thus only the deformation parameter of x1, which it
+        # refers to as its 0th one.
+        info = make_sector_info(1, [
+            ('0', '0', 'x0,x1,x2', 'SecDecInternalLambda0,SecDecInternalLambda1',
+             'SecDecInternalAbbreviation[1] = x1*x2;\nreturn(SecDecInternalAbbreviation[1] + x0);',
+             'SecDecInternalOutputDeformationParameters(0, x0);\nSecDecInternalOutputDeformationParameters(1, x1);',
+             'return(x1*x2 - x0);'),
+            ('n1', '-1', 'x1,x2', 'SecDecInternalLambda1',
+             'SecDecInternalAbbreviation[1] = x1*x2;\nreturn(2*SecDecInternalAbbreviation[1]);',
+             'SecDecInternalOutputDeformationParameters(0, x2);',
+             'return(x1*x2);')
+        ])
+        fused = self.export_sector.fused_kernel('sector_1', [info])
+        self.assertEqual(fused.parts, [('1', 'n1'), ('1', '0')])
+        self.assertEqual(fused.intvars, ['x0', 'x1', 'x2'])
+        self.assertEqual(fused.deformp, ['SecDecInternalLambda0', 'SecDecInternalLambda1'])
+        self.assertEqual(fused.weights, [('wo_0', ('x1', 'x2')), ('wo_1', ('x0', 'x1', 'x2'))])
+        self.assertEqual(fused.integrand, [
+            'auto tmp1_1_o0 = x1*x2;',
+            'acc[0] = acc[0] + wo_0*(2*tmp1_1_o0);',
+            'acc[1] = acc[1] + wo_1*(tmp1_1_o0 + x0);'
+        ])
+        self.assertEqual(fused.maxdeformp, [
+            'SecDecInternalOutputDeformationParameters(1, x2);',
+            'SecDecInternalOutputDeformationParameters(0, x0);',
+            'SecDecInternalOutputDeformationParameters(1, x1);'
+        ])
+        self.assertEqual(fused.fpolycheck, [
+            'auto fpoly_im_o0 = SecDecInternalImagPart(x1*x2);',
+            'if (unlikely(fpoly_im_o0 > 0)) return 1;',
+            'auto fpoly_im_o1 = SecDecInternalImagPart(x1*x2 - x0);',
+            'if (unlikely(fpoly_im_o1 > 0)) return 1;'
+        ])
+
+    #@pytest.mark.active
+    def test_fused_parts_order(self):
+        # The results of a fused kernel come in the order of the
+        # components listed by make_package.
+        orders = [('n2', '-2,0'), ('0', '0,0'), ('n1', '-1,0'), ('n1_1', '-1,1')]
+        info = make_sector_info(3, [
+            (name, powers, 'x0,x1', '', 'return(x0);', '', 'return(x1);')
+            for name, powers in orders
+        ])
+        sector_orders = {}
+        for name, powers in orders:
+            sector_orders.setdefault(tuple(int(p) for p in powers.split(',')), []).append((3, name))
+        fused = self.export_sector.fused_kernel('sector_3', [info])
+        self.assertEqual(['sector_%s_order_%s' % part for part in fused.parts],
+                         _make_kernel_components(sector_orders, 0)['sector_3'])
+
+    #@pytest.mark.active
+    def test_group_parts_order(self):
+        # With two sectors per group, the sectors 1 and 2 share
+        # the kernel group_1, and the sector 3 has group_2; the
+        # sectors have different orders.
+        sector_order_powers = {
+            1: [('0', '0'), ('n1', '-1')],
+            2: [('1', '1'), ('n1', '-1'), ('0', '0')],
+            3: [('0', '0'), ('n2', '-2')]
+        }
+        infos = {
+            s: make_sector_info(s, [
+                (name, powers, 'x0,x1', '', 'return(x0);', '', 'return(x1);')
+                for name, powers in orders
+            ])
+            for s, orders in sector_order_powers.items()
+        }
+        sector_orders = {}
+        for s, orders in sorted(sector_order_powers.items()):
+            for name, powers in orders:
+                sector_orders.setdefault((int(powers),), []).append((s, name))
+        kernel_components = _make_kernel_components(sector_orders, 2)
+        self.assertEqual(list(kernel_components), ['group_1', 'group_2'])
+        for group, sectors in (('group_1', [1, 2]), ('group_2', [3])):
+            fused = self.export_sector.fused_kernel(group, [infos[s] for s in sectors])
+            self.assertEqual(['sector_%s_order_%s' % part for part in fused.parts], kernel_components[group])
+        self.assertEqual(kernel_components['group_1'], [
+            'sector_1_order_n1', 'sector_1_order_0',
+            'sector_2_order_n1', 'sector_2_order_0', 'sector_2_order_1'
+        ])
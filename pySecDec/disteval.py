@@ -6,14 +6,46 @@ Usage:
 Options:
     --epsabs=X              stop if this absolute precision is reached (default: 1e-10)
     --epsrel=X              stop if this relative precision is reached (default: 1e-4)
-    --timeout=X             stop after at most this many seconds (defaul: inf)
+    --timeout=X             stop after at most this many seconds per point (default: inf)
     --points=X              begin integration with this lattice size (default: 1e4)
     --presamples=X          use this many points for presampling (default: 1e4)
     --shifts=X              use this many lattice shifts per integral (default: 32)
+    --job-time=X            split the lattices into jobs of about X seconds (default: 1)
     --cluster=X             use this cluster.json file
+    --local-cpus=X          without a cluster file, use this many threads for the local CPU
+                            workers (default: all, but one per GPU and one for disteval)
+    --local-gpus=X          without a cluster file, use at most this many GPUs (default: all)
+    --gpu-lattice=X         send lattices smaller than X points to the CPU workers only, and
+                            the rest to the GPU workers only (default: by expected job durations)
+    --watch-cluster=X       check the cluster file every X seconds, and start or retire
+                            the workers as they are added or removed there (default: no)
     --coefficients=X        use coefficients from this directory
+    --coefficient-workers=X without a "coefficients" list in the cluster file, expand the
+                            coefficients using this many local workers (default: 2)
     --format=X              output the result in this format ("sympy", "mathematica", "json")
     --lattice-candidates=X  number of median lattice candidates, if X>0 (default: 0)
+    --lattice-step=X        construct lattices at most 1+X times larger than needed,
+                            if the built-in tables have none (default: tables only)
+    --lattice-cache=X       store the constructed lattices in this directory
+                            (default: ~/.cache/pysecdec/generating-vectors)
+    --protocol=X            talk to the workers using this protocol ("binary", "json")
+    --scheduler=X           distribute the jobs using this scheduler ("random", "cost"; default: "random")
+    --relaunch=X            relaunch the workers that die ("yes", "no"; default: "yes")
+    --heartbeat=X           consider busy workers dead after X seconds of silence (default: 5m)
+    --calibration=X         reuse the worker calibration stored in this file ("none" to disable;
+                            default: ~/.cache/pysecdec/disteval-calibration.json)
+    --calibration-ttl=X     recalibrate the workers after X seconds (default: 1d)
+    --cache=X               reuse and store the integration results in this directory
+    --cache-size=X          keep at most this many results in the cache (default: 1e6)
+    --scan=X                evaluate each point of this CSV or JSONL file ("-" for stdin)
+    --scan-output=X         write the scan results to this JSONL file (default: stdout)
+    --parallel-points=X     evaluate up to this many scan points at once (default: 4)
+    --warm-start=X          start from the lattices saved in this file, and update it
+    --checkpoint=X          save the integration state to this file after each round
+    --resume=X              continue from the state saved in this file, and keep updating it
+    --metrics=X             write the worker and kernel statistics to this JSON file periodically
+    --metrics-interval=X    update the metrics file every X seconds (default: 10s)
+    --trace=X               write the timeline of all jobs to this Chrome trace event file
     --help                  show this help message
 Arguments:
     <var>=X                 set this integral or coefficient variable to a given value
@@ -22,19 +54,28 @@ Arguments:
 """
 
 import asyncio
+import bisect
+import collections
+import csv
+import functools
 import getopt
+import hashlib
+import itertools
 import json
 import math
 import numpy as np
 import os
 import random
 import re
+import sqlite3
+import struct
 import subprocess
 import sympy as sp
 import sys
 import time
 
-from .generating_vectors import generating_vector, max_lattice_size
+from .generating_vectors import generating_vector, max_lattice_size, default_cache_dir as default_lattice_cache
+from .disteval_coefficients import coefficient_orders, load_compiled_coefficient
 
 from pySecDecContrib import dirname as contrib_dirname
 
@@ -64,25 +105,140 @@ def encode_message(data):
 def decode_message(binary):
     return json.loads(binary[1:])
 
+# Binary RPC: once negotiated at the "start" command, every
+# message is a frame made of a 16-byte header (token, method
+# or reply kind, payload size) and a payload. The frequent
+# messages have fixed-layout little-endian payloads; the rest
+# are JSON messages wrapped into a frame.
+
+FRAME_HEADER = struct.Struct("<QII")
+METHOD_JSON = 0
+METHOD_INTEGRATE = 1
+METHOD_MAXDEFORMP = 2
+METHOD_PING = 3
+METHOD_INTEGRATE_SHIFTS = 4
+REPLY_JSON = 0
+REPLY_INTEGRATE = 1
+REPLY_REALS = 2
+REPLY_INTEGRATE_SHIFTS = 3
+INTEGRATE_FRAME = struct.Struct("<6Q")
+INTEGRATE_SHIFTS_FRAME = struct.Struct("<7Q")
+MAXDEFORMP_FRAME = struct.Struct("<4Q")
+INTEGRATE_REPLY = struct.Struct("<ddQd")
+INTEGRATE_SHIFTS_REPLY = struct.Struct("<Qd")
+
+# The maximal number of shifts in one "integrate_shifts" call.
+MAX_SHIFTS_PER_CALL = 64
+
+def encode_binary_message(token, method, args):
+    if method == "integrate":
+        kernelidx, lattice, i1, i2, genvec, shift, deformp = args
+        ndim = len(genvec)
+        payload = INTEGRATE_FRAME.pack(kernelidx, lattice, i1, i2, ndim, len(deformp)) + \
+            struct.pack(f"<{ndim}Q{ndim}d{len(deformp)}d", *genvec, *shift, *deformp)
+        return FRAME_HEADER.pack(token, METHOD_INTEGRATE, len(payload)) + payload
+    if method == "integrate_shifts":
+        kernelidx, lattice, i1, i2, genvec, shifts, deformp = args
+        ndim = len(genvec)
+        payload = INTEGRATE_SHIFTS_FRAME.pack(kernelidx, lattice, i1, i2, ndim, len(deformp), len(shifts)) + \
+            struct.pack(f"<{ndim}Q{ndim*len(shifts)}d{len(deformp)}d", *genvec, *(x for shift in shifts for x in shift), *deformp)
+        return FRAME_HEADER.pack(token, METHOD_INTEGRATE_SHIFTS, len(payload)) + payload
+    if method == "maxdeformp":
+        kernelidx, ndeformp, lattice, genvec, shift = args
+        ndim = len(genvec)
+        payload = MAXDEFORMP_FRAME.pack(kernelidx, ndeformp, lattice, ndim) + \
+            struct.pack(f"<{ndim}Q{ndim}d", *genvec, *shift)
+        return FRAME_HEADER.pack(token, METHOD_MAXDEFORMP, len(payload)) + payload
+    if method == "ping":
+        return FRAME_HEADER.pack(token, METHOD_PING, 0)
+    payload = encode_message((token, method, args))
+    return FRAME_HEADER.pack(token, METHOD_JSON, len(payload)) + payload
+
+def decode_binary_reply(kind, payload):
+    """
+    Decode the payload of a binary reply frame into a
+    (result, error) pair.
+    """
+    if kind == REPLY_INTEGRATE:
+        re, im, di, dt = INTEGRATE_REPLY.unpack(payload)
+        return [[re, im], di, dt], None
+    if kind == REPLY_INTEGRATE_SHIFTS:
+        di, dt = INTEGRATE_SHIFTS_REPLY.unpack_from(payload)
+        values = struct.unpack_from(f"<{(len(payload) - INTEGRATE_SHIFTS_REPLY.size)//8}d", payload, INTEGRATE_SHIFTS_REPLY.size)
+        return [[list(values[i:i+2]) for i in range(0, len(values), 2)], di, dt], None
+    if kind == REPLY_REALS:
+        return list(struct.unpack(f"<{len(payload)//8}d", payload)), None
+    if kind == REPLY_JSON:
+        return json.loads(payload)
+    raise ValueError(f"unknown reply kind: {kind}")
+
+# Commands that are known to not understand the protocol
+# negotiation, and are started in the JSON mode right away.
+json_only_commands = set()
+
+# The protocols that can be asked for at the negotiation.
+protocols = ("binary", "json")
+
 class WorkerException(Exception):
     pass
 
+# The error passed to the pending callbacks of a worker that
+# has exited or stopped responding.
+WORKER_DIED = "worker died"
+
+# How fast the worker speed estimates follow the timings of the
+# real jobs (0: never, 1: take the latest job as is).
+SPEED_SMOOTHING = 0.1
+
 class Worker:
 
-    def __init__(self, process, name=None):
+    def __init__(self, process, name=None, protocol="json", features=(), command=None):
         self.name = name
         self.process = process
+        self.protocol = protocol
+        self.features = set(features)
+        self.command = command
         self.serial = 0
         self.callbacks = {}
-        self.reader_task = asyncio.get_event_loop().create_task(self._reader())
+        self.alive = True
+        self.on_exit = None
+        self.last_activity = time.time()
+        self.metrics = None
+        self.heartbeat_task = None
+        # The instruction set of the loaded kernels, as reported by
+        # the worker, and how much faster they are than the generic
+        # ones.
+        self.isa = None
+        self.isa_speedup = 1.0
+        if protocol == "binary":
+            self._encode = encode_binary_message
+            self.reader_task = asyncio.get_event_loop().create_task(self._binary_reader())
+        else:
+            self._encode = lambda token, method, args: encode_message((token, method, args))
+            self.reader_task = asyncio.get_event_loop().create_task(self._reader())
 
     def queue_size(self):
         return len(self.callbacks)
 
+    def update_speed(self, bubbles, dt):
+        """
+        Refine the speed estimate using a finished job that was
+        expected to cost this many bubbles, and took dt seconds.
+        """
+        if dt > 2*self.int_overhead:
+            self.speed += SPEED_SMOOTHING*(bubbles/(dt - self.int_overhead) - self.speed)
+
     def call_cb(self, method, args, callback, callback_args=()):
         token = self.serial = self.serial + 1
+        if not self.alive:
+            asyncio.get_event_loop().call_soon(callback, None, WORKER_DIED, self, *callback_args)
+            return token
+        if not self.callbacks:
+            self.last_activity = time.time()
         self.callbacks[token] = (callback, callback_args)
-        message = encode_message((token, method, args))
+        message = self._encode(token, method, args)
+        if self.metrics is not None:
+            self.metrics.sent(self, token, method, args, len(message))
         self.process.stdin.write(message)
         return token
 
@@ -105,6 +261,8 @@ class Worker:
         results = [None]*len(calls)
         ntodo = [len(calls)]
         def multicall_return(result, error, w, i):
+            if fut.done():
+                return
             if error is None:
                 results[i] = result
                 ntodo[0] -= 1
@@ -112,12 +270,19 @@ class Worker:
                     fut.set_result(results)
             else:
                 fut.set_exception(WorkerException(error))
-        s0 = self.serial
+        if not self.alive:
+            fut.set_exception(WorkerException(WORKER_DIED))
+            return fut
+        if not self.callbacks:
+            self.last_activity = time.time()
+        s0 = self.serial + 1
         self.serial += len(calls)
         parts = []
         for i, (method, args) in enumerate(calls):
-            parts.append(encode_message((s0 + i, method, args)))
+            parts.append(self._encode(s0 + i, method, args))
             self.callbacks[s0 + i] = (multicall_return, (i,))
+            if self.metrics is not None:
+                self.metrics.sent(self, s0 + i, method, args, len(parts[-1]))
         self.process.stdin.write(b"".join(parts))
         return fut
 
@@ -129,7 +294,10 @@ class Worker:
                 line = await self.process.stdout.readline()
                 if len(line) == 0: break
                 if line.startswith(b"@"):
+                    self.last_activity = time.time()
                     i, res, err = decode_message(line)
+                    if self.metrics is not None:
+                        self.metrics.received(self, i, res, err, len(line))
                     callback, callback_args = self.callbacks[i]
                     del self.callbacks[i]
                     callback(res, err, self, *callback_args)
@@ -139,92 +307,1118 @@ class Worker:
             log(f"{self.name} reader failed: {type(e).__name__}: {e}")
             log(f"{self.name} line was {line!r}")
         log(f"{self.name} reader exited")
+        self._exited()
+
+    async def _binary_reader(self):
+        header = None
+        try:
+            while True:
+                header = await self.process.stdout.readexactly(FRAME_HEADER.size)
+                i, kind, size = FRAME_HEADER.unpack(header)
+                payload = await self.process.stdout.readexactly(size)
+                self.last_activity = time.time()
+                res, err = decode_binary_reply(kind, payload)
+                if self.metrics is not None:
+                    self.metrics.received(self, i, res, err, FRAME_HEADER.size + size)
+                callback, callback_args = self.callbacks[i]
+                del self.callbacks[i]
+                callback(res, err, self, *callback_args)
+        except asyncio.IncompleteReadError as e:
+            if len(e.partial) != 0:
+                log(f"{self.name} reader failed: truncated frame")
+        except Exception as e:
+            log(f"{self.name} reader failed: {type(e).__name__}: {e}")
+            log(f"{self.name} frame header was {header!r}")
+        log(f"{self.name} reader exited")
+        self._exited()
+
+    def _exited(self):
+        # Let the scheduler forget this worker first, so that the
+        # failed jobs would be re-sent to the others.
+        self.alive = False
+        if self.metrics is not None:
+            self.metrics.exited(self)
+        if self.on_exit is not None:
+            self.on_exit(self)
+        callbacks, self.callbacks = self.callbacks, {}
+        for callback, callback_args in callbacks.values():
+            callback(None, WORKER_DIED, self, *callback_args)
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+
+    def start_heartbeat(self, timeout):
+        self.heartbeat_task = asyncio.get_event_loop().create_task(self._heartbeat(timeout))
+
+    async def _heartbeat(self, timeout):
+        # Ping idle workers, so that dead connections would be
+        # noticed; kill busy workers that stay silent for too long.
+        while self.alive:
+            await asyncio.sleep(timeout/4)
+            if not self.alive:
+                break
+            if not self.callbacks:
+                self.call_cb("ping", (), lambda result, error, w: None)
+            elif time.time() - self.last_activity > timeout:
+                log(f"{self.name} did not reply in {timeout}s, assuming it is dead")
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    pass
+                break
+
+# Integration job methods; their replies are (value, points, seconds).
+JOB_METHODS = ("integrate", "integrate_shifts")
+
+class Metrics:
+    """
+    Structured statistics of a disteval run: per-worker busy time,
+    queue depth, bytes exchanged and call latency histograms, and
+    per-kernel evaluation rates. Optionally, also a timeline of
+    all the integration jobs in the Chrome trace event format,
+    viewable in chrome://tracing or https://ui.perfetto.dev.
+
+    The workers report it via sent(), received() and exited();
+    a worker's busy time is the sum of the job durations that it
+    measures itself, so busy/wall is the useful time fraction.
+    """
+
+    def __init__(self, trace=False):
+        self.t0 = time.time()
+        self.workers = [] # [(worker, stats)]
+        self.kernels = {} # kernel name -> stats
+        self.kernel_names = {} # kernel id -> name
+        self.history = [] # [(time, [queue depth per worker])]
+        self.trace = [] if trace else None
+
+    def add_worker(self, w):
+        stats = {
+            "started": time.time(),
+            "exited": None,
+            "busy": 0.0,
+            "jobs": 0,
+            "calls": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "max_queue": 0,
+            "latency": {},
+            "pending": {}
+        }
+        w.metrics = self
+        w.metrics_index = len(self.workers)
+        self.workers.append((w, stats))
+        if self.trace is not None:
+            self.trace.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": w.metrics_index, "args": {"name": w.name}})
+
+    def sent(self, w, token, method, args, nbytes):
+        stats = self.workers[w.metrics_index][1]
+        stats["calls"] += 1
+        stats["bytes_sent"] += nbytes
+        kernel = args[0] if method in JOB_METHODS else None
+        stats["pending"][token] = (method, kernel, time.time())
+        stats["max_queue"] = max(stats["max_queue"], len(stats["pending"]))
+
+    def received(self, w, token, result, error, nbytes):
+        now = time.time()
+        stats = self.workers[w.metrics_index][1]
+        stats["bytes_received"] += nbytes
+        if token not in stats["pending"]: return
+        method, kernel, t = stats["pending"].pop(token)
+        # Log2 buckets, from 1us up.
+        bucket = min(max(int(math.log2(max(now - t, 1e-9)/1e-6)) + 1, 0), 40)
+        hist = stats["latency"].setdefault(method, [0]*41)
+        hist[bucket] += 1
+        if kernel is None or error is not None: return
+        value, di, dt = result
+        stats["busy"] += dt
+        stats["jobs"] += 1
+        name = self.kernel_names.get(kernel, f"kernel {kernel}")
+        kstats = self.kernels.setdefault(name, {"jobs": 0, "points": 0, "seconds": 0.0})
+        kstats["jobs"] += 1
+        kstats["points"] += di
+        kstats["seconds"] += dt
+        if self.trace is not None:
+            # The job ended at about the time of the reply.
+            self.trace.append({
+                "name": name, "cat": method, "ph": "X", "pid": 1, "tid": w.metrics_index,
+                "ts": (now - dt - self.t0)*1e6, "dur": dt*1e6,
+                "args": {"points": di, "waited": max(now - t - dt, 0.0)}
+            })
+            self.trace.append({
+                "name": "queue", "ph": "C", "pid": 1, "ts": (now - self.t0)*1e6,
+                "args": {w.name: len(stats["pending"])}
+            })
+
+    def exited(self, w):
+        stats = self.workers[w.metrics_index][1]
+        stats["exited"] = time.time()
+        stats["pending"].clear()
+
+    def snapshot(self):
+        now = time.time()
+        workers = {}
+        tbusy = twall = 0
+        for w, stats in self.workers:
+            wall = (stats["exited"] or now) - stats["started"]
+            tbusy += stats["busy"]
+            twall += wall
+            workers[w.name] = {
+                "alive": stats["exited"] is None,
+                "wall": wall,
+                "busy": stats["busy"],
+                "idle": max(wall - stats["busy"], 0.0),
+                "useful_fraction": stats["busy"]/wall if wall > 0 else 0.0,
+                "jobs": stats["jobs"],
+                "calls": stats["calls"],
+                "queue": len(stats["pending"]),
+                "max_queue": stats["max_queue"],
+                "bytes_sent": stats["bytes_sent"],
+                "bytes_received": stats["bytes_received"],
+                "latency": {
+                    method: [[1e-6*2**(b - 1) if b > 0 else 0.0, 1e-6*2**b, n] for b, n in enumerate(hist) if n > 0]
+                    for method, hist in stats["latency"].items()
+                }
+            }
+        kernels = {
+            name: dict(kstats, points_per_second=kstats["points"]/kstats["seconds"] if kstats["seconds"] > 0 else 0.0)
+            for name, kstats in self.kernels.items()
+        }
+        return {
+            "time": now - self.t0,
+            "useful_fraction": tbusy/twall if twall > 0 else 0.0,
+            "workers": workers,
+            "kernels": kernels,
+            "queue_history": self.history
+        }
+
+    def sample_queues(self):
+        self.history.append((time.time() - self.t0, [len(stats["pending"]) for w, stats in self.workers]))
+        del self.history[:-1000]
+
+    async def write_snapshots(self, filename, interval):
+        """
+        Keep writing the snapshot into a JSON file every interval
+        seconds, sampling the queue depths in between.
+        """
+        n = 10
+        while True:
+            for i in range(n):
+                await asyncio.sleep(interval/n)
+                self.sample_queues()
+            self.save_snapshot(filename)
+
+    def save_snapshot(self, filename):
+        try:
+            save_json(filename, self.snapshot())
+        except OSError as e:
+            log(f"Can't save the metrics to {filename}: {e}")
+
+    def save_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.trace, "displayTimeUnit": "ms"}, f)
+
+class DaemonConnection:
+    """
+    A connection to a worker daemon (see pySecDec.disteval_daemon),
+    standing in for a worker process.
+    """
+
+    def __init__(self, reader, writer):
+        self.stdout = reader
+        self.stdin = writer
 
-async def launch_worker(command, dirname, maxtimeout=10):
+    def kill(self):
+        self.stdin.close()
+
+    async def wait(self):
+        self.stdin.close()
+        await self.stdin.wait_closed()
+
+async def connect_daemon(address):
+    if address.startswith("unix:"):
+        reader, writer = await asyncio.open_unix_connection(address[5:])
+    else:
+        host, port = address.rsplit(":", 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+    return DaemonConnection(reader, writer)
+
+async def launch_worker(command, dirname, maxtimeout=10, protocol="binary", attempts=math.inf):
+    """
+    Start a worker with the given command (a string for the
+    shell, or a list of arguments), or connect to a worker daemon
+    if the command is {"connect": "host:port" or "unix:path"}.
+    The failed starts are retried with an increasing delay; after
+    this many attempts, a WorkerException is raised.
+    """
     timeout = min(1, maxtimeout/10)
+    # How many times in a row the worker quit at the protocol
+    # negotiation.
+    nquit = 0
     while True:
-        log(f"running: {command}")
-        if isinstance(command, str):
-            p = await asyncio.create_subprocess_shell(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            if isinstance(command, dict):
+                log(f"connecting to: {command['connect']}")
+                p = await connect_daemon(command["connect"])
+            elif isinstance(command, str):
+                log(f"running: {command}")
+                p = await asyncio.create_subprocess_shell(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            else:
+                log(f"running: {command}")
+                p = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as e:
+            log(f"failed to start worker: {type(e).__name__}: {e}")
+            attempts -= 1
+            if attempts <= 0:
+                raise WorkerException(f"failed to start {command}: {type(e).__name__}: {e}")
+            log(f"will retry after {timeout}s")
+            await asyncio.sleep(timeout)
+            timeout = min(timeout*2, maxtimeout)
+            continue
+        negotiate = repr(command) not in json_only_commands and nquit < 2
+        if negotiate:
+            p.stdin.write(encode_message((0, "start", (dirname, [protocol]))))
         else:
-            p = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        p.stdin.write(encode_message((0, "start", (dirname,))))
+            p.stdin.write(encode_message((0, "start", (dirname,))))
         answer = await p.stdout.readline()
         try:
+            if negotiate and len(answer) == 0:
+                # Older workers exit on unknown start arguments,
+                # but so does a worker that failed for any other
+                # reason: only the one that quits twice, and then
+                # starts without the negotiation, is taken for old.
+                nquit += 1
+                log(f"worker quit at the protocol negotiation, will retry {'without it' if nquit >= 2 else 'once more'}")
+                await p.wait()
+                continue
             _, name, err = decode_message(answer)
             if err is not None:
                 log(f"worker startup fail: {err}")
             else:
-                w = Worker(p, name=name)
-                log(f"worker {w.name} connected")
+                wproto = "json"
+                features = ()
+                if negotiate:
+                    name, wproto, features = name
+                w = Worker(p, name=name, protocol=wproto, features=features, command=command)
+                if nquit >= 2:
+                    log(f"worker does not support protocol negotiation, will use JSON")
+                    json_only_commands.add(repr(command))
+                log(f"worker {w.name} connected using the {wproto} protocol")
                 return w
         except Exception as e:
             log(f"failed to start worker: {type(e).__name__}: {e}")
+        nquit = 0
         try:
             p.stdin.close()
             p.kill()
         except ProcessLookupError:
             pass
+        attempts -= 1
+        if attempts <= 0:
+            raise WorkerException(f"failed to start {command}")
         log(f"will retry after {timeout}s")
         await asyncio.sleep(timeout)
         timeout = min(timeout*2, maxtimeout)
 
 # Generic scheduling
 
+def worker_kind(w):
+    return "gpu" if "gpu" in w.features else "cpu"
+
+def job_kind(job, gpu_lattice):
+    """
+    Return the kind of the workers that should get this job:
+    "cpu" for lattices smaller than gpu_lattice, "gpu" for the
+    rest, or None if any worker will do.
+    """
+    if gpu_lattice is None or job.method not in JOB_METHODS:
+        return None
+    return "gpu" if job.args[1] >= gpu_lattice else "cpu"
+
+# The worker features needed by the job methods: a worker that
+# joined without one doesn't get these jobs.
+METHOD_FEATURES = {"integrate_shifts": "integrate_shifts"}
+
+def can_take(w, job, gpu_lattice, kinds):
+    # If there are no workers of the right kind, the others
+    # take the job.
+    feature = METHOD_FEATURES.get(job.method)
+    if feature is not None and feature not in w.features:
+        return False
+    kind = job_kind(job, gpu_lattice)
+    return kind is None or kind not in kinds or worker_kind(w) == kind
+
 class RandomScheduler:
-    def __init__(self):
+    def __init__(self, gpu_lattice=None):
+        self.gpu_lattice = gpu_lattice
         self.workers = []
         self.wspeed = []
         self.npending = 0
         self.drained = asyncio.Event()
         self.drained.set()
+        self.orphans = [] # jobs waiting for a worker to appear
+        self.family_params = {} # family id -> (realp, complexp)
+        self.family_version = 0
+        self.failures = [] # names of the workers that died
+        self.retried = [] # (worker name, method, args) of the retried jobs
+        self.on_worker_exit = None
 
     def add_worker(self, worker):
         self.workers.append(worker)
         self.wspeed.append(worker.speed)
+        worker.on_exit = self._worker_exited
+        orphans, self.orphans = self.orphans, []
+        for job in orphans:
+            self._send(job)
+
+    def _worker_exited(self, worker):
+        if worker not in self.workers: return
+        self._remove(worker)
+        worker_exited(self, worker)
+
+    def _remove(self, worker):
+        i = self.workers.index(worker)
+        del self.workers[i]
+        del self.wspeed[i]
+
+    def retire_worker(self, worker):
+        """
+        Send no more jobs to this worker; the jobs it already has
+        still report back here (and are re-sent if it dies).
+        """
+        if worker in self.workers:
+            self._remove(worker)
 
     def queue_size(self):
         return sum(w.queue_size() for w in self.workers)
 
     def call(self, method, *args):
-        w = min(random.choices(self.workers, weights=self.wspeed, k=3),
-                key=lambda w: w.queue_size())#/w.speed)
-        return w.call(method, *args)
+        fut = asyncio.futures.Future()
+        def call_return(result, error, w):
+            if error is None: fut.set_result(result)
+            else: fut.set_exception(WorkerException(error))
+        self.call_cb(method, args, call_return, ())
+        return fut
 
-    def call_cb(self, method, args, callback, callback_args):
-        w = min(random.choices(self.workers, weights=self.wspeed, k=3),
+    def call_cb(self, method, args, callback, callback_args, cost=None):
+        job = CostJob(method, args, callback, callback_args, cost or 0)
+        self.npending += 1
+        self._send(job)
+        return job
+
+    def _send(self, job):
+        if len(self.workers) == 0:
+            self.orphans.append(job)
+            return
+        workers, wspeed = self.workers, self.wspeed
+        if job_kind(job, self.gpu_lattice) is not None or job.method in METHOD_FEATURES:
+            kinds = set(worker_kind(w) for w in self.workers)
+            choices = [
+                (w, s) for w, s in zip(self.workers, self.wspeed)
+                if can_take(w, job, self.gpu_lattice, kinds)
+            ]
+            if not choices:
+                self.orphans.append(job)
+                return
+            workers, wspeed = zip(*choices)
+        w = min(random.choices(workers, weights=wspeed, k=3),
                 key=lambda w: w.queue_size())#/w.speed)
+        job.token = (w, w.call_cb(job.method, job.args, self._cb, (job,)))
+
+    def _cb(self, result, exception, worker, job):
+        if exception is WORKER_DIED:
+            self.retried.append((worker.name, job.method, job.args))
+            self._send(job)
+            return
+        self._finish(job)
+        return job.callback(result, exception, worker, *job.callback_args)
+
+    def _finish(self, job):
+        job.done = True
+        self.npending -= 1
+        if self.npending == 0:
+            self.drained.set()
+
+    def cancel_cb(self, job):
+        if job.done:
+            return False
+        if job in self.orphans:
+            self.orphans.remove(job)
+        else:
+            w, t = job.token
+            w.cancel_cb(t)
+        self._finish(job)
+        return True
+
+    async def drain(self):
+        if self.npending > 0:
+            self.drained.clear()
+            await self.drained.wait()
+
+class CostJob:
+    def __init__(self, method, args, callback, callback_args, cost):
+        self.method = method
+        self.args = args
+        self.callback = callback
+        self.callback_args = callback_args
+        self.cost = cost
+        self.copies = 0
+        self.done = False
+        self.token = None
+
+class CostScheduler:
+    """
+    A scheduler that keeps the jobs in its own queue, and sends
+    them out longest-first to the worker that is expected to
+    finish them the earliest. The expected duration of a job
+    with a given cost (measured in "bubbles", the same units as
+    the worker speed) is w.overhead + cost/w.speed.
+
+    Each worker only gets enough jobs to hide the round-trip
+    latency; the rest wait here, so that the placement can be
+    reconsidered as the workers finish. When the queue is empty
+    and a worker goes idle, it duplicates the latest-finishing
+    job of a slower worker if it can finish it earlier; the
+    first copy to finish wins.
+
+    If a worker dies, its unfinished jobs go back to the queue.
+
+    In a pool of both CPU and GPU workers, gpu_lattice, if set,
+    sends the lattices smaller than this many points only to the
+    CPU workers, and the rest only to the GPU ones; otherwise
+    the jobs are placed by the expected durations alone.
+    """
+
+    # How many of the longest jobs to consider for each worker.
+    lookahead = 32
+
+    def __init__(self, gpu_lattice=None):
+        self.gpu_lattice = gpu_lattice
+        self.workers = []
+        self.inflight = {} # worker -> [(job, expected duration)]
+        self.backlog = {} # worker -> total expected duration
+        self.started = {} # worker -> when the first job started
+        self.pending = [] # [(cost, serial, job)], sorted
+        self.serial = 0
+        self.npending = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.family_params = {} # family id -> (realp, complexp)
+        self.family_version = 0
+        self.failures = [] # names of the workers that died
+        self.retried = [] # (worker name, method, args) of the retried jobs
+        self.on_worker_exit = None
+
+    def add_worker(self, worker):
+        self.workers.append(worker)
+        self.inflight[worker] = []
+        self.backlog[worker] = 0.0
+        self.started[worker] = time.time()
+        worker.on_exit = self._worker_exited
+        self._dispatch()
+
+    def _worker_exited(self, worker):
+        if worker not in self.inflight: return
+        retired = worker not in self.workers
+        if not retired:
+            self.workers.remove(worker)
+        del self.inflight[worker]
+        del self.backlog[worker]
+        del self.started[worker]
+        if not retired:
+            worker_exited(self, worker)
+
+    def retire_worker(self, worker):
+        """
+        Send no more jobs to this worker; the jobs it already has
+        still report back here (and are queued again if it dies).
+        """
+        if worker in self.workers:
+            self.workers.remove(worker)
+
+    def queue_size(self):
+        return self.npending
+
+    def duration(self, w, cost):
+        return w.overhead + (cost or 0)/w.speed
+
+    def call(self, method, *args, cost=None):
+        fut = asyncio.futures.Future()
+        def call_return(result, error, w):
+            if error is None: fut.set_result(result)
+            else: fut.set_exception(WorkerException(error))
+        self.call_cb(method, args, call_return, (), cost=cost)
+        return fut
+
+    def call_cb(self, method, args, callback, callback_args, cost=None):
+        job = CostJob(method, args, callback, callback_args, cost or 0)
+        self._enqueue(job)
         self.npending += 1
-        return (w, w.call_cb(method, args, self._cb, (callback, callback_args)))
+        self._dispatch()
+        return job
+
+    def _enqueue(self, job):
+        self.serial += 1
+        bisect.insort(self.pending, (job.cost, self.serial, job))
+
+    def cancel_cb(self, job):
+        # The workers can't abort a job, so the copies that were
+        # already sent will finish, and their results will be
+        # ignored.
+        if job.done:
+            return False
+        self._finish(job)
+        return True
 
-    def _cb(self, result, exception, worker, callback, callback_args):
+    def _finish(self, job):
+        job.done = True
+        self.npending -= 1
+        if self.npending == 0:
+            self.drained.set()
+
+    def _accepts(self, w):
+        # Keep enough work queued at each worker to hide the
+        # latency, but no more.
+        return len(self.inflight[w]) == 0 or self.backlog[w] < 2*(w.latency + w.overhead)
+
+    def _finish_time(self, w, cost):
+        return self.backlog[w] + self.duration(w, cost)
+
+    def _pick_job(self, w, kinds):
+        # The longest job, unless some other worker would finish
+        # it earlier even with its current backlog; in that case
+        # try the next longest one. If none fit, the shortest job.
+        # Only the jobs routed to this kind of worker count.
+        for k in range(len(self.pending) - 1, max(-1, len(self.pending) - 1 - self.lookahead), -1):
+            cost, _, job = self.pending[k]
+            if not can_take(w, job, self.gpu_lattice, kinds): continue
+            t = self._finish_time(w, cost)
+            if all(t <= self._finish_time(w2, cost) for w2 in self.workers if w2 is not w and can_take(w2, job, self.gpu_lattice, kinds)):
+                return self.pending.pop(k)[2]
+        for k, (cost, _, job) in enumerate(self.pending):
+            if can_take(w, job, self.gpu_lattice, kinds):
+                return self.pending.pop(k)[2]
+        return None
+
+    def _send(self, w, job):
+        d = self.duration(w, job.cost)
+        if len(self.inflight[w]) == 0:
+            self.started[w] = time.time()
+        self.inflight[w].append((job, d))
+        self.backlog[w] += d
+        job.copies += 1
+        w.call_cb(job.method, job.args, self._cb, (job, d))
+
+    def _dispatch(self):
+        if len(self.workers) == 0: return
+        kinds = set(worker_kind(w) for w in self.workers) if self.gpu_lattice is not None else set()
+        # The workers that have nothing to do in the queue.
+        skip = set()
+        while self.pending:
+            cost, _, job = self.pending[-1]
+            if job.done:
+                self.pending.pop()
+                continue
+            free = [w for w in self.workers if w not in skip and self._accepts(w)]
+            if not free: break
+            w = min(free, key=lambda w: self.backlog[w])
+            job = self._pick_job(w, kinds)
+            if job is None:
+                skip.add(w)
+                continue
+            if job.done: continue
+            self._send(w, job)
+        for w in self.workers:
+            if len(self.inflight[w]) == 0 and (not self.pending or w in skip):
+                self._steal(w, kinds)
+
+    def _steal(self, w, kinds):
+        now = time.time()
+        best = None
+        for w2 in self.workers:
+            if w2 is w: continue
+            t = self.started[w2] - now
+            for job, d in self.inflight[w2]:
+                t += d
+                if job.done or job.copies > 1: continue
+                if not can_take(w, job, self.gpu_lattice, kinds): continue
+                if self.duration(w, job.cost) < t and (best is None or t > best[0]):
+                    best = (t, job)
+        if best is not None:
+            self._send(w, best[1])
+
+    def _cb(self, result, exception, worker, job, d):
+        if worker in self.inflight:
+            self.inflight[worker].remove((job, d))
+            self.backlog[worker] = max(0.0, self.backlog[worker] - d)
+            self.started[worker] = time.time()
+        if exception is WORKER_DIED:
+            job.copies -= 1
+            if not job.done and job.copies == 0:
+                self.retried.append((worker.name, job.method, job.args))
+                self._enqueue(job)
+        elif not job.done:
+            self._finish(job)
+            job.callback(result, exception, worker, *job.callback_args)
+        self._dispatch()
+
+    async def drain(self):
+        if self.npending > 0:
+            self.drained.clear()
+            await self.drained.wait()
+
+def worker_exited(par, worker):
+    par.failures.append(worker.name)
+    log(f"worker {worker.name} died; {len(par.workers)} workers left")
+    if par.on_worker_exit is not None:
+        par.on_worker_exit(worker)
+
+schedulers = {
+    "random": RandomScheduler,
+    "cost": CostScheduler
+}
+
+class JobGroup:
+    """
+    A view of a scheduler that keeps track of its own pending
+    jobs, so that several evaluations can share one scheduler,
+    and each can wait for its own jobs only.
+    """
+
+    def __init__(self, par):
+        self.par = par
+        self.workers = par.workers
+        self.npending = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def queue_size(self):
+        return self.par.queue_size()
+
+    def call(self, method, *args):
+        return self.par.call(method, *args)
+
+    def call_cb(self, method, args, callback, callback_args, cost=None):
+        self.npending += 1
+        return self.par.call_cb(method, args, self._cb, (callback, callback_args), cost=cost)
+
+    def _finish(self):
         self.npending -= 1
         if self.npending == 0:
             self.drained.set()
-        return callback(result, exception, worker, *callback_args)
+
+    def _cb(self, result, exception, worker, callback, callback_args):
+        # The callback may schedule more jobs (e.g. on NaN), so
+        # only count this one as finished afterwards.
+        try:
+            return callback(result, exception, worker, *callback_args)
+        finally:
+            self._finish()
 
     def cancel_cb(self, token):
-        w, t = token
-        if w.cancel_cb(t):
-            self.npending -= 1
-            if self.npending == 0:
-                self.drained.set()
+        if self.par.cancel_cb(token):
+            self._finish()
             return True
-        else:
-            return False
+        return False
 
     async def drain(self):
-        assert self.npending <= sum(len(w.callbacks) for w in self.workers)
         if self.npending > 0:
             self.drained.clear()
             await self.drained.wait()
 
+class WorkerPool:
+    """
+    Keeps the running workers matching a list of worker commands,
+    which may change during a run. The missing workers are started
+    with the launch coroutine (which sets them up and adds them
+    to the scheduler); the extra ones are retired: they get no new
+    jobs, and are stopped once the jobs they have are done. The
+    workers that die are relaunched (if relaunch is set) as long
+    as they are still wanted.
+    """
+
+    def __init__(self, sched, launch, relaunch=True):
+        self.sched = sched
+        self.launch = launch
+        self.relaunch = relaunch
+        self.on_launch = None
+        self.wanted = {} # command key -> (command, count)
+        self.running = {} # command key -> [worker]
+        self.starting = {} # command key -> launches in progress
+        self.retiring = set()
+        self.relaunches = {} # command key -> relaunch count
+        self.watch_task = None
+        self.closed = False
+        sched.on_worker_exit = self._worker_died
+
+    @staticmethod
+    def key(command):
+        return json.dumps(command, sort_keys=True)
+
+    def count(self, key):
+        return self.starting.get(key, 0) + len(self.running.get(key, []))
+
+    def nwanted(self, key):
+        return self.wanted[key][1] if key in self.wanted else 0
+
+    def set_commands(self, commands, retry=True):
+        """
+        Start the workers missing from the given list of commands,
+        and retire the ones not in it any more. Return the list
+        of the launch tasks; if retry is set, the failed launches
+        are logged and retried, otherwise the tasks fail.
+        """
+        wanted = {}
+        for cmd in commands:
+            k = self.key(cmd)
+            wanted[k] = (cmd, wanted[k][1] + 1 if k in wanted else 1)
+        self.wanted = wanted
+        tasks = []
+        for k, (cmd, n) in wanted.items():
+            tasks.extend(asyncio.ensure_future(self._launch(cmd, retry=retry)) for i in range(n - self.count(k)))
+        for k, ws in list(self.running.items()):
+            # The least busy ones go first.
+            excess = self.count(k) - self.nwanted(k)
+            for w in sorted(ws, key=lambda w: w.queue_size())[:max(0, excess)]:
+                self.retire(w)
+        return tasks
+
+    async def _start(self, cmd, delay=0):
+        k = self.key(cmd)
+        self.starting[k] = self.starting.get(k, 0) + 1
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # The command may have been removed in the meantime.
+            if self.closed or self.count(k) > self.nwanted(k):
+                return None
+            w = await self.launch(cmd)
+        finally:
+            self.starting[k] -= 1
+        self.running.setdefault(k, []).append(w)
+        if self.closed or self.count(k) > self.nwanted(k):
+            self.retire(w)
+        elif not w.alive:
+            self._worker_died(w)
+        elif self.on_launch is not None:
+            self.on_launch(w)
+        return w
+
+    async def _launch(self, cmd, delay=0, retry=True):
+        try:
+            return await self._start(cmd, delay)
+        except Exception as e:
+            if not retry: raise
+            log(f"failed to launch {cmd}: {type(e).__name__}: {e}")
+            self._relaunch(cmd)
+
+    def _relaunch(self, cmd):
+        # Back off exponentially if the same command keeps failing.
+        k = self.key(cmd)
+        n = self.relaunches[k] = self.relaunches.get(k, 0) + 1
+        delay = min(2**(n - 1), 60)
+        log(f"will relaunch {cmd} after {delay}s")
+        asyncio.ensure_future(self._launch(cmd, delay))
+
+    def _worker_died(self, w):
+        k = self.key(w.command)
+        if w not in self.running.get(k, []): return
+        self.running[k].remove(w)
+        if self.relaunch and not self.closed and self.count(k) < self.nwanted(k):
+            self._relaunch(w.command)
+
+    def retire(self, w):
+        """
+        Send no more jobs to this worker, and stop it as soon as
+        the jobs it has are done.
+        """
+        self.running[self.key(w.command)].remove(w)
+        self.retiring.add(w)
+        self.sched.retire_worker(w)
+        asyncio.ensure_future(self._drain(w))
+
+    async def _drain(self, w):
+        log(f"retiring {w.name}, {w.queue_size()} jobs to go")
+        while w.alive and w.queue_size() > 0:
+            await asyncio.sleep(0.1)
+        if w.heartbeat_task is not None:
+            w.heartbeat_task.cancel()
+        try:
+            w.process.kill()
+        except ProcessLookupError:
+            pass
+        self.retiring.discard(w)
+        log(f"retired {w.name}; {len(self.sched.workers)} workers left")
+
+    async def watch(self, jsonfile, interval):
+        """
+        Check the cluster file every interval seconds, and follow
+        the changes of the worker list in it.
+        """
+        try:
+            mtime = os.stat(jsonfile).st_mtime_ns
+        except OSError:
+            mtime = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if os.stat(jsonfile).st_mtime_ns == mtime: continue
+                mtime = os.stat(jsonfile).st_mtime_ns
+                commands = read_cluster_file(jsonfile)
+            except (OSError, ValueError) as e:
+                log(f"can't read {jsonfile}: {type(e).__name__}: {e}")
+                continue
+            log(f"{jsonfile} changed, now asking for {len(commands)} workers")
+            self.set_commands(commands)
+
+    def start_watching(self, jsonfile, interval):
+        self.watch_task = asyncio.ensure_future(self.watch(jsonfile, interval))
+
+    def close(self):
+        """
+        Stop following the changes, and launching the workers.
+        """
+        self.closed = True
+        self.sched.on_worker_exit = None
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+
+# Coefficient workers
+
+class CoefficientService:
+    """
+    The workers that expand the amplitude coefficients with
+    GiNaC (the "evalf" command), kept apart from the integration
+    workers so that those don't need to load GiNaC at all. They
+    are only launched on the first call, because the compiled
+    coefficients (see pySecDec.disteval_coefficients) need none.
+    """
+
+    def __init__(self, commands, datadir, relaunch=True, attempts=3):
+        self.commands = commands
+        self.datadir = datadir
+        self.attempts = attempts
+        self.sched = RandomScheduler()
+        self.pool = WorkerPool(self.sched, self._launch, relaunch=relaunch)
+        self.started = False
+
+    async def _launch(self, cmd):
+        w = await launch_worker(cmd, self.datadir, protocol="json", attempts=self.attempts)
+        # These are not benchmarked: all get an equal share.
+        w.speed = 1.0
+        self.sched.add_worker(w)
+        return w
+
+    async def _start(self):
+        # The first launch is not retried: if none of the workers
+        # start, fail the calls waiting for them (and try again at
+        # the next call); otherwise leave the missing ones to the
+        # pool to retry.
+        log(f"launching {len(self.commands)} coefficient workers")
+        results = await asyncio.gather(*self.pool.set_commands(self.commands, retry=False), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        for e in errors:
+            log(f"failed to launch a coefficient worker: {type(e).__name__}: {e}")
+        if self.sched.workers:
+            if errors:
+                self.pool.set_commands(self.commands)
+            return
+        self.started = False
+        error = f"could not launch any coefficient workers: {errors[0]}" if errors else "no coefficient workers"
+        orphans, self.sched.orphans = self.sched.orphans, []
+        for job in orphans:
+            self.sched._finish(job)
+            job.callback(None, error, None, *job.callback_args)
+
+    def call_cb(self, method, args, callback, callback_args):
+        job = self.sched.call_cb(method, args, callback, callback_args)
+        if not self.started:
+            self.started = True
+            asyncio.ensure_future(self._start())
+        return job
+
+    def workers(self):
+        return list(self.sched.workers) + list(self.pool.retiring)
+
+# Result cache
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    An on-disk cache of the integration results: for each kernel,
+    lattice, generating vector and deformation parameters it keeps
+    the values at each evaluated shift, along with the evaluation
+    statistics (bubbles, points, and seconds spent).
+
+    A kernel is identified by a key made of the family and kernel
+    names, the hash of the family library, and the values of the
+    real and complex parameters, so that the results are never
+    reused after the integral is rebuilt or the point changes.
+
+    The cache is bounded to at most maxsize shift values; the
+    lattices that were used the least recently are evicted first.
+    """
+
+    def __init__(self, dirname, maxsize=10**6):
+        os.makedirs(dirname, exist_ok=True)
+        self.maxsize = maxsize
+        self.db = sqlite3.connect(os.path.join(dirname, "results.sqlite"))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS lattices (
+                id INTEGER PRIMARY KEY,
+                kernel TEXT NOT NULL,
+                lattice INTEGER NOT NULL,
+                genvec TEXT NOT NULL,
+                deformp TEXT NOT NULL,
+                db REAL NOT NULL DEFAULT 0,
+                di REAL NOT NULL DEFAULT 0,
+                dt REAL NOT NULL DEFAULT 0,
+                atime REAL NOT NULL,
+                UNIQUE (kernel, lattice, genvec, deformp)
+            );
+            CREATE TABLE IF NOT EXISTS shifts (
+                lattice_id INTEGER NOT NULL,
+                shift TEXT NOT NULL,
+                re REAL NOT NULL,
+                im REAL NOT NULL,
+                PRIMARY KEY (lattice_id, shift)
+            );
+            CREATE TABLE IF NOT EXISTS median_genvecs (
+                integrand TEXT NOT NULL,
+                lattice INTEGER NOT NULL,
+                genvec TEXT NOT NULL,
+                PRIMARY KEY (integrand, lattice)
+            );
+            CREATE INDEX IF NOT EXISTS lattices_by_kernel ON lattices (kernel, lattice);
+            CREATE INDEX IF NOT EXISTS lattices_by_atime ON lattices (atime);
+        """)
+        self.size = self.db.execute("SELECT COUNT(*) FROM shifts").fetchone()[0]
+
+    @staticmethod
+    def kernel_key(family, kernel, libhash, realp, complexp):
+        return hashlib.sha256(json.dumps(
+            [family, kernel, libhash, [float(x) for x in realp], [[float(re), float(im)] for re, im in complexp]]
+        ).encode("ascii")).hexdigest()
+
+    @staticmethod
+    def integrand_key(family, kernel, libhash):
+        # Unlike kernel_key(), this doesn't depend on the point.
+        return hashlib.sha256(json.dumps([family, kernel, libhash]).encode("ascii")).hexdigest()
+
+    def median_genvec(self, integrand, lattice):
+        """
+        Return the generating vector previously chosen by the
+        median QMC rule for the given integrand and lattice size,
+        or None.
+        """
+        row = self.db.execute(
+            "SELECT genvec FROM median_genvecs WHERE integrand=? AND lattice=?", (integrand, int(lattice))
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def store_median_genvec(self, integrand, lattice, genvec):
+        self.db.execute(
+            "INSERT OR REPLACE INTO median_genvecs (integrand, lattice, genvec) VALUES (?,?,?)",
+            (integrand, int(lattice), json.dumps([int(x) for x in genvec])))
+
+    def _lattice_id(self, kernel, lattice, genvec, deformp, create=False):
+        key = (kernel, int(lattice), json.dumps([int(x) for x in genvec]), json.dumps([float(x) for x in deformp]))
+        row = self.db.execute(
+            "SELECT id FROM lattices WHERE kernel=? AND lattice=? AND genvec=? AND deformp=?", key
+        ).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE lattices SET atime=? WHERE id=?", (time.time(), row[0]))
+            return row[0]
+        if not create:
+            return None
+        return self.db.execute(
+            "INSERT INTO lattices (kernel, lattice, genvec, deformp, atime) VALUES (?,?,?,?,?)", key + (time.time(),)
+        ).lastrowid
+
+    def lookup(self, kernel, lattice, genvec, deformp, nshifts):
+        """
+        Return a list of at most nshifts known values of the given
+        kernel lattice (each at a different shift), and the stored
+        (bubbles, points, seconds) statistics of the lattice.
+        """
+        shifts, values, stats = self.lookup_shifts(kernel, lattice, genvec, deformp, nshifts)
+        return values, stats
+
+    def lookup_shifts(self, kernel, lattice, genvec, deformp, nshifts):
+        """
+        Same as lookup(), but also return the shifts of the
+        values, as (shifts, values, stats).
+        """
+        lid = self._lattice_id(kernel, lattice, genvec, deformp)
+        if lid is None:
+            return [], [], (0.0, 0.0, 0.0)
+        rows = self.db.execute("SELECT shift, re, im FROM shifts WHERE lattice_id=? ORDER BY rowid LIMIT ?", (lid, nshifts)).fetchall()
+        shifts = [json.loads(shift) for shift, re, im in rows]
+        values = [complex(re, im) for shift, re, im in rows]
+        stats = self.db.execute("SELECT db, di, dt FROM lattices WHERE id=?", (lid,)).fetchone()
+        return shifts, values, tuple(stats)
+
+    def largest(self, kernel, nshifts):
+        """
+        Return (lattice, genvec, deformp) of the largest lattice of
+        the given kernel with at least nshifts known values, or None.
+        """
+        row = self.db.execute(
+            "SELECT lattice, genvec, deformp FROM lattices WHERE kernel=? AND "
+            "(SELECT COUNT(*) FROM shifts WHERE lattice_id=lattices.id) >= ? "
+            "ORDER BY lattice DESC LIMIT 1", (kernel, nshifts)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), tuple(json.loads(row[2]))
+
+    def store(self, kernel, lattice, genvec, deformp, shifts, values, db=0.0, di=0.0, dt=0.0):
+        """
+        Remember the values of the given kernel lattice at the
+        given shifts, and add (db, di, dt) to its statistics.
+        """
+        lid = self._lattice_id(kernel, lattice, genvec, deformp, create=True)
+        count = lambda: self.db.execute("SELECT COUNT(*) FROM shifts WHERE lattice_id=?", (lid,)).fetchone()[0]
+        n0 = count()
+        # The values at the already known shifts are replaced,
+        # and don't add to the size.
+        self.db.executemany(
+            "INSERT OR REPLACE INTO shifts (lattice_id, shift, re, im) VALUES (?,?,?,?)",
+            [(lid, json.dumps([float(x) for x in s]), v.real, v.imag) for s, v in zip(shifts, values)])
+        self.size += count() - n0
+        self.db.execute("UPDATE lattices SET db=db+?, di=di+?, dt=dt+? WHERE id=?", (db, di, dt, lid))
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used lattices until the cache
+        # is within 90% of its size limit.
+        self.size = self.db.execute("SELECT COUNT(*) FROM shifts").fetchone()[0]
+        for lid, n in self.db.execute(
+                "SELECT id, (SELECT COUNT(*) FROM shifts WHERE lattice_id=lattices.id) FROM lattices ORDER BY atime"
+            ).fetchall():
+            if self.size <= self.maxsize*0.9:
+                break
+            self.db.execute("DELETE FROM shifts WHERE lattice_id=?", (lid,))
+            self.db.execute("DELETE FROM lattices WHERE id=?", (lid,))
+            self.size -= n
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
 # Main
 
-async def benchmark_worker(w):
-    lattice, genvec = generating_vector(2, 10**3)
-    shift = ([0.3, 0.8])
-    deformp = ([1.0, 1.0])
+async def measure_latency(w):
     # Measure round-trip latency.
     latency = []
     await w.call("ping")
@@ -232,7 +1426,21 @@ async def benchmark_worker(w):
         t0 = time.time()
         await w.call("ping")
         latency.append(time.time() -  t0)
-    w.latency = latency = np.mean(latency)
+    w.latency = np.mean(latency)
+
+async def benchmark_worker(w, generic_kernel=None):
+    """
+    Measure the worker latency, overheads, and speed using the
+    builtin kernel 0. If generic_kernel is given, it should be the
+    same kernel loaded from the generic (not instruction set
+    specific) library; its speed relative to kernel 0 is then
+    recorded as the worker's isa_speedup.
+    """
+    lattice, genvec = generating_vector(2, 10**3)
+    shift = ([0.3, 0.8])
+    deformp = ([1.0, 1.0])
+    await measure_latency(w)
+    latency = w.latency
     # Calculate worker's total per-message overhead by how many
     # empty jobs can it do per second.
     t0 = time.time()
@@ -254,20 +1462,174 @@ async def benchmark_worker(w):
         if dt > dt0*1000:
             break
     w.speed = dn/(dt - dt0)
+    w.isa_speedup = 1.0
+    if generic_kernel is not None:
+        v, dn, dt = await w.call("integrate", generic_kernel,
+                lattice, 0, lattice, genvec, shift, deformp)
+        w.isa_speedup = w.speed*(dt - dt0)/dn
 
-def bracket_mul(br1, br2, maxorders):
+async def check_calibration(w, profile, tolerance=1.5):
     """
-    Multiply two multivariate polynomials represented in the form
-    of {exponent: coefficient} dictionaries; skip any terms with
-    the combined exponent higher than the specified maximum.
+    Check that a cached calibration profile still describes the
+    worker: measure the latency anew, and time a single job that
+    should take 1ms or 100 integration overheads, whichever is
+    longer. If the time is
+    within the tolerance factor of the prediction, use the profile
+    and return True; otherwise return False. The profile is also
+    outdated if the worker now loads a different instruction set
+    variant of the kernels.
     """
-    br = {}
-    for k1, v1 in br1.items():
-        for k2, v2 in br2.items():
-            key = tuple(x + y for x, y in zip(k1, k2))
-            if all(x <= y for x, y in zip(key, maxorders)):
-                br[key] = br.get(key, 0) + v1*v2
-    return br
+    if profile.get("isa") != w.isa:
+        log(f"{w.name}: calibration is outdated, the kernels are now for {w.isa} instead of {profile.get('isa')}")
+        return False
+    await measure_latency(w)
+    lattice, genvec = generating_vector(2, 10**7)
+    n = int(min(max(100*profile["int_overhead"], 1e-3)*profile["speed"], lattice))
+    v, dn, dt = await w.call("integrate", 0, lattice, 0, n, genvec, [0.3, 0.8], [1.0, 1.0])
+    expected = profile["int_overhead"] + dn/profile["speed"]
+    if not (expected/tolerance < dt < expected*tolerance):
+        log(f"{w.name}: calibration is outdated, a test job took {dt:.2e}s instead of {expected:.2e}s")
+        return False
+    w.speed = profile["speed"]
+    w.int_overhead = profile["int_overhead"]
+    w.overhead = profile["overhead"]
+    w.isa_speedup = profile.get("isa_speedup", 1.0)
+    return True
+
+class CalibrationCache:
+    """
+    A JSON file with the worker calibration profiles (speed,
+    integration and total overheads, latency, instruction set
+    and its speedup), so that the
+    workers don't need to be benchmarked at every startup.
+
+    The profiles are keyed by the host name, the worker command,
+    and the protocol; a profile older than ttl seconds is ignored.
+    """
+
+    def __init__(self, filename, ttl=24*60*60):
+        self.filename = filename
+        self.ttl = ttl
+        self.modified = False
+        try:
+            with open(filename, "r") as f:
+                self.profiles = json.load(f)
+        except FileNotFoundError:
+            self.profiles = {}
+        except ValueError:
+            log(f"Can't parse {filename}; will recalibrate the workers")
+            self.profiles = {}
+
+    @staticmethod
+    def worker_key(w):
+        # The worker name is "host:pid" (or "host:pid:cuda").
+        host = w.name.split(":")[0]
+        return json.dumps([host, repr(w.command), w.protocol])
+
+    def lookup(self, w):
+        profile = self.profiles.get(self.worker_key(w))
+        if profile is None or time.time() - profile["time"] > self.ttl:
+            return None
+        return profile
+
+    def store(self, w):
+        self.profiles[self.worker_key(w)] = {
+            "speed": w.speed,
+            "int_overhead": w.int_overhead,
+            "overhead": w.overhead,
+            "latency": w.latency,
+            "isa": w.isa,
+            "isa_speedup": w.isa_speedup,
+            "time": time.time()
+        }
+        self.modified = True
+
+    def save(self):
+        if not self.modified: return
+        try:
+            dirname = os.path.dirname(self.filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            save_json(self.filename, self.profiles)
+            self.modified = False
+        except OSError as e:
+            log(f"Can't save the calibration to {self.filename}: {e}")
+
+def default_calibration_file():
+    cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cachedir, "pysecdec", "disteval-calibration.json")
+
+class IntegralWeights:
+    """
+    The expanded prefactor and the kernel orders of one integral,
+    prepared once, so that at each point the weights of its
+    kernels in the amplitudes are computed by array operations.
+    """
+
+    def __init__(self, info, kernel2idx):
+        self.prefactor_powers = np.array([t["regulator_powers"] for t in info["expanded_prefactor"]], dtype=np.int64)
+        self.prefactor_exprs = [sp.sympify(t["coefficient"]).evalf() for t in info["expanded_prefactor"]]
+        self.symbols = sorted(set().union(*[e.free_symbols for e in self.prefactor_exprs]), key=str)
+        self.parameters = [str(s) for s in self.symbols]
+        self.prefactor_function = sp.lambdify(self.symbols, self.prefactor_exprs, modules="numpy")
+        self.order_powers = np.array([o["regulator_powers"] for o in info["orders"]], dtype=np.int64)
+        self.kern_leading_orders = np.min(self.order_powers, axis=0)
+        self.kern_highest_orders = np.max(self.order_powers, axis=0)
+        # order_kernels[i, k] = how many times the kernel k is
+        # listed in the order i.
+        self.order_kernels = np.zeros((len(info["orders"]), len(kernel2idx)))
+        for i, o in enumerate(info["orders"]):
+            np.add.at(self.order_kernels[i], [kernel2idx[info["name"], k] for k in o["kernels"]], 1)
+
+    def prefactor_values(self, valuemaps):
+        """
+        Evaluate the prefactor terms at each of the given points;
+        return a (npoints, nterms) complex array.
+        """
+        for p in self.parameters:
+            for vm in valuemaps:
+                if p not in vm:
+                    raise ValueError(f"missing prefactor parameter: {p}")
+        args = [np.array([complex(vm[p]) for vm in valuemaps]) for p in self.parameters]
+        try:
+            with np.errstate(all="ignore"):
+                values = self.prefactor_function(*args)
+            return np.array([np.broadcast_to(np.asarray(v, dtype=np.complex128), (len(valuemaps),)) for v in values]).T
+        except (NameError, TypeError):
+            # A function numpy doesn't know about: let sympy do it.
+            return np.array([
+                [complex(e.subs(dict(zip(self.symbols, vm)))) for e in self.prefactor_exprs]
+                for vm in zip(*args)
+            ], dtype=np.complex128).reshape(len(valuemaps), len(self.prefactor_exprs))
+
+    def add_weights(self, rows, ampid, prefactor, coef_powers, coef_values, requested_orders):
+        """
+        Multiply the expanded prefactor (the values at one point)
+        by the expansion of the amplitude coefficient, and add the
+        weights of the kernels to the {(ampid, powers): weights}
+        dictionary; skip the orders higher than requested, or
+        higher than known from the kernels.
+        """
+        if len(coef_values) == 0: return
+        nreg = self.order_powers.shape[1]
+        coef_powers = np.asarray(coef_powers, dtype=np.int64).reshape(-1, nreg)
+        max_highest_orders = np.min(self.prefactor_powers, axis=0) + np.min(coef_powers, axis=0) + self.kern_highest_orders
+        powers = (self.prefactor_powers[:,None,:] + coef_powers[None,:,:]).reshape(-1, nreg)
+        values = (prefactor[:,None] * np.asarray(coef_values, dtype=np.complex128)[None,:]).reshape(-1)
+        keep = np.all(powers <= -self.kern_leading_orders + requested_orders, axis=1)
+        powers, values = powers[keep], values[keep]
+        # All combinations of the kernel orders and the terms of
+        # the prefactor times the coefficient.
+        total = self.order_powers[:,None,:] + powers[None,:,:]
+        ok = np.all((total <= requested_orders) & (total <= max_highest_orders), axis=2)
+        oidx, tidx = np.nonzero(ok)
+        if len(oidx) == 0: return
+        keys, kidx = np.unique(total[oidx, tidx], axis=0, return_inverse=True)
+        C = np.zeros((len(keys), len(self.order_powers)), dtype=np.complex128)
+        np.add.at(C, (kidx.reshape(-1), oidx), values[tidx])
+        for p, w in zip(keys.tolist(), C @ self.order_kernels):
+            key = (ampid, tuple(p))
+            rows[key] = rows[key] + w if key in rows else w
 
 def adjust_1d_n(W2, V, w, a, tau, nmin, nmax, allow_medianQMC):
     assert np.all(W2 > 0)
@@ -316,6 +1678,18 @@ def adjust_1d_n(W2, V, w, a, tau, nmin, nmax, allow_medianQMC):
         mask |= add
     return n
 
+def component_names(kern_comps):
+    """
+    Name the components for the log: "k<i>" for the kernels with
+    a single component, and "k<i>.<j>" for the j-th component of
+    a kernel with several.
+    """
+    names = [None] * sum(len(comps) for comps in kern_comps)
+    for i, comps in enumerate(kern_comps):
+        for j, c in enumerate(comps):
+            names[c] = f"k{i}" if len(comps) == 1 else f"k{i}.{j}"
+    return names
+
 def adjust_n(W2, V, w, a, tau, nmin, nmax, allow_medianQMC, names=[]):
     assert np.all(V>0)
     assert len(W2) == len(V)
@@ -326,7 +1700,35 @@ def adjust_n(W2, V, w, a, tau, nmin, nmax, allow_medianQMC, names=[]):
         assert not np.any(np.isnan(n))
     return n
 
-async def prepare_eval(workers, datadir, intfile):
+class PreparedEval(collections.namedtuple("PreparedEval", [
+        "datadir", "info", "requested_orders", "kernel2idx", "infos", "ampcount", "korders",
+        "family2idx", "sched", "t_init", "t_worker", "weights", "comp2idx", "kern_comps",
+        "median_genvecs", "coefficients", "pool", "slots"])):
+    """
+    The integrals and the workers set up by prepare_eval(), to
+    be shared by the evaluations at any number of points:
+    - datadir, info: the directory and the contents of the
+      integral (or sum) file;
+    - infos, family2idx: the integral descriptions and the
+      family ids by integral name;
+    - kernel2idx, comp2idx: the kernel and the component ids by
+      (integral, name), kern_comps the components of each kernel,
+      and korders the order index of each kernel;
+    - requested_orders, ampcount, weights: the orders to
+      evaluate, the number of sums, and the IntegralWeights
+      of each integral;
+    - sched, pool, coefficients: the integration scheduler, its
+      worker pool, and the CoefficientService;
+    - median_genvecs: the known median QMC generating vectors;
+    - slots: the number of points that can be evaluated at once;
+    - t_init, t_worker: the time spent loading the integrals and
+      starting the workers.
+    """
+
+async def prepare_eval(workers, datadir, intfile, protocol="binary", scheduler="random", slots=1, relaunch=True, heartbeat=300, calibration=None, metrics=None, gpu_lattice=None, coefficient_workers=None):
+    if protocol not in protocols:
+        raise ValueError(f"unknown protocol: {protocol}")
+
     # Load the integrals from the requested json file
     t0 = time.time()
 
@@ -338,10 +1740,22 @@ async def prepare_eval(workers, datadir, intfile):
 
     requested_orders = info["requested_orders"]
     kernel2idx = {}
+    # A kernel with fused orders (see make_package) returns the
+    # values of several components at once; the components are
+    # what the weights refer to. Other kernels are their own
+    # single component.
+    comp2idx = {}
+    kern_comps = []
+    def add_kernels(fam, ii):
+        for k in ii["kernels"]:
+            kernel2idx[fam, k] = len(kernel2idx)
+            kern_comps.append([])
+            for c in ii.get("kernel_components", {}).get(k, [k]):
+                kern_comps[-1].append(len(comp2idx))
+                comp2idx[fam, c] = len(comp2idx)
     if info["type"] == "integral":
         infos = {info["name"] : info}
-        for k in info["kernels"]:
-            kernel2idx[info["name"], k] = len(kernel2idx)
+        add_kernels(info["name"], info)
         log(f"got the total of {len(kernel2idx)} kernels")
         ampcount = 1
     elif info["type"] == "sum":
@@ -351,8 +1765,7 @@ async def prepare_eval(workers, datadir, intfile):
             with open(os.path.join(datadir, f"{i}.json"), "r") as f:
                 infos[i] = json.load(f)
                 assert infos[i]["name"] == i
-            for k in infos[i]["kernels"]:
-                kernel2idx[i, k] = len(kernel2idx)
+            add_kernels(i, infos[i])
         log(f"got the total of {len(kernel2idx)} kernels")
         if isinstance(info["sums"], list):
             info["sums"] = {f"sum{sumidx}" : sum for sumidx, sum in enumerate(info["sums"])}
@@ -364,55 +1777,170 @@ async def prepare_eval(workers, datadir, intfile):
         for i, oo in enumerate(ii["orders"]):
             for ker in oo["kernels"]:
                 korders.setdefault((fam, ker), i)
+    log(f"parsing {len(infos)} integral prefactors")
+    if len(comp2idx) != len(kernel2idx):
+        log(f"the kernels have the total of {len(comp2idx)} components")
+    weights = {fam: IntegralWeights(ii, comp2idx) for fam, ii in infos.items()}
 
     log("Kernel ids:")
+    comp_names = component_names(kern_comps)
+    idx2comp = list(comp2idx.keys())
     for (fam, ker), i in kernel2idx.items():
         log(f"- ({fam}, {ker}) = k{i}")
+        if len(kern_comps[i]) > 1:
+            for c in kern_comps[i]:
+                log(f"  - {idx2comp[c][1]} = {comp_names[c]}")
 
     family2idx = {fam:i for i, fam in enumerate(infos.keys())}
 
+    if metrics is not None:
+        for slot in range(slots):
+            for (fam, ker), i in kernel2idx.items():
+                metrics.kernel_names[1 + slot*len(kernel2idx) + i] = f"k{i}"
+
     # Launch all the workers
     t1 = time.time()
 
-    par = RandomScheduler()
+    if scheduler not in schedulers:
+        raise ValueError(f"unknown scheduler: {scheduler}")
+    par = schedulers[scheduler](gpu_lattice=gpu_lattice)
 
     async def add_worker(cmd):
-        w = await launch_worker(cmd, datadir)
-        await w.call("family", 0, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)
+        w = await launch_worker(cmd, datadir, protocol=protocol)
+        # The CPU worker replies with the instruction set of the
+        # library variant it has chosen.
+        w.isa = await w.call("family", 0, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)
         await w.call("kernel", 0, 0, "gauge")
+        # Each slot gets its own copy of the families (and thus
+        # of the parameter values), so that up to this many points
+        # can be evaluated at once. The workers that support it
+        # only open the libraries and resolve the kernels on their
+        # first use, checking the number of results then.
+        lazy = "lazy_kernels" in w.features
         await w.multicall([
-            ("family", (i+1, fam, info["dimension"], (), (), info["complex_result"]))
+            ("family", (1 + slot*len(infos) + i, fam, info["dimension"], (), (), info["complex_result"]) + ((True,) if lazy else ()))
+            for slot in range(slots)
             for i, (fam, info) in enumerate(infos.items())
         ])
-        await w.multicall([
-            ("kernel", (i+1, family2idx[fam]+1, ker))
+        nresults = await w.multicall([
+            ("kernel", (1 + slot*len(kernel2idx) + i, 1 + slot*len(infos) + family2idx[fam], ker) + ((len(kern_comps[i]),) if lazy else ()))
+            for slot in range(slots)
             for (fam, ker), i in kernel2idx.items()
         ])
-        await benchmark_worker(w)
+        # Older workers reply with null: one result per kernel.
+        for (fam, ker), i in kernel2idx.items():
+            n = 1 if nresults[i] is None else nresults[i]
+            if n != len(kern_comps[i]):
+                raise WorkerException(f"{w.name}: kernel {fam}.{ker} has {n} results instead of {len(kern_comps[i])}")
+        # To measure the speedup of the instruction set specific
+        # kernels, load the generic builtin one after all the slots.
+        generic_kernel = None
+        if w.isa not in (None, "generic"):
+            await w.call("family", 1 + slots*len(infos), "builtin@generic", 2, (2.0, 0.1, 0.2, 0.3), (), True)
+            generic_kernel = 1 + slots*len(kernel2idx)
+            await w.call("kernel", generic_kernel, 1 + slots*len(infos), "gauge")
+        profile = calibration.lookup(w) if calibration is not None else None
+        if profile is None or not await check_calibration(w, profile):
+            await benchmark_worker(w, generic_kernel)
+            if calibration is not None:
+                calibration.store(w)
+        if metrics is not None:
+            metrics.add_worker(w)
+        # A relaunched worker needs the current parameter values;
+        # repeat if they were changed in the meantime.
+        while par.family_params:
+            version = par.family_version
+            await w.multicall([
+                ("changefamily", (famid, realp, complexp))
+                for famid, (realp, complexp) in par.family_params.items()
+            ])
+            if version == par.family_version: break
+        if heartbeat is not None:
+            w.start_heartbeat(heartbeat)
         par.add_worker(w)
-    await asyncio.gather(*[add_worker(cmd) for cmd in workers])
+        return w
+    # The workers can be added and removed later via the pool.
+    pool = WorkerPool(par, add_worker, relaunch=relaunch)
+    await asyncio.gather(*pool.set_commands(workers, retry=False))
+    if calibration is not None:
+        calibration.save()
+    def worker_launched(w):
+        log(f"launched {w.name}, {len(par.workers)} workers now")
+        if calibration is not None:
+            calibration.save()
+    pool.on_launch = worker_launched
     log("workers:")
     for w in par.workers:
-        log(f"- {w.name}: int speed={w.speed:.2e}bps, int overhead={w.int_overhead:.2e}s, total overhead={w.overhead:.2e}s, latency={w.latency:.2e}s")
+        isa = f" isa={w.isa} (x{w.isa_speedup:.2f} over generic)," if w.isa else ""
+        log(f"- {w.name}:{isa} int speed={w.speed:.2e}bps, int overhead={w.int_overhead:.2e}s, total overhead={w.overhead:.2e}s, latency={w.latency:.2e}s")
 
     t2 = time.time()
 
-    return (
-        datadir,
-        info,
-        requested_orders,
-        kernel2idx,
-        infos,
-        ampcount,
-        korders,
-        family2idx,
-        par,
-        t1 - t0,
-        t2 - t1)
-
-async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nshifts, lattice_candidates, standard_lattices, valuemap, valuemap_coeff, deadline):
-
-    datadir, info, requested_orders, kernel2idx, infos, ampcount, korders, family2idx, par, t_init, t_worker = prepared
+    if coefficient_workers is None:
+        coefficient_workers = default_coefficient_commands()
+    coefficients = CoefficientService(coefficient_workers, datadir, relaunch=relaunch)
+
+    return PreparedEval(
+        datadir=datadir,
+        info=info,
+        requested_orders=requested_orders,
+        kernel2idx=kernel2idx,
+        infos=infos,
+        ampcount=ampcount,
+        korders=korders,
+        family2idx=family2idx,
+        sched=par,
+        t_init=t1 - t0,
+        t_worker=t2 - t1,
+        weights=weights,
+        comp2idx=comp2idx,
+        kern_comps=kern_comps,
+        median_genvecs={},
+        coefficients=coefficients,
+        pool=pool,
+        slots=slots)
+
+async def shutdown(prepared, timeout=5):
+    """
+    Stop the workers started by prepare_eval(), without
+    relaunching them.
+    """
+    sched, coefficients, pool = prepared.sched, prepared.coefficients, prepared.pool
+    pool.close()
+    coefficients.pool.close()
+    workers = list(sched.workers) + list(pool.retiring) + coefficients.workers()
+    for w in workers:
+        if w.heartbeat_task is not None:
+            w.heartbeat_task.cancel()
+        try:
+            w.process.kill()
+        except ProcessLookupError:
+            pass
+    if workers:
+        await asyncio.wait([w.reader_task for w in workers], timeout=timeout)
+
+async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nshifts, lattice_candidates, standard_lattices, valuemap, valuemap_coeff, deadline, job_time=1.0, cache=None, slot=0, warmstart=None, checkpoint=None, resume=None, lattice_step=None, lattice_cache=None):
+
+    datadir, info, infos = prepared.datadir, prepared.info, prepared.infos
+    requested_orders, ampcount, weights = prepared.requested_orders, prepared.ampcount, prepared.weights
+    kernel2idx, comp2idx, kern_comps = prepared.kernel2idx, prepared.comp2idx, prepared.kern_comps
+    sched, coefficients, slots = prepared.sched, prepared.coefficients, prepared.slots
+    t_init, t_worker, median_genvecs = prepared.t_init, prepared.t_worker, prepared.median_genvecs
+    if not 0 <= slot < slots:
+        raise ValueError(f"slot {slot} is out of range; only {slots} were prepared")
+    # The values are tracked per component, and the lattices
+    # per kernel; comp_kern[c] is the kernel of the component c.
+    comp_kern = np.zeros(len(comp2idx), dtype=np.int64)
+    for i, comps in enumerate(kern_comps):
+        comp_kern[comps] = i
+    comp_count = np.array([len(comps) for comps in kern_comps], dtype=np.float64)
+    comp_names = component_names(kern_comps)
+    # Family and kernel ids of this slot, as known to the workers.
+    fambase = 1 + slot*len(infos)
+    kernbase = 1 + slot*len(kernel2idx)
+    par = JobGroup(sched)
+    nretried0 = len(sched.retried)
+    nfailures0 = len(sched.failures)
 
     if lattice_candidates == 0: standard_lattices=True
 
@@ -424,10 +1952,6 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
 
     sp_regulators = sp.var(info["regulators"])
 
-    valuemap_rat = {
-        k:sp.nsimplify(v, rational=True, tolerance=np.abs(v)*1e-13)
-        for k, v in valuemap_coeff.items()
-    }
     realp = {
         i : [valuemap[p] for p in info["realp"]]
         for i, info in infos.items()
@@ -437,48 +1961,63 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
         for i, info in infos.items()
     }
 
-    log(f"parsing {len(infos)} integral prefactors")
-    for ii in infos.values():
-        ii["expanded_prefactor_value"] = {
-            tuple(t["regulator_powers"]) : complex(sp.sympify(t["coefficient"]).subs(valuemap))
-            for t in ii["expanded_prefactor"]
-        }
-
-    await asyncio.gather(*[
-        w.multicall([
-            ("changefamily", (i+1, realp[fam], complexp[fam]))
-            for i, (fam, info) in enumerate(infos.items())
-        ])
-        for w in par.workers])
+    prefactors = {fam: weights[fam].prefactor_values([valuemap])[0] for fam in infos.keys()}
+
+    for i, fam in enumerate(infos.keys()):
+        sched.family_params[fambase + i] = (realp[fam], complexp[fam])
+    sched.family_version += 1
+    for r in await asyncio.gather(*[
+            w.multicall([
+                ("changefamily", (fambase + i, realp[fam], complexp[fam]))
+                for i, (fam, info) in enumerate(infos.items())
+            ])
+            for w in par.workers],
+            return_exceptions=True):
+        # Dead workers will get the parameters when relaunched.
+        if isinstance(r, Exception) and str(r) != WORKER_DIED:
+            raise r
 
     # Load the integral coefficients
     ap2coeffs = {} # (ampid, powerlist) -> coeflist
     if info["type"] == "integral":
         sum_names = ["sum0"]
-        br_coef = {(0,)*len(info["regulators"]): sp.sympify(1)}
-        split_integral_into_orders(ap2coeffs, 0, kernel2idx, info, br_coef, valuemap, sp_regulators, requested_orders)
+        weights[info["name"]].add_weights(ap2coeffs, 0, prefactors[info["name"]], [(0,)*len(info["regulators"])], [1], requested_orders)
     elif info["type"] == "sum":
         log("loading amplitude coefficients")
         sum_names = list(info["sums"].keys())
         done_evalf = asyncio.Future()
         done_evalf.todo = sum(len(terms) for terms in info["sums"].values())
-        def evalf_cb(br_coef, exception, w, a, t):
-            if exception is not None:
-                done_evalf.set_exception(WorkerException(exception))
-                return
+        def add_coefficient(a, t, br_coef):
             log("-", t["coefficient"])
-            br_coef = {tuple(k):complex(re, im) for k, (re, im) in br_coef}
-            split_integral_into_orders(ap2coeffs, a, kernel2idx, infos[t["integral"]], br_coef, valuemap, sp_regulators, requested_orders)
+            weights[t["integral"]].add_weights(ap2coeffs, a, prefactors[t["integral"]], list(br_coef.keys()), list(br_coef.values()), requested_orders)
             done_evalf.todo -= 1
             if done_evalf.todo == 0:
                 done_evalf.set_result(None)
+        def evalf_cb(br_coef, exception, w, a, t):
+            if exception is not None:
+                if not done_evalf.done():
+                    done_evalf.set_exception(WorkerException(exception))
+                return
+            add_coefficient(a, t, {tuple(k):complex(re, im) for k, (re, im) in br_coef})
+        valuemap_rat = None
+        ncompiled = 0
         for a, terms in enumerate(info["sums"].values()):
             for t in terms:
-                intinfo = infos[t["integral"]]
-                pref_lord = np.min([o["regulator_powers"] for o in intinfo["expanded_prefactor"]], axis=0)
-                kern_lord = np.min([o["regulator_powers"] for o in intinfo["orders"]], axis=0)
-                coef_ord = - kern_lord - pref_lord + requested_orders
-                par.call_cb("evalf", (
+                coef_ord = coefficient_orders(infos[t["integral"]], requested_orders)
+                # Use the compiled coefficients if available (see
+                # pySecDec.disteval_coefficients); otherwise let
+                # a coefficient worker expand it with GiNaC.
+                compiled = load_compiled_coefficient(os.path.join(coeffsdir, t["coefficient"]), info["regulators"], coef_ord)
+                if compiled is not None:
+                    ncompiled += 1
+                    add_coefficient(a, t, compiled(valuemap_coeff, coef_ord))
+                    continue
+                if valuemap_rat is None:
+                    valuemap_rat = {
+                        k:sp.nsimplify(v, rational=True, tolerance=np.abs(v)*1e-13)
+                        for k, v in valuemap_coeff.items()
+                    }
+                coefficients.call_cb("evalf", (
                         os.path.relpath(os.path.join(coeffsdir, t["coefficient"]), datadir),
                         {k:str(v) for k,v in valuemap_rat.items()},
                         [[str(var), int(order)] for var, order in zip(sp_regulators, coef_ord)]
@@ -486,6 +2025,8 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
                     evalf_cb,
                     (a, t)
                 )
+        if ncompiled > 0:
+            log(f"evaluated {ncompiled} compiled coefficients")
         await done_evalf
 
     W = np.stack([w for w in ap2coeffs.values()])
@@ -498,18 +2039,51 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
     epsabsOrig = epsabs.copy()
     epsabs = [epsabs[a] if a < len(epsabs) else epsabs[-1] for a, p in ap2coeffs.keys()]
 
-    # Presample all kernels
+    if resume is not None:
+        if resume["kernels"] != [[fam, ker] for fam, ker in kernel2idx.keys()]:
+            raise ValueError("the checkpoint was made for different kernels")
+        if resume["parameters"] != encode_valuemap(valuemap):
+            raise ValueError("the checkpoint was made for different parameter values")
+        log(f"resuming from a checkpoint at stage {resume['stage']}")
+
+    # The warm start state of each kernel, if known. The state
+    # of a kernel with different components (e.g. from before the
+    # orders were fused differently) is not applicable.
+    idx2comp = list(comp2idx.keys())
+    kern_comp_names = [[idx2comp[c][1] for c in comps] for comps in kern_comps]
+    warm = [None] * len(kernel2idx)
+    if warmstart is not None and resume is None:
+        for (fam, ker), i in kernel2idx.items():
+            w = warmstart.get(fam, {}).get(ker)
+            if w is not None and len(w["genvec"]) == infos[fam]["dimension"] and len(w["deformp"]) == infos[fam]["deformp_count"] \
+                    and w.get("components", [ker]) == kern_comp_names[i]:
+                warm[i] = w
+        log(f"warm-starting {sum(w is not None for w in warm)} of {len(kernel2idx)} kernels")
+
+    # Constructing a lattice that is not in the tables can take
+    # seconds; meanwhile the event loop must keep serving the
+    # workers (and the other points), so do it in a thread.
+    loop = asyncio.get_event_loop()
+    def lattice_for(dim, n):
+        return loop.run_in_executor(None, functools.partial(
+            generating_vector, dim, n, step=lattice_step, cache_dir=lattice_cache))
+
+    # Presample all kernels, except for the warm-started ones
     kern_rng = [np.random.RandomState(0) for fam, ker in kernel2idx.keys()]
     t2 = time.time()
     log("distributing presampling jobs")
-    results = []
+    results = {}
     for i, (fam, ker) in enumerate(kernel2idx.keys()):
-        lattice, genvec = generating_vector(infos[fam]["dimension"], npresample)
-        f = par.call("maxdeformp", i+1, infos[fam]["deformp_count"],
+        if warm[i] is not None or resume is not None: continue
+        lattice, genvec = await lattice_for(infos[fam]["dimension"], npresample)
+        results[i] = par.call("maxdeformp", kernbase + i, infos[fam]["deformp_count"],
             lattice, genvec, kern_rng[i].rand(infos[fam]["dimension"]).tolist())
-        results.append(f)
     log("waiting for the presampling results")
-    deformp = await asyncio.gather(*results)
+    results = dict(zip(results.keys(), await asyncio.gather(*results.values())))
+    if resume is not None:
+        deformp = resume["deformp"]
+    else:
+        deformp = [warm[i]["deformp"] if warm[i] is not None else results[i] for i in range(len(kernel2idx))]
     deformp = [[min(max(x, 1e-6), 1.0) for x in defp] for defp in deformp]
     for i, d in enumerate(deformp):
         log(f"maxdeformp of k{i} is {d}")
@@ -525,54 +2099,201 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
     maxlattices = np.array([max_lattice_size(d) for d in dims], dtype=np.float64)
     lattices = np.zeros(len(kernel2idx), dtype=np.float64)
     for i in range(len(kernel2idx)):
-        lattices[i], genvecs[i] = generating_vector(dims[i], npoints0)
-    shift_val = np.full((len(kernel2idx), nshifts), np.nan, dtype=np.complex128)
+        lattices[i], genvecs[i] = await lattice_for(dims[i], npoints0)
+    shift_val = np.full((len(comp2idx), nshifts), np.nan, dtype=np.complex128)
     shift_rnd = np.empty((len(kernel2idx), nshifts), dtype=object)
     shift_tag = np.full((len(kernel2idx), nshifts), None, dtype=object)
+    kern_tags = [[] for i in range(len(kernel2idx))]
     kern_db = np.ones(len(kernel2idx))
     kern_dt = np.ones(len(kernel2idx))
     kern_di = np.ones(len(kernel2idx))
-    kern_val = np.zeros(len(kernel2idx), dtype=np.complex128)
-    kern_var = np.full(len(kernel2idx), np.inf, dtype=np.complex128)
+    kern_val = np.zeros(len(comp2idx), dtype=np.complex128)
+    kern_var = np.full(len(comp2idx), np.inf, dtype=np.complex128)
+
+    # Start the warm kernels from their previous lattices, and
+    # with their previous cost per point.
+    for i, w in enumerate(warm):
+        if w is None: continue
+        if w["lattice"] > lattices[i]:
+            lattices[i], genvecs[i] = w["lattice"], list(w["genvec"])
+        kern_db[i] = w["bubbles"]
+
+    if cache is not None:
+        libhashes = {fam : file_hash(os.path.join(datadir, f"{fam}.so")) for fam in infos.keys()}
+        comp_keys = [
+            ResultCache.kernel_key(fam, comp, libhashes[fam], realp[fam], complexp[fam])
+            for fam, comp in comp2idx.keys()
+        ]
+        integrand_keys = [
+            ResultCache.integrand_key(fam, ker, libhashes[fam])
+            for fam, ker in kernel2idx.keys()
+        ]
+
+    # Resume each kernel from its largest fully cached lattice,
+    # unless the whole state (including the deformation
+    # parameters) comes from a checkpoint.
+    if cache is not None and resume is None:
+        for i in range(len(kernel2idx)):
+            largest = cache.largest(comp_keys[kern_comps[i][0]], nshifts)
+            if largest is not None and largest[0] > lattices[i]:
+                lattices[i], genvecs[i], deformp[i] = largest
+                log(f"resuming k{i} from the cached lattice of {largest[0]} points")
+
+    # Continue from the checkpointed round.
+    if resume is not None:
+        lattices[:] = resume["lattices"]
+        oldlattices[:] = resume["oldlattices"]
+        genvecs[:] = [list(g) for g in resume["genvecs"]]
+        kern_db[:] = resume["kern_db"]
+        kern_di[:] = resume["kern_di"]
+        kern_dt[:] = resume["kern_dt"]
+        kern_val[:] = [complex(re, im) for re, im in resume["kern_val"]]
+        kern_var[:] = [complex(re, im) for re, im in resume["kern_var"]]
+
+    def save_checkpoint(stage):
+        # Only the state between the rounds is saved: the
+        # lattices to evaluate next, and the results so far.
+        save_json(checkpoint, {
+            "kernels": [[fam, ker] for fam, ker in kernel2idx.keys()],
+            "parameters": encode_valuemap(valuemap),
+            "stage": stage,
+            "deformp": [[float(x) for x in d] for d in deformp],
+            "lattices": lattices.tolist(),
+            "oldlattices": oldlattices.tolist(),
+            "genvecs": [[int(x) for x in g] for g in genvecs],
+            "kern_db": kern_db.tolist(),
+            "kern_di": kern_di.tolist(),
+            "kern_dt": kern_dt.tolist(),
+            "kern_val": [[v.real, v.imag] for v in kern_val.tolist()],
+            "kern_var": [[v.real, v.imag] for v in kern_var.tolist()]
+        })
 
     genvec_candidates = dict()
 
-    def shift_done_cb(result, exception, w, idx, shift):
-        (re, im), di, dt = result
-        if math.isnan(re) or math.isnan(im):
-            for s in range(nshifts):
-                par.cancel_cb(shift_tag[idx, s])
+    def chunk_done_cb(result, exception, w, idx, s0, partial, multi):
+        # Each job covers an index range of the lattice for one
+        # or several shifts; the partial sums are accumulated in
+        # partial[1] until all partial[0] chunks are done.
+        values, di, dt = result
+        comps = kern_comps[idx]
+        if not multi and len(comps) == 1: values = [values]
+        if any(math.isnan(re) or math.isnan(im) for re, im in values):
+            for tag in kern_tags[idx]:
+                par.cancel_cb(tag)
             deformp[idx] = tuple(p*0.9 for p in deformp[idx])
             log(f"got NaN from k{idx}; decreasing deformp by 0.9 to {deformp[idx]}")
             schedule_kernel(idx)
+            return
+        # The values come shift by shift, each with all of the
+        # components of the kernel.
+        partial[1] += np.array([complex(re, im) for re, im in values]).reshape(-1, len(comps))
+        partial[0] -= 1
+        if dt > 2*w.int_overhead:
+            # Once the kernel cost is known from other jobs, use
+            # it to correct the speed of this worker.
+            if kern_di[idx] > 4*di:
+                w.update_speed(di*kern_db[idx]/kern_di[idx], dt)
+            db = (dt - w.int_overhead)*w.speed
+            kern_db[idx] += db
+            kern_di[idx] += di
+            kern_dt[idx] += dt
+            partial[2] += (db, di, dt)
+        if partial[0] == 0:
+            s1 = s0 + len(partial[1])
+            shift_val[comps, s0:s1] = partial[1].T
+            if cache is not None:
+                for j, c in enumerate(comps):
+                    cache.store(comp_keys[c], lattices[idx], genvecs[idx], deformp[idx],
+                        shift_rnd[idx, s0:s1], partial[1][:,j], *partial[2])
+
+    def kernel_cost(idx):
+        # Expected cost of one lattice evaluation, in bubbles.
+        return lattices[idx]*kern_db[idx]/kern_di[idx]
+
+    # Workers that know "integrate_shifts" get all the shifts
+    # of a kernel in a single call. The workers that join later
+    # without it only get the other jobs (see can_take()).
+    multishift = all("integrate_shifts" in w.features for w in par.workers)
+
+    # The mean worker speed; while all the workers are gone
+    # (e.g. being relaunched), the last known one.
+    mean_speed = None
+
+    def schedule_kernel(idx):
+        nonlocal mean_speed
+        lattice = int(lattices[idx])
+        # Split the work into jobs of about job_time seconds
+        # on an average worker: first by shifts, and then, if a
+        # single shift is still too much, by lattice index ranges.
+        # Without any speed known, don't split at all.
+        if par.workers:
+            mean_speed = np.mean([w.speed for w in par.workers])
+        if mean_speed is not None:
+            job_points = max(1.0, job_time*mean_speed*kern_di[idx]/kern_db[idx])
         else:
-            shift_val[idx, shift] = complex(re, im)
-            if dt > 2*w.int_overhead:
-                kern_db[idx] += (dt - w.int_overhead)*w.speed
+            job_points = float(lattice*MAX_SHIFTS_PER_CALL)
+        pershift = int(min(max(job_points//lattice, 1), MAX_SHIFTS_PER_CALL)) if multishift else 1
+        nchunks = int(min(max(math.ceil(lattice*pershift/job_points), 1), lattice))
+        bounds = [lattice*c//nchunks for c in range(nchunks + 1)]
+        if nchunks > 1:
+            log(f"splitting k{idx} into {nchunks} chunks per shift")
+        kern_tags[idx] = []
+        # Only evaluate the shifts that are not cached yet.
+        scached = 0
+        if cache is not None:
+            found = [cache.lookup_shifts(comp_keys[c], lattice, genvecs[idx], deformp[idx], nshifts) for c in kern_comps[idx]]
+            scached = min(len(values) for shifts, values, stats in found)
+            for c, (shifts, values, stats) in zip(kern_comps[idx], found):
+                shift_val[c, :scached] = values[:scached]
+            # The components share the shifts; skip as many random
+            # draws as there are cached shifts, so that the new
+            # shifts are not the same as the cached ones.
+            for s in range(scached):
+                shift_rnd[idx, s] = np.array(found[0][0][s])
+                kern_rng[idx].rand(dims[idx])
+            db, di, dt = found[0][2]
+            if scached == nshifts and di > 0:
+                kern_db[idx] += db
                 kern_di[idx] += di
                 kern_dt[idx] += dt
-
-    def schedule_kernel(idx):
-        for s in range(nshifts):
-            shift = kern_rng[idx].rand(dims[idx])
-            shift_rnd[idx, s] = shift
-            shift_tag[idx, s] = par.call_cb("integrate",
-                (idx+1, int(lattices[idx]), 0, int(lattices[idx]), genvecs[idx],
-                shift.tolist(),
-                deformp[idx]),
-                shift_done_cb, (idx, s))
+            if scached > 0:
+                log(f"using {scached} cached shifts of k{idx}")
+        for s0 in range(scached, nshifts, pershift):
+            s1 = min(s0 + pershift, nshifts)
+            for s in range(s0, s1):
+                shift_rnd[idx, s] = kern_rng[idx].rand(dims[idx])
+            partial = [nchunks, np.zeros((s1 - s0, len(kern_comps[idx])), dtype=np.complex128), np.zeros(3)]
+            for c in range(nchunks):
+                if multishift:
+                    kern_tags[idx].append(par.call_cb("integrate_shifts",
+                        (kernbase + idx, lattice, bounds[c], bounds[c+1], genvecs[idx],
+                        [shift_rnd[idx, s].tolist() for s in range(s0, s1)],
+                        deformp[idx]),
+                        chunk_done_cb, (idx, s0, partial, True),
+                        cost=(s1 - s0)*kernel_cost(idx)/nchunks))
+                else:
+                    kern_tags[idx].append(par.call_cb("integrate",
+                        (kernbase + idx, lattice, bounds[c], bounds[c+1], genvecs[idx],
+                        shift_rnd[idx, s0].tolist(),
+                        deformp[idx]),
+                        chunk_done_cb, (idx, s0, partial, False),
+                        cost=kernel_cost(idx)/nchunks))
 
     def shift_done_cb_median_lattice(result, exception, w, idx, shift):
-        (re, im), di, dt = result
-        if math.isnan(re) or math.isnan(im):
+        values, di, dt = result
+        comps = kern_comps[idx]
+        if len(comps) == 1: values = [values]
+        if any(math.isnan(re) or math.isnan(im) for re, im in values):
             for s in range(lattice_candidates):
                 par.cancel_cb(shift_tag[idx, s])
             deformp[idx] = tuple(p*0.9 for p in deformp[idx])
             log(f"got NaN from k{idx}; decreasing deformp by 0.9 to {deformp[idx]}")
             schedule_kernel_median_lattice(idx)
         else:
-            shift_val[idx, shift] = complex(re, im)
+            shift_val[comps, shift] = [complex(re, im) for re, im in values]
             if dt > 2*w.int_overhead:
+                if kern_di[idx] > 4*di:
+                    w.update_speed(di*kern_db[idx]/kern_di[idx], dt)
                 kern_db[idx] += (dt - w.int_overhead)*w.speed
                 kern_di[idx] += di
                 kern_dt[idx] += dt
@@ -588,14 +2309,38 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
                 return r
             genvec_candidates[(idx, s)] = tuple( rand() for _ in range(dims[idx]) )
             shift_tag[idx, s] = par.call_cb("integrate",
-                (idx+1, int(lattices[idx]), 0, int(lattices[idx]), genvec_candidates[(idx,s)],
+                (kernbase + idx, int(lattices[idx]), 0, int(lattices[idx]), genvec_candidates[(idx,s)],
                 shift.tolist(),
                 deformp[idx]),
-                shift_done_cb_median_lattice, (idx, s))
+                shift_done_cb_median_lattice, (idx, s),
+                cost=kernel_cost(idx))
+
+    # The median QMC choice of a generating vector only depends
+    # on the integrand, so it is reused for the same lattice in
+    # the later rounds and points, and, via the cache, runs.
+    def known_median_genvec(idx):
+        key = (fams[idx], kers[idx], int(lattices[idx]))
+        if key not in median_genvecs and cache is not None:
+            genvec = cache.median_genvec(integrand_keys[idx], lattices[idx])
+            if genvec is not None:
+                median_genvecs[key] = genvec
+        return median_genvecs.get(key)
+
+    def remember_median_genvec(idx):
+        median_genvecs[fams[idx], kers[idx], int(lattices[idx])] = list(genvecs[idx])
+        if cache is not None:
+            cache.store_median_genvec(integrand_keys[idx], lattices[idx], genvecs[idx])
 
     perkern_epsrel = 0.2
     perkern_epsabs = 1e-4
 
+    def kernel_lattices(n):
+        # All the components of a kernel are evaluated on the
+        # same lattice: take the largest size proposed for them.
+        nk = np.zeros(len(kernel2idx), dtype=np.float64)
+        np.maximum.at(nk, comp_kern, n)
+        return nk
+
     def propose_lattices1(amp_val, amp_var):
         scaling = 2
         K = 20
@@ -605,11 +2350,12 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
             log("per-integral precision reached")
             oldlattices[:] = lattices
             return None
-        n = lattices * (kern_absvar/kern_maxvar)**(1/scaling)
-        n = np.clip(n, lattices, lattices*K)
-        mask_toolo = (lattices < n) & (n < lattices * 2)
-        n[mask_toolo] = lattices[mask_toolo]*2
-        return n
+        clattices = lattices[comp_kern]
+        n = clattices * (kern_absvar/kern_maxvar)**(1/scaling)
+        n = np.clip(n, clattices, clattices*K)
+        mask_toolo = (clattices < n) & (n < clattices * 2)
+        n[mask_toolo] = clattices[mask_toolo]*2
+        return kernel_lattices(n)
 
     def propose_lattices2(amp_val, amp_var):
         scaling = 2
@@ -628,30 +2374,41 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
             log("per-amplitude precision reached")
             oldlattices[:] = lattices
             return None
-        tau = kern_db/kern_di
+        # The cost of a kernel is shared by its components.
+        tau = (kern_db/kern_di/comp_count)[comp_kern]
         kern_absvar = np.real(kern_var) + np.imag(kern_var)
-        v0 = kern_absvar * lattices**scaling
-        n = adjust_n(W2, amp_maxerr**2, v0, scaling, tau, lattices, maxlattices, lattice_candidates>0)
-        n = np.clip(n, lattices, lattices*K)
-        toobig = n >= lattices*K
+        clattices = lattices[comp_kern]
+        v0 = kern_absvar * clattices**scaling
+        n = adjust_n(W2, amp_maxerr**2, v0, scaling, tau, clattices, maxlattices[comp_kern], lattice_candidates>0)
+        n = np.clip(n, clattices, clattices*K)
+        toobig = n >= clattices*K
         if np.any(toobig):
-            n[toobig] = lattices[toobig]*K
-            toosmall = n < lattices*2
-            n[toosmall] = lattices[toosmall]
-        return n
+            n[toobig] = clattices[toobig]*K
+            toosmall = n < clattices*2
+            n[toosmall] = clattices[toosmall]
+        return kernel_lattices(n)
 
     early_exit = False
 
-    async def iterate_integration(propose_lattices):
+    async def iterate_integration(propose_lattices, stage):
         nonlocal early_exit
         while True:
+            if checkpoint is not None:
+                save_checkpoint(stage)
             mask_todo = lattices != oldlattices
             if np.any(mask_todo):
                 # Schedule all kernels in mask_todo
                 # Construct lattices using medianQmc if required
                 if lattice_candidates > 0:
+                    median_todo = []
                     for i in mask_todo.nonzero()[0]:
                         if(not standard_lattices or lattices[i] > maxlattices[i]):
+                            genvec = known_median_genvec(int(i))
+                            if genvec is not None:
+                                log(f"reusing the median QMC generating vector of k{i} for lattice {lattices[i]:.0f}")
+                                genvecs[i] = list(genvec)
+                                continue
+                            median_todo.append(int(i))
                             schedule_kernel_median_lattice(int(i))
                             await asyncio.sleep(0)
                     if par.queue_size() > 0:
@@ -670,13 +2427,17 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
                         if isinstance(x,complex):
                             return x.real if abs(x.real) > abs(x.imag) else x.imag
                         else: return x
-                    for i in mask_todo.nonzero()[0]:
-                        if(not standard_lattices or lattices[i] > maxlattices[i]):
-                            median = np.median([signedMax(x) for x in shift_val[i,:lattice_candidates]])
-                            for s in range(lattice_candidates):
-                                if signedMax(shift_val[i,s]) == median:
-                                    genvecs[i] = list(genvec_candidates[(i,s)])
-                                shift_val[i,s] = np.nan
+                    for i in median_todo:
+                        # Pick by the sum of the kernel components.
+                        candidate_val = np.sum(shift_val[kern_comps[i],:lattice_candidates], axis=0)
+                        complete = not np.any(np.isnan(candidate_val))
+                        median = np.median([signedMax(x) for x in candidate_val])
+                        for s in range(lattice_candidates):
+                            if signedMax(candidate_val[s]) == median:
+                                genvecs[i] = list(genvec_candidates[(i,s)])
+                            shift_val[kern_comps[i],s] = np.nan
+                        if complete:
+                            remember_median_genvec(i)
 
                 # Run integration
                 log(f"distributing {np.count_nonzero(mask_todo)}*{nshifts} integration jobs")
@@ -697,28 +2458,36 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
                     log("WARNING: timeout reached, will stop soon")
                     early_exit = True
 
+                if cache is not None:
+                    cache.commit()
+
                 # Not all kernels might be done due to an early exit
-                mask_done = np.logical_and(mask_todo, ~np.any(np.isnan(shift_val), axis=1))
+                kern_nan = np.zeros(len(kernel2idx), dtype=bool)
+                np.logical_or.at(kern_nan, comp_kern, np.any(np.isnan(shift_val), axis=1))
+                mask_done = np.logical_and(mask_todo, ~kern_nan)
                 log(f"integration done, updated {np.count_nonzero(mask_done)} kernels")
-                shift_val_done = shift_val[mask_done]
-                shift_val[mask_todo] = np.nan
+                # The same masks and lattices, per component
+                cmask_done = mask_done[comp_kern]
+                clattices = lattices[comp_kern]
+                shift_val_done = shift_val[cmask_done]
+                shift_val[mask_todo[comp_kern]] = np.nan
                 new_kern_val = np.mean(shift_val_done, axis=1)
-                new_kern_val /= lattices[mask_done]
+                new_kern_val /= clattices[cmask_done]
                 new_kern_var = np.var(np.real(shift_val_done), axis=1) + (1j)*np.var(np.imag(shift_val_done), axis=1)
-                new_kern_var /= lattices[mask_done]**2 * nshifts
+                new_kern_var /= clattices[cmask_done]**2 * nshifts
 
-                latticex = lattices[mask_done]/oldlattices[mask_done]
-                precisionx = np.sqrt((np.real(kern_var[mask_done]) + np.imag(kern_var[mask_done])) / (np.real(new_kern_var) + np.imag(new_kern_var)))
-                for i, idx in enumerate(mask_done.nonzero()[0]):
+                latticex = clattices[cmask_done]/oldlattices[comp_kern][cmask_done]
+                precisionx = np.sqrt((np.real(kern_var[cmask_done]) + np.imag(kern_var[cmask_done])) / (np.real(new_kern_var) + np.imag(new_kern_var)))
+                for i, idx in enumerate(cmask_done.nonzero()[0]):
                     idx = int(idx)
                     if precisionx[i] < 1.0:
-                        log(f"k{idx} @ {lattices[idx]:.3e} = {new_kern_val[i]:.16e} ~ {new_kern_var[i]:.3e} ({1/precisionx[i]:.4g}x worse at {latticex[i]:.1f}x lattice)")
+                        log(f"{comp_names[idx]} @ {clattices[idx]:.3e} = {new_kern_val[i]:.16e} ~ {new_kern_var[i]:.3e} ({1/precisionx[i]:.4g}x worse at {latticex[i]:.1f}x lattice)")
                     else:
-                        log(f"k{idx} @ {lattices[idx]:.3e} = {new_kern_val[i]:.16e} ~ {new_kern_var[i]:.3e} ({precisionx[i]:.4g}x better at {latticex[i]:.1f}x lattice)")
-                submask_lucky = new_kern_var <= kern_var[mask_done]
-                kern_val[mask_done] = np.where(submask_lucky, new_kern_val, kern_val[mask_done])
-                kern_var[mask_done] = np.where(submask_lucky, new_kern_var, kern_var[mask_done])
-                log(f"unlucky results: {np.count_nonzero(~submask_lucky)} out of {np.count_nonzero(mask_done)}")
+                        log(f"{comp_names[idx]} @ {clattices[idx]:.3e} = {new_kern_val[i]:.16e} ~ {new_kern_var[i]:.3e} ({precisionx[i]:.4g}x better at {latticex[i]:.1f}x lattice)")
+                submask_lucky = new_kern_var <= kern_var[cmask_done]
+                kern_val[cmask_done] = np.where(submask_lucky, new_kern_val, kern_val[cmask_done])
+                kern_var[cmask_done] = np.where(submask_lucky, new_kern_var, kern_var[cmask_done])
+                log(f"unlucky results: {np.count_nonzero(~submask_lucky)} out of {np.count_nonzero(cmask_done)}")
             amp_val = W @ kern_val
             amp_var = W2 @ kern_var
             # Report results
@@ -750,7 +2519,7 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
             newgenvecs = [None] * len(kernel2idx)
             if standard_lattices:
                 for i in range(len(kernel2idx)):
-                    try: n[i], newgenvecs[i] = generating_vector(dims[i], n[i])
+                    try: n[i], newgenvecs[i] = await lattice_for(dims[i], n[i])
                     except ValueError: 
                         if lattice_candidates > 0: pass
             if not np.any(n != lattices):
@@ -763,14 +2532,28 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
             lattices[:] = n
             genvecs[:] = newgenvecs
 
-    if not early_exit:
+    stage = 1 if resume is None else resume["stage"]
+
+    if not early_exit and stage == 1:
         if np.min(epsrel) < 0.1:
             log(f"trying to achieve epsrel={perkern_epsrel} and epsabs={perkern_epsabs} for each kernel")
-            amp_val, amp_var = await iterate_integration(propose_lattices1)
+            amp_val, amp_var = await iterate_integration(propose_lattices1, 1)
 
     if not early_exit:
         log(f"trying to achieve epsrel={epsrel} and epsabs={epsabs} for each amplitude")
-        amp_val, amp_var = await iterate_integration(propose_lattices2)
+        amp_val, amp_var = await iterate_integration(propose_lattices2, 2)
+
+    # Remember the final state of each finished kernel.
+    if warmstart is not None:
+        for (fam, ker), i in kernel2idx.items():
+            if not np.all(np.isfinite(kern_var[kern_comps[i]])): continue
+            warmstart.setdefault(fam, {})[ker] = {
+                "lattice": int(lattices[i]),
+                "genvec": [int(x) for x in genvecs[i]],
+                "deformp": [float(x) for x in deformp[i]],
+                "bubbles": float(kern_db[i]/kern_di[i]),
+                "components": kern_comp_names[i]
+            }
 
     # Report the results
     t4 = time.time()
@@ -780,6 +2563,20 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
     log("presampling time:", t3-t2)
     log("integration time:", t4-t3)
 
+    if len(sched.failures) > nfailures0:
+        log(f"worker failures: {', '.join(sched.failures[nfailures0:])}")
+    retried = {}
+    for wname, method, args in sched.retried[nretried0:]:
+        if method in ("integrate", "integrate_shifts", "maxdeformp") and 0 <= args[0] - kernbase < len(kernel2idx):
+            key = f"k{args[0] - kernbase} {method}"
+        else:
+            key = method
+        retried[key] = retried.get(key, 0) + 1
+    if retried:
+        log(f"jobs retried after worker failures: {sum(retried.values())}")
+        for key, n in sorted(retried.items()):
+            log(f"- {key}: {n}")
+
     log(f"per-integral statistics:")
     for f in set(fams):
         mask = np.array([ff == f for ff in fams])
@@ -802,14 +2599,101 @@ async def do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nsh
         }
     }
 
-def default_worker_commands(dirname):
-    ncpu = 0
+async def do_scan(prepared, points, point_cb, coeffsdir, epsabs, epsrel, npresample, npoints0, nshifts, lattice_candidates, standard_lattices, timeout=math.inf, job_time=1.0, cache=None, warmstart=None, lattice_step=None, lattice_cache=None):
+    """
+    Evaluate the integrals at a sequence of points, each given
+    as an (integral valuemap, coefficient valuemap) pair. As
+    many points are evaluated at once as there are slots in the
+    prepared workers; point_cb(i, result) is called as soon as
+    the i-th point is done. The points can be an iterator, and
+    are only consumed as the slots become free.
+
+    Each point is warm-started from the state left in warmstart
+    by the points finished before it; by default a fresh state
+    is used, so consecutive points seed each other.
+    """
+    if warmstart is None: warmstart = {}
+    slots = prepared.slots
+    points = enumerate(points)
+    async def run_slot(slot):
+        for i, (valuemap, valuemap_coeff) in points:
+            log(f"evaluating point {i} in slot {slot}")
+            result = await do_eval(prepared, coeffsdir, epsabs, epsrel, npresample, npoints0, nshifts,
+                lattice_candidates, standard_lattices, valuemap, valuemap_coeff,
+                time.time() + timeout, job_time=job_time, cache=cache, slot=slot, warmstart=warmstart,
+                lattice_step=lattice_step, lattice_cache=lattice_cache)
+            point_cb(i, result)
+    await asyncio.gather(*[run_slot(slot) for slot in range(slots)])
+
+def parse_cpu_list(text):
+    """
+    Parse a Linux CPU list, e.g. "0-3,8-11,16".
+    """
+    result = []
+    for item in text.strip().split(","):
+        if not item: continue
+        if "-" in item:
+            a, b = item.split("-", 1)
+            result.extend(range(int(a), int(b) + 1))
+        else:
+            result.append(int(item))
+    return result
+
+def numa_node_cpu_counts():
+    """
+    Return the number of CPUs available to this process in each
+    NUMA node, or just the total CPU count if the NUMA topology
+    is unknown.
+    """
     try:
-        ncpu = max(1, len(os.sched_getaffinity(0)) - 1)
+        cpus = os.sched_getaffinity(0)
     except AttributeError:
-        ncpu = max(1, os.cpu_count() - 1)
+        return [os.cpu_count()]
+    counts = []
+    try:
+        for node in sorted(os.listdir("/sys/devices/system/node")):
+            if not re.match("^node[0-9]+$", node): continue
+            with open(os.path.join("/sys/devices/system/node", node, "cpulist"), "r") as f:
+                n = len(cpus.intersection(parse_cpu_list(f.read())))
+            if n > 0: counts.append(n)
+    except (OSError, ValueError):
+        return [len(cpus)]
+    return counts if sum(counts) == len(cpus) else [len(cpus)]
+
+def local_worker_threads(nodecpus, ncuda, cpu_threads=None):
+    """
+    Split the CPUs of each NUMA node between the CPU workers,
+    leaving one core to ourselves, and one to drive each GPU;
+    return the thread counts of the CPU workers. If cpu_threads
+    is given, use at most that many threads in total.
+    """
+    nodecpus = list(nodecpus)
+    reserve = 1 + ncuda
+    for i in range(len(nodecpus)):
+        n = min(reserve, nodecpus[i])
+        nodecpus[i] -= n
+        reserve -= n
+    if cpu_threads is None:
+        # Without GPUs, at least one CPU worker.
+        return [n for n in nodecpus if n > 0] or ([] if ncuda > 0 else [1])
+    result = []
+    for n in nodecpus:
+        n = min(n, cpu_threads - sum(result))
+        if n > 0: result.append(n)
+    if not result and cpu_threads > 0:
+        result = [cpu_threads]
+    return result
+
+def default_worker_commands(dirname, cpu_threads=None, gpus=None):
+    """
+    Return the commands of the local workers: one multithreaded
+    CPU worker per NUMA node, and one worker per GPU (at most
+    gpus of them, if given).
+    """
     ncuda = 0
-    if os.path.exists(os.path.join(dirname, "builtin.fatbin")):
+    if gpus == 0:
+        pass
+    elif os.path.exists(os.path.join(dirname, "builtin.fatbin")):
         try:
             p = subprocess.run([os.path.join(contrib_dirname, "bin", "pysecdec_listcuda")], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
             ncuda = len(p.stdout.splitlines())
@@ -817,42 +2701,73 @@ def default_worker_commands(dirname):
             log(f"Can't determine GPU count: {e}")
     else:
         log(f"CUDA worker data was not built, skipping")
-    if ncuda > 0: ncpu = 0
-    log(f"local CPU worker count: {ncpu}, GPU worker count: {ncuda}")
-    return [["nice", sys.executable, "-m", "pySecDecContrib", "pysecdec_cpuworker"]] * ncpu + \
+    if gpus is not None: ncuda = min(ncuda, gpus)
+    nodecpus = local_worker_threads(numa_node_cpu_counts(), ncuda, cpu_threads)
+    log(f"local CPU worker threads: {'+'.join(map(str, nodecpus)) or 0}, GPU worker count: {ncuda}")
+    return [["nice", sys.executable, "-m", "pySecDecContrib", "pysecdec_cpuworker", "-t", str(n)] for n in nodecpus] + \
         [["nice", sys.executable, "-m", "pySecDecContrib", "pysecdec_cudaworker", "-d", str(i)] for i in range(ncuda)]
 
-def load_worker_commands(jsonfile, dirname):
+def default_coefficient_commands(count=2):
+    """
+    Return the commands of count local coefficient workers.
+    """
+    return [["nice", sys.executable, "-m", "pySecDecContrib", "pysecdec_coeffworker"]] * count
+
+def parse_worker_list(entries):
+    workers = []
+    for w in entries:
+        cmd = w["command"] if "command" in w else {"connect": w["connect"]}
+        workers.extend([cmd] * w.get("count", 1))
+    return workers
+
+def read_cluster_file(jsonfile, key="cluster"):
+    """
+    Return the worker commands listed under the given key of the
+    cluster file: "cluster" for the integration workers, and
+    "coefficients" for the coefficient ones.
+    """
+    with open(jsonfile, "r") as f:
+        cluster_json = json.load(f)
+    if not isinstance(cluster_json, dict) or not isinstance(cluster_json.get(key), list):
+        raise ValueError(f"expected a \"{key}\" list")
+    return parse_worker_list(cluster_json[key])
+
+def load_worker_commands(jsonfile, dirname, cpu_threads=None, gpus=None):
     try:
-        with open(jsonfile, "r") as f:
-            cluster_json = json.load(f)
-            assert "cluster" in cluster_json
-            assert isinstance(cluster_json["cluster"], list)
-            log(f"Using cluster configuration from {jsonfile!r}")
-            workers = []
-            for w in cluster_json["cluster"]:
-                workers.extend([w["command"]] * w.get("count", 1))
-            return workers
+        workers = read_cluster_file(jsonfile)
+        log(f"Using cluster configuration from {jsonfile!r}")
+        return workers
     except FileNotFoundError:
         log(f"Can't find {jsonfile}; will run locally")
-    return default_worker_commands(dirname)
-
-def split_integral_into_orders(orders, ampid, kernel2idx, info, br_coef, valmap, sp_regulators, requested_orders):
-    br_pref = info["expanded_prefactor_value"]
-    br_pref_coef_leading_orders = np.min([o for o in br_pref.keys()],axis=0) + np.min([o for o in br_coef.keys()],axis=0)
-    kern_leading_orders = np.min([o["regulator_powers"] for o in info["orders"]], axis=0)
-    kern_highest_orders = np.max([o["regulator_powers"] for o in info["orders"]], axis=0)
-    max_highest_orders = br_pref_coef_leading_orders + kern_highest_orders
-    prefactor = bracket_mul(br_pref, br_coef, -kern_leading_orders + requested_orders)
-    for o in info["orders"]:
-        powers = np.array(o["regulator_powers"])
-        for pow, coef in prefactor.items():
-            p = powers + pow
-            if np.all(p <= requested_orders) & np.all(p <= max_highest_orders): # truncate expansion at highest known order
-                key = (ampid, tuple(p.tolist()))
-                orders.setdefault(key, np.zeros(len(kernel2idx), dtype=np.complex128))
-                for k in o["kernels"]:
-                    orders[key][kernel2idx[info["name"], k]] += coef
+    return default_worker_commands(dirname, cpu_threads=cpu_threads, gpus=gpus)
+
+def load_coefficient_commands(jsonfile, count=2):
+    try:
+        with open(jsonfile, "r") as f:
+            has_list = "coefficients" in json.load(f)
+    except FileNotFoundError:
+        has_list = False
+    if has_list:
+        return read_cluster_file(jsonfile, key="coefficients")
+    return default_coefficient_commands(count)
+
+def encode_valuemap(valuemap):
+    return {k: [float(np.real(v)), float(np.imag(v))] for k, v in sorted(valuemap.items())}
+
+def save_json(filename, data):
+    # Write to a temporary file first, so that an interrupted
+    # write never leaves a truncated file behind.
+    with open(filename + ".tmp", "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+def load_warm_start(filename):
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        log(f"Can't find {filename}; will start cold")
+        return {}
 
 def parse_array_shorthand(text):
     """
@@ -874,6 +2789,41 @@ def parse_array_shorthand(text):
             result.append(float(item))
     return result
 
+def parse_value(value):
+    value = complex(value)
+    return value.real if value.imag == 0 else value
+
+def split_valuemap(values):
+    """
+    Split a map of variable values into the integral and the
+    coefficient maps, following the "int-" and "coeff-" prefixes.
+    """
+    valuemap = {}
+    valuemap_coeff = {}
+    valuemap_int = {}
+    for key, value in values.items():
+        if key.startswith("coeff-"):
+            valuemap_coeff[key[6:]] = value
+        elif key.startswith("int-"):
+            valuemap_int[key[4:]] = value
+        else:
+            valuemap[key] = value
+    return {**valuemap, **valuemap_int}, {**valuemap, **valuemap_coeff}
+
+def read_scan_points(f):
+    """
+    Read the points of a scan, either from a CSV file with a
+    header line of variable names, or from a JSONL file with one
+    object per line; yield a map of variable values per point.
+    """
+    first = f.readline()
+    if first.lstrip().startswith("{"):
+        for line in itertools.chain([first], f):
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(itertools.chain([first], f), skipinitialspace=True)
+
 def parse_unit(text, units):
     for unit, magnitude in units.items():
         if text.endswith(unit):
@@ -914,11 +2864,33 @@ def result_to_mathematica(result):
     text.append("}")
     return "".join(text)
 
+def scan_main(loop, prepared, scanfile, scanoutput, values, result_format, coeffsdir, epsabs, epsrel, npresamples, npoints, nshifts, lattice_candidates, standard_lattices, timeout, job_time, cache, warmstart, lattice_step, lattice_cache):
+    infile = sys.stdin if scanfile == "-" else open(scanfile, "r")
+    outfile = sys.stdout if scanoutput is None else open(scanoutput, "w")
+    rows = []
+    def points():
+        for row in read_scan_points(infile):
+            rows.append(row)
+            yield split_valuemap({**values, **{k: parse_value(v) for k, v in row.items()}})
+    def point_cb(i, result):
+        if result_format == "mathematica":
+            result = result_to_mathematica(result)
+        elif result_format != "json":
+            result = result_to_sympy(result)
+        outfile.write(json.dumps({"point": i, "values": rows[i], "result": result}) + "\n")
+        outfile.flush()
+        log(f"point {i} done")
+    try:
+        loop.run_until_complete(do_scan(prepared, points(), point_cb, coeffsdir, epsabs, epsrel,
+            npresamples, npoints, nshifts, lattice_candidates, standard_lattices,
+            timeout=timeout, job_time=job_time, cache=cache, warmstart=warmstart, lattice_step=lattice_step, lattice_cache=lattice_cache))
+    finally:
+        if infile is not sys.stdin: infile.close()
+        if outfile is not sys.stdout: outfile.close()
+
 def main():
 
-    valuemap = {}
-    valuemap_coeff = {}
-    valuemap_int = {}
+    values = {}
     npoints = 10**4
     npresamples = 10**4
     epsabs = [1e-10]
@@ -926,28 +2898,78 @@ def main():
     result_format = "sympy"
     nshifts = 32
     clusterfile = None
+    localcpus = None
+    localgpus = None
+    gpu_lattice = None
+    watchinterval = None
     coeffsdir = None
+    ncoeffworkers = 2
     lattice_candidates = 0
     standard_lattices = False
-    deadline = math.inf
+    timeout = math.inf
+    protocol = "binary"
+    scheduler = "random"
+    relaunch = True
+    heartbeat = 300
+    job_time = 1.0
+    cachedir = None
+    cachesize = 10**6
+    scanfile = None
+    scanoutput = None
+    parallel_points = 4
+    warmstartfile = None
+    checkpointfile = None
+    resumefile = None
+    calibrationfile = default_calibration_file()
+    calibrationttl = 24*60*60
+    lattice_step = None
+    lattice_cache = default_lattice_cache
+    metricsfile = None
+    metricsinterval = 10
+    tracefile = None
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["cluster=", "coefficients=", "epsabs=", "epsrel=", "format=", "points=", "presamples=", "shifts=", "lattice-candidates=", "standard-lattices=", "timeout=", "help"])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["cluster=", "local-cpus=", "local-gpus=", "gpu-lattice=", "watch-cluster=", "coefficients=", "coefficient-workers=", "epsabs=", "epsrel=", "format=", "points=", "presamples=", "shifts=", "job-time=", "lattice-candidates=", "lattice-step=", "lattice-cache=", "standard-lattices=", "timeout=", "protocol=", "scheduler=", "relaunch=", "heartbeat=", "calibration=", "calibration-ttl=", "cache=", "cache-size=", "scan=", "scan-output=", "parallel-points=", "warm-start=", "checkpoint=", "resume=", "metrics=", "metrics-interval=", "trace=", "help"])
     except getopt.GetoptError as e:
         print(e, file=sys.stderr)
         print("use --help to see the usage", file=sys.stderr)
         exit(1)
     for key, value in opts:
         if key == "--cluster": clusterfile = value
+        elif key == "--local-cpus": localcpus = int(value)
+        elif key == "--local-gpus": localgpus = int(value)
+        elif key == "--gpu-lattice": gpu_lattice = int(float(value))
+        elif key == "--watch-cluster": watchinterval = None if value.lower() == "no" else parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
         elif key == "--coefficients": coeffsdir = value
+        elif key == "--coefficient-workers": ncoeffworkers = int(value)
         elif key == "--epsabs": epsabs = parse_array_shorthand(value)
         elif key == "--epsrel": epsrel = parse_array_shorthand(value)
         elif key == "--format": result_format = value
         elif key == "--points": npoints = int(float(value))
         elif key == "--presamples": npresamples = int(float(value))
         elif key == "--shifts": nshifts = int(float(value))
-        elif key == "--timeout": deadline = time.time() + parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
+        elif key == "--timeout": timeout = parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
         elif key == "--lattice-candidates": lattice_candidates = int(float(value))
+        elif key == "--lattice-step": lattice_step = float(value)
+        elif key == "--lattice-cache": lattice_cache = value
         elif key == "--standard-lattices": standard_lattices = value.lower() == "yes"
+        elif key == "--protocol": protocol = value
+        elif key == "--scheduler": scheduler = value
+        elif key == "--relaunch": relaunch = value.lower() == "yes"
+        elif key == "--heartbeat": heartbeat = parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
+        elif key == "--calibration": calibrationfile = None if value.lower() == "none" else value
+        elif key == "--calibration-ttl": calibrationttl = parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
+        elif key == "--cache": cachedir = value
+        elif key == "--cache-size": cachesize = int(float(value))
+        elif key == "--scan": scanfile = value
+        elif key == "--scan-output": scanoutput = value
+        elif key == "--parallel-points": parallel_points = int(float(value))
+        elif key == "--warm-start": warmstartfile = value
+        elif key == "--checkpoint": checkpointfile = value
+        elif key == "--resume": resumefile = value
+        elif key == "--metrics": metricsfile = value
+        elif key == "--metrics-interval": metricsinterval = parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
+        elif key == "--trace": tracefile = value
+        elif key == "--job-time": job_time = parse_unit(value, {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60})
         elif key == "--help":
             print(__doc__.strip())
             exit(0)
@@ -967,21 +2989,37 @@ def main():
     log(f"- points = {npoints}")
     log(f"- presamples = {npresamples}")
     log(f"- shifts = {nshifts}")
+    log(f"- job-time = {job_time}")
     log(f"- lattice-candidates = {lattice_candidates}")
+    log(f"- lattice-step = {lattice_step}")
+    log(f"- lattice-cache = {lattice_cache}")
+    log(f"- protocol = {protocol}")
+    log(f"- scheduler = {scheduler}")
+    log(f"- gpu-lattice = {gpu_lattice}")
+    log(f"- relaunch = {relaunch}")
+    log(f"- watch-cluster = {watchinterval}")
+    log(f"- heartbeat = {heartbeat}")
+    log(f"- calibration = {calibrationfile}")
+    log(f"- cache = {cachedir}")
+    log(f"- warm-start = {warmstartfile}")
+    if resumefile is not None:
+        if checkpointfile is None: checkpointfile = resumefile
+        log(f"- resume = {resumefile}")
+    log(f"- checkpoint = {checkpointfile}")
+    log(f"- metrics = {metricsfile}")
+    log(f"- trace = {tracefile}")
+    if scanfile is not None and checkpointfile is not None:
+        log("Scans can not be checkpointed")
+        exit(1)
+    if scanfile is not None:
+        log(f"- scan = {scanfile}")
+        log(f"- parallel-points = {parallel_points}")
     for arg in args[1:]:
         if "=" not in arg: raise ValueError(f"Bad argument: {arg}")
         key, value = arg.split("=", 1)
-        value = complex(value)
-        value = value.real if value.imag == 0 else value
-        if key.startswith("coeff-"):
-            valuemap_coeff[key[6:]] = value
-        elif key.startswith("int-"):
-            valuemap_int[key[4:]] = value
-        else:
-            valuemap[key] = value
-    valuemap_int = {**valuemap, **valuemap_int}
-    valuemap_coeff = {**valuemap, **valuemap_coeff}
-    log("Invariants:")
+        values[key] = parse_value(value)
+    valuemap_int, valuemap_coeff = split_valuemap(values)
+    log("Invariants:" if scanfile is None else "Invariants common to all points:")
     for key, value in valuemap_int.items():
         if valuemap_coeff.get(key, None) == value:
             log(f"- {key} = {value}")
@@ -993,15 +3031,50 @@ def main():
             log(f"- coefficient {key} = {value}")
 
     # Load worker list
-    workers = load_worker_commands(clusterfile, dirname)
+    workers = load_worker_commands(clusterfile, dirname, cpu_threads=localcpus, gpus=localgpus)
     if len(workers) == 0:
         log("No workers defined")
         exit(1)
+    coefficient_workers = load_coefficient_commands(clusterfile, ncoeffworkers)
+
+    warmstart = None
+    if warmstartfile is not None:
+        warmstart = load_warm_start(warmstartfile)
+    resume = None
+    if resumefile is not None:
+        with open(resumefile, "r") as f:
+            resume = json.load(f)
 
     # Begin evaluation
+    cache = ResultCache(cachedir, cachesize) if cachedir is not None else None
+    calibration = CalibrationCache(calibrationfile, calibrationttl) if calibrationfile is not None else None
+    metrics = Metrics(trace=tracefile is not None) if metricsfile is not None or tracefile is not None else None
     loop = asyncio.get_event_loop()
-    prepared = loop.run_until_complete(prepare_eval(workers, dirname, intfile))
-    result = loop.run_until_complete(do_eval(prepared, coeffsdir, epsabs, epsrel, npresamples, npoints, nshifts, lattice_candidates, standard_lattices, valuemap_int, valuemap_coeff, deadline))
+    slots = 1 if scanfile is None else max(1, parallel_points)
+    prepared = loop.run_until_complete(prepare_eval(workers, dirname, intfile, protocol=protocol, scheduler=scheduler, slots=slots, relaunch=relaunch, heartbeat=heartbeat, calibration=calibration, metrics=metrics, gpu_lattice=gpu_lattice, coefficient_workers=coefficient_workers))
+    if watchinterval is not None:
+        prepared.pool.start_watching(clusterfile, watchinterval)
+    if metricsfile is not None:
+        metrics_task = loop.create_task(metrics.write_snapshots(metricsfile, metricsinterval))
+    def finish():
+        if cache is not None:
+            cache.close()
+        if warmstart is not None:
+            save_json(warmstartfile, warmstart)
+        if metricsfile is not None:
+            metrics_task.cancel()
+            metrics.save_snapshot(metricsfile)
+            log(f"useful worker time: {100*metrics.snapshot()['useful_fraction']:.1f}%, metrics saved to {metricsfile}")
+        if tracefile is not None:
+            metrics.save_trace(tracefile)
+            log(f"job timeline saved to {tracefile}")
+    if scanfile is not None:
+        scan_main(loop, prepared, scanfile, scanoutput, values, result_format, coeffsdir, epsabs, epsrel,
+            npresamples, npoints, nshifts, lattice_candidates, standard_lattices, timeout, job_time, cache, warmstart, lattice_step, lattice_cache)
+        finish()
+        return
+    result = loop.run_until_complete(do_eval(prepared, coeffsdir, epsabs, epsrel, npresamples, npoints, nshifts, lattice_candidates, standard_lattices, valuemap_int, valuemap_coeff, time.time() + timeout, job_time=job_time, cache=cache, warmstart=warmstart, checkpoint=checkpointfile, resume=resume, lattice_step=lattice_step, lattice_cache=lattice_cache))
+    finish()
 
     # Report the result
     if result_format == "json":
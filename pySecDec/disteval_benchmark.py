@@ -8,6 +8,9 @@ Usage:
 Options:
     --points=X          evaluate using this many points per batch (default: 1e5)
     --repetitions=X     repeat the measurement this many times (default: 10)
+    --protocol=X        talk to the worker using this protocol ("binary", "json")
+    --rpc=X             instead of the kernels, benchmark the RPC overhead
+                        of each protocol using X calls per measurement
     --help              show this help message
 Arguments:
     <var>=X             set this integral or coefficient variable to a given value
@@ -20,145 +23,64 @@ import math
 import numpy as np
 import os
 import random
-import re
 import subprocess
 import sympy as sp
 import sys
 import time
 
+from .disteval import launch_worker, log, encode_binary_message, encode_message
 from .generating_vectors import generating_vector, max_lattice_size
 
 from pySecDecContrib import dirname as contrib_dirname
 
-log_starttime = time.time()
-def log(*args):
-    t = time.time() - log_starttime
-    if t < 60:
-        print(f"{t:.3f}]", *args, file=sys.stderr)
-    else:
-        m, s = divmod(t, 60)
-        if m < 60:
-            print(f"{m:.0f}:{s:06.3f}]", *args, file=sys.stderr)
-        else:
-            h, m = divmod(m, 60)
-            print(f"{h:.0f}:{m:02.0f}:{s:06.3f}]", *args, file=sys.stderr)
-    sys.stderr.flush()
-
-# Generic RPC
-
-def encode_message(data):
-    return json.dumps(data,separators=(',',':')).encode("ascii") + b"\n"
-
-def decode_message(binary):
-    return json.loads(binary[1:])
-
-class WorkerException(Exception):
-    pass
-
-class Worker:
-
-    def __init__(self, process, name=None):
-        self.name = name
-        self.process = process
-        self.serial = 0
-        self.callbacks = {}
-        self.reader_task = asyncio.get_event_loop().create_task(self._reader())
-
-    def queue_size(self):
-        return len(self.callbacks)
-
-    def call_cb(self, method, args, callback, callback_args=()):
-        token = self.serial = self.serial + 1
-        self.callbacks[token] = (callback, callback_args)
-        message = encode_message((token, method, args))
-        self.process.stdin.write(message)
-        return token
-    
-    def cancel_cb(self, token):
-        if token in self.callbacks:
-            self.callbacks[token] = (lambda a,b,c:None, ())
-
-    def call(self, method, *args):
-        fut = asyncio.futures.Future()
-        def call_return(result, error, w):
-            if error is None: fut.set_result(result)
-            else: fut.set_exception(WorkerException(error))
-        self.call_cb(method, args, call_return)
-        return fut
-    
-    def multicall(self, calls):
-        fut = asyncio.futures.Future()
-        results = [None]*len(calls)
-        ntodo = [len(calls)]
-        def multicall_return(result, error, w, i):
-            if error is None:
-                results[i] = result
-                ntodo[0] -= 1
-                if ntodo[0] == 0:
-                    fut.set_result(results)
-            else:
-                fut.set_exception(WorkerException(error))
-        s0 = self.serial
-        self.serial += len(calls)
-        parts = []
-        for i, (method, args) in enumerate(calls):
-            parts.append(encode_message((s0 + i, method, args)))
-            self.callbacks[s0 + i] = (multicall_return, (i,))
-        self.process.stdin.write(b"".join(parts))
-        return fut
-
-    async def _reader(self):
-        rx = re.compile(b"^@([a-zA-Z0-9_]+)(?: ([^\\n]*))?\n$")
-        line = None
-        try:
-            while True:
-                line = await self.process.stdout.readline()
-                if len(line) == 0: break
-                if line.startswith(b"@"):
-                    i, res, err = decode_message(line)
-                    callback, callback_args = self.callbacks[i]
-                    del self.callbacks[i]
-                    callback(res, err, self, *callback_args)
-                else:
-                    log(f"{self.name}: {line}")
-        except Exception as e:
-            log(f"{self.name} reader failed: {type(e).__name__}: {e}")
-            log(f"{self.name} line was {line!r}")
-        log(f"{self.name} reader exited")
+# Main
 
-async def launch_worker(command, dirname, maxtimeout=10):
-    timeout = min(1, maxtimeout/10)
-    while True:
-        log(f"running: {command}")
-        if isinstance(command, str):
-            p = await asyncio.create_subprocess_shell(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+async def rpcbenchmark(workercmd, datadir, ncalls, nreps):
+    """
+    Measure the round-trip latency of "ping", and the rate of
+    empty "integrate" calls (all pipelined), for each of the
+    worker protocols.
+    """
+    results = []
+    dim = 2
+    lattice, genvec = generating_vector(dim, 1000)
+    shift = [random.random() for i in range(dim)]
+    deformp = [1.0, 1.0]
+    args = (0, lattice, 0, 1, genvec, shift, deformp)
+    for protocol in ("json", "binary"):
+        w = await launch_worker(workercmd, datadir, protocol=protocol)
+        if w.protocol != protocol:
+            log(f"worker does not support the {protocol} protocol, skipping")
+            continue
+        await w.call("family", 0, "builtin", dim, (2.0, 0.1, 0.2, 0.3), (), True)
+        await w.call("kernel", 0, 0, "gauge")
+        if protocol == "binary":
+            nbytes = len(encode_binary_message(1, "integrate", args))
         else:
-            p = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        p.stdin.write(encode_message((0, "start", (dirname,))))
-        answer = await p.stdout.readline()
-        try:
-            _, name, err = decode_message(answer)
-            if err is not None:
-                log(f"worker startup fail: {err}")
-            else:
-                w = Worker(p, name=name)
-                log(f"worker {w.name} connected")
-                return w
-        except Exception as e:
-            log(f"failed to start worker: {type(e).__name__}: {e}")
-        try:
-            p.stdin.close()
-            p.kill()
-        except ProcessLookupError:
-            pass
-        log(f"will retry after {timeout}s")
-        await asyncio.sleep(timeout)
-        timeout = min(timeout*2, maxtimeout)
-
+            nbytes = len(encode_message((1, "integrate", args)))
+        latency = np.zeros(nreps)
+        rate = np.zeros(nreps)
+        for i in range(nreps):
+            t0 = time.time()
+            for j in range(ncalls):
+                await w.call("ping")
+            latency[i] = (time.time() - t0)/ncalls
+            t0 = time.time()
+            await asyncio.gather(*[w.call("integrate", *args) for j in range(ncalls)])
+            rate[i] = ncalls/(time.time() - t0)
+        w.process.stdin.close()
+        await w.process.wait()
+        lat, laterr = float(np.mean(latency)), float(np.std(latency))/math.sqrt(nreps)
+        r, rerr = float(np.mean(rate)), float(np.std(rate))/math.sqrt(nreps)
+        log(f"{protocol}: ping in {lat:.3e} ± {laterr:.1e}s, {r:.3e} ± {rerr:.1e} calls/s, {nbytes} bytes per call")
+        results.append((protocol, lat, laterr, r, rerr, nbytes))
 
-# Main
+    # Print the final statistics
+    print("protocol,latency,latency_error,rate,rate_error,bytes")
+    for result in results:
+        print(",".join(map(str, result)))
 
-async def dobenchmark(workercmd, datadir, intfile, valuemap, npoints, nreps):
+async def dobenchmark(workercmd, datadir, intfile, valuemap, npoints, nreps, protocol="binary"):
     # Load the integrals from the requested json file
     with open(intfile, "r") as f:
         info = json.load(f)
@@ -203,7 +125,7 @@ async def dobenchmark(workercmd, datadir, intfile, valuemap, npoints, nreps):
     family2idx = {fam:i for i, fam in enumerate(infos.keys())}
 
     # Launch the worker
-    w = await launch_worker(workercmd, datadir)
+    w = await launch_worker(workercmd, datadir, protocol=protocol)
     await w.call("family", 0, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)
     await w.call("kernel", 0, 0, "gauge")
     await w.multicall([
@@ -247,8 +169,10 @@ def main():
     valuemap = {}
     npoints = 10**5
     nreps = 10
+    protocol = "binary"
+    rpc_calls = 0
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["points=", "repetitions=", "help"])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["points=", "repetitions=", "protocol=", "rpc=", "help"])
     except getopt.GetoptError as e:
         print(e, file=sys.stderr)
         print("use --help to see the usage", file=sys.stderr)
@@ -258,6 +182,10 @@ def main():
             npoints = int(float(value))
         elif key == "--repetitions":
             nreps = int(float(value))
+        elif key == "--protocol":
+            protocol = value
+        elif key == "--rpc":
+            rpc_calls = int(float(value))
         elif key == "--help":
             print(__doc__.strip())
             exit(0)
@@ -270,6 +198,7 @@ def main():
     log(f"- file = {intfile}")
     log(f"- points = {npoints}")
     log(f"- repetitions = {nreps}")
+    log(f"- protocol = {protocol}")
     for arg in args[1:]:
         if "=" not in arg: raise ValueError(f"Bad argument: {arg}")
         key, value = arg.split("=", 1)
@@ -300,7 +229,10 @@ def main():
 
     # Run the benchmark
     loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(dobenchmark(worker, dirname, intfile, valuemap, npoints, nreps))
+    if rpc_calls > 0:
+        loop.run_until_complete(rpcbenchmark(worker, dirname, rpc_calls, nreps))
+    else:
+        loop.run_until_complete(dobenchmark(worker, dirname, intfile, valuemap, npoints, nreps, protocol=protocol))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Compile the amplitude coefficients of a disteval sum package into
+numeric code, so that disteval can evaluate them at each point
+directly, instead of asking a worker to expand them in the
+regulators with GiNaC every time.
+Usage:
+    python3 -m pySecDec.disteval_coefficients sum.json [options]
+Options:
+    --coefficients=X    compile the coefficients in this directory
+                        (default: the coefficients/ directory next to sum.json)
+    --force             recompile the coefficients even if up to date
+    --help              show this help message
+For each coefficient file X, the code is stored in X.compiled.json.
+"""
+
+import getopt
+import hashlib
+import json
+import numpy as np
+import os
+import random
+import re
+import sympy as sp
+import sys
+
+COMPILED_SUFFIX = ".compiled.json"
+
+# GiNaC function and constant names, as known to sympy.
+GINAC_NAMES = {
+    "sqrt": sp.sqrt, "exp": sp.exp, "log": sp.log,
+    "sin": sp.sin, "cos": sp.cos, "tan": sp.tan,
+    "Pi": sp.pi, "Euler": sp.EulerGamma, "I": sp.I
+}
+
+def coefficient_orders(intinfo, requested_orders):
+    """
+    Return the regulator orders up to which a coefficient of the
+    given integral is needed.
+    """
+    pref_lord = np.min([o["regulator_powers"] for o in intinfo["expanded_prefactor"]], axis=0)
+    kern_lord = np.min([o["regulator_powers"] for o in intinfo["orders"]], axis=0)
+    return - kern_lord - pref_lord + requested_orders
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+def parse_ginac(text):
+    """
+    Parse a GiNaC expression into sympy; return the expression
+    and the list of its symbol names.
+    """
+    names = set(
+        m.group(1)
+        for m in re.finditer(r"(?<![\w.])([a-zA-Z_][a-zA-Z_0-9]*)(\s*\()?", text)
+        if m.group(2) is None
+    ) - set(GINAC_NAMES)
+    symbols = {name: sp.Symbol(name) for name in names}
+    expr = sp.sympify(text.replace("^", "**"), locals={**GINAC_NAMES, **symbols})
+    return expr, sorted(str(s) for s in expr.free_symbols)
+
+def is_zero(expr, symbols, tries=2):
+    # Zero at several random rational points: assume identically so.
+    for i in range(tries):
+        point = {s: sp.Rational(random.randint(1, 2**30), random.randint(1, 2**30)) for s in symbols}
+        try:
+            if expr.subs(point) != 0: return False
+        except (ZeroDivisionError, TypeError):
+            return False
+    return True
+
+def expand_orders(expr, regulators, orders):
+    """
+    Expand the expression in each of the regulators in turn, up to
+    the given orders, as GiNaC's series() does in the workers;
+    return a {powers tuple: coefficient} dictionary.
+    """
+    if len(regulators) == 0:
+        return {(): expr}
+    x, order = regulators[0], int(orders[0])
+    series = sp.series(expr, x, 0, order + 1).removeO() if expr.has(x) else expr
+    terms = {}
+    for term in sp.Add.make_args(series):
+        coef, power = term.as_coeff_exponent(x)
+        if coef.has(x):
+            raise ValueError(f"can't expand the coefficient in {x}: {term}")
+        terms[int(power)] = terms.get(int(power), 0) + coef
+    result = {}
+    for power, coef in sorted(terms.items()):
+        for powers, c in expand_orders(coef, regulators[1:], orders[1:]).items():
+            result[(power,) + powers] = c
+    return result
+
+def compile_coefficient(text, regulators, orders):
+    """
+    Expand a coefficient in the regulators up to the given orders,
+    and compile the non-zero terms into a Python function of the
+    parameters (with common subexpressions eliminated). Return a
+    dict to be saved in the .compiled.json file.
+    """
+    expr, names = parse_ginac(text)
+    regs = [sp.Symbol(r) for r in regulators]
+    parameters = [n for n in names if n not in regulators]
+    psymbols = [sp.Symbol(n) for n in parameters]
+    terms = expand_orders(expr, regs, orders)
+    terms = {p: c for p, c in terms.items() if not is_zero(c, psymbols)}
+    args = [sp.Symbol(f"_p{i}") for i in range(len(parameters))]
+    exprs = [c.subs(dict(zip(psymbols, args)), simultaneous=True) for c in terms.values()]
+    subexprs, exprs = sp.cse(exprs, symbols=sp.numbered_symbols("_t"))
+    printer = sp.printing.numpy.NumPyPrinter({"fully_qualified_modules": True})
+    code = [f"def coefficient({', '.join(str(a) for a in args)}):"]
+    for sym, sub in subexprs:
+        code.append(f"    {sym} = {printer.doprint(sub)}")
+    code.append(f"    return [{', '.join(printer.doprint(e) for e in exprs)}]")
+    return {
+        "source_hash": text_hash(text),
+        "regulators": list(regulators),
+        "orders": [int(o) for o in orders],
+        "parameters": parameters,
+        "powers": [list(p) for p in terms.keys()],
+        "code": "\n".join(code) + "\n"
+    }
+
+class CompiledCoefficient:
+    """
+    A coefficient loaded from a .compiled.json file.
+    """
+
+    def __init__(self, data):
+        self.regulators = data["regulators"]
+        self.orders = np.array(data["orders"])
+        self.parameters = data["parameters"]
+        self.powers = [tuple(p) for p in data["powers"]]
+        namespace = {"numpy": np}
+        exec(compile(data["code"], "<coefficient>", "exec"), namespace)
+        self.function = namespace["coefficient"]
+
+    def __call__(self, valuemap, orders):
+        """
+        Return the {powers: value} expansion of the coefficient
+        at the given parameter values, up to the given orders.
+        """
+        for p in self.parameters:
+            if p not in valuemap:
+                raise ValueError(f"missing coefficient parameter: {p}")
+        values = self.function(*[complex(valuemap[p]) for p in self.parameters])
+        return {
+            p: complex(v)
+            for p, v in zip(self.powers, values)
+            if all(a <= b for a, b in zip(p, orders))
+        }
+
+_compiled_cache = {}
+
+def load_compiled_coefficient(filename, regulators, orders):
+    """
+    Return the compiled form of the coefficient in the given file,
+    or None if there is none that is up to date, and that covers
+    the given regulators and orders.
+    """
+    try:
+        cfile = filename + COMPILED_SUFFIX
+        key = (cfile, os.stat(cfile).st_mtime_ns, os.stat(filename).st_mtime_ns)
+        if key not in _compiled_cache:
+            with open(cfile, "r") as f:
+                data = json.load(f)
+            with open(filename, "r") as f:
+                uptodate = data["source_hash"] == text_hash(f.read())
+            _compiled_cache[key] = CompiledCoefficient(data) if uptodate else None
+        cc = _compiled_cache[key]
+    except (OSError, ValueError, KeyError):
+        return None
+    if cc is None or cc.regulators != list(regulators) or np.any(cc.orders < orders):
+        return None
+    return cc
+
+def compile_sum_coefficients(sumfile, coeffsdir, force=False):
+    """
+    Compile all the coefficients of a sum package, skipping those
+    that are already compiled for the current source.
+    """
+    dirname = os.path.dirname(sumfile)
+    with open(sumfile, "r") as f:
+        info = json.load(f)
+    if info["type"] != "sum":
+        raise ValueError(f"only sums have coefficients, got {info['type']}")
+    infos = {}
+    for i in info["integrals"]:
+        with open(os.path.join(dirname, f"{i}.json"), "r") as f:
+            infos[i] = json.load(f)
+    sums = info["sums"].values() if isinstance(info["sums"], dict) else info["sums"]
+    for terms in sums:
+        for t in terms:
+            filename = os.path.join(coeffsdir, t["coefficient"])
+            orders = coefficient_orders(infos[t["integral"]], info["requested_orders"])
+            if not force and load_compiled_coefficient(filename, info["regulators"], orders) is not None:
+                print(f"{filename}: up to date", file=sys.stderr)
+                continue
+            with open(filename, "r") as f:
+                text = f.read()
+            data = compile_coefficient(text, info["regulators"], orders)
+            with open(filename + COMPILED_SUFFIX + ".tmp", "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(filename + COMPILED_SUFFIX + ".tmp", filename + COMPILED_SUFFIX)
+            print(f"{filename}: compiled {len(data['powers'])} orders", file=sys.stderr)
+
+def main():
+    coeffsdir = None
+    force = False
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["coefficients=", "force", "help"])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        print("use --help to see the usage", file=sys.stderr)
+        exit(1)
+    for key, value in opts:
+        if key == "--coefficients": coeffsdir = value
+        elif key == "--force": force = True
+        elif key == "--help":
+            print(__doc__.strip())
+            exit(0)
+    if len(args) != 1:
+        print(__doc__.strip(), file=sys.stderr)
+        exit(1)
+    if coeffsdir is None: coeffsdir = os.path.join(os.path.dirname(args[0]), "coefficients")
+    compile_sum_coefficients(args[0], coeffsdir, force=force)
+
+if __name__ == "__main__":
+    main()
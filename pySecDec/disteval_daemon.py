@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+A persistent worker daemon for disteval. Listen on a TCP or a
+Unix socket, and serve each connection with a worker process,
+exactly as if disteval has started the worker itself. The
+workers are kept running between the connections, so that the
+following evaluations of the same integrals skip the worker
+start up and the loading of the integral libraries.
+Usage:
+    python3 -m pySecDec.disteval_daemon [options] [worker command ...]
+Options:
+    --listen=X          listen on this address, "host:port" or "unix:path"
+                        (default: localhost:7300)
+    --allow-remote      allow listening on a non-loopback address
+    --data-dir=X        only serve the integrals in this directory or below
+                        it (may be repeated; default: any directory)
+    --max-idle=X        keep at most this many idle workers (default: 16)
+    --help              show this help message
+Arguments:
+    worker command      start the workers with this command
+                        (default: python3 -m pySecDecContrib pysecdec_cpuworker)
+To use the daemon, list it in cluster.json, once per worker:
+    {"cluster": [{"connect": "host:7300", "count": 4}]}
+Security:
+    The clients name the integral libraries that the workers load
+    and run, so anyone who can connect to the daemon can run any
+    code as the user running it. By default it only listens on the
+    loopback interface, which still lets every local user in; use
+    a Unix socket with restricted permissions on shared machines,
+    and --data-dir to limit which libraries can be loaded. Use
+    --allow-remote only on a trusted network.
+"""
+
+import asyncio
+import getopt
+import glob
+import ipaddress
+import json
+import os
+import subprocess
+import sys
+
+from .disteval import FRAME_HEADER, METHOD_JSON, REPLY_JSON, decode_binary_reply, encode_binary_message, encode_message, log
+
+# The token of the message used to wait until a worker has
+# finished all the jobs of a disconnected client.
+BARRIER_TOKEN = 2**62
+
+# The calls that set up a worker; if a new client repeats the
+# calls already done by an idle worker, they are answered here
+# with the replies the worker gave to them.
+SETUP_METHODS = ("family", "kernel")
+
+def library_stamp(dirname, family):
+    """
+    Return the names, sizes, and modification times of the files
+    of a family in the given directory (all its library variants,
+    e.g. "name.so" and "name.avx2.so"), so that a rebuilt library
+    would not be taken for the one an idle worker has loaded.
+    """
+    name = family.split("@")[0]
+    stamp = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(dirname), glob.escape(name) + ".*"))):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stamp.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+    return stamp
+
+def setup_key(dirname, method, args):
+    """
+    The key identifying a setup call (see SETUP_METHODS): the
+    call itself, and for "family", the stamp of its library.
+    """
+    stamp = library_stamp(dirname, args[1]) if method == "family" else None
+    return json.dumps([method, args, stamp])
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+class DaemonWorker:
+    def __init__(self, process, startkey, startreply, protocol):
+        self.process = process
+        self.startkey = startkey
+        self.startreply = startreply
+        self.protocol = protocol
+        self.setup = [] # setup_key() of each setup call done
+        self.replies = [] # [result, error] of each setup call, or None until known
+        self.pending = {} # token -> index in setup, of the setup calls sent for the client
+        self.client = None
+        self.swallow = 0
+        self.barrier = None
+        self.nbarrier = 0 # barrier replies still expected
+        self.pump_task = asyncio.get_event_loop().create_task(self._pump())
+
+    def alive(self):
+        return self.process.returncode is None and not self.pump_task.done()
+
+    def send(self, token, method, args):
+        if self.protocol == "binary":
+            self.process.stdin.write(encode_binary_message(token, method, args))
+        else:
+            self.process.stdin.write(encode_message((token, method, args)))
+
+    async def _read_reply(self):
+        if self.protocol == "binary":
+            header = await self.process.stdout.readexactly(FRAME_HEADER.size)
+            token, kind, size = FRAME_HEADER.unpack(header)
+            return token, header + await self.process.stdout.readexactly(size)
+        line = await self.process.stdout.readline()
+        if len(line) == 0:
+            raise asyncio.IncompleteReadError(line, None)
+        if not line.startswith(b"@"):
+            return None, line
+        return int(line[2:line.index(b",")]), line
+
+    def _decode_reply(self, data):
+        if self.protocol == "binary":
+            token, kind, size = FRAME_HEADER.unpack_from(data)
+            return list(decode_binary_reply(kind, data[FRAME_HEADER.size:]))
+        return json.loads(data[1:])[1:]
+
+    async def _pump(self):
+        # Forward the replies to the current client, except for
+        # the replies to our own replayed setup calls, and the
+        # ones that come after the client has disconnected.
+        try:
+            while True:
+                token, data = await self._read_reply()
+                if token is not None and self.swallow > 0:
+                    self.swallow -= 1
+                    continue
+                if token in self.pending:
+                    self.replies[self.pending.pop(token)] = self._decode_reply(data)
+                if token == BARRIER_TOKEN and self.barrier is not None:
+                    self.nbarrier -= 1
+                    if self.nbarrier == 0:
+                        self.barrier.set_result(None)
+                elif self.client is not None:
+                    self.client.write(data)
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            if self.client is not None:
+                self.client.close()
+            if self.barrier is not None and not self.barrier.done():
+                self.barrier.set_exception(EOFError())
+
+    async def release(self):
+        """
+        Wait until the jobs of the disconnected client are done,
+        and return True if the worker can serve another one.
+        """
+        self.client = None
+        # "changefamily" waits for the previous jobs of its family
+        # to finish, so send it for every family that was loaded.
+        # (The workers with lazy kernels get a trailing flag in
+        # "family" too.)
+        families = []
+        for key, reply in zip(self.setup, self.replies):
+            method, args, stamp = json.loads(key)
+            if method == "family" and reply is not None and reply[1] is None:
+                families.append(args)
+        if not families:
+            return False
+        self.barrier = asyncio.futures.Future()
+        self.nbarrier = len(families)
+        for args in families:
+            idx, realp, complexp = args[0], args[3], args[4]
+            self.send(BARRIER_TOKEN, "changefamily", (idx, realp, complexp))
+        try:
+            await self.barrier
+        except EOFError:
+            return False
+        self.barrier = None
+        return self.alive()
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+
+class Daemon:
+    def __init__(self, command, max_idle=16, data_dirs=None):
+        self.command = command
+        self.max_idle = max_idle
+        # The directories the clients may load the integrals from,
+        # or None for any.
+        self.data_dirs = None if data_dirs is None else [os.path.realpath(d) for d in data_dirs]
+        self.idle = [] # [DaemonWorker], oldest first
+        self.nsessions = 0
+        self.nactive = 0
+
+    async def spawn(self, startmsg):
+        """
+        Start a new worker and send it the given "start" message;
+        return the worker, or None and the reply if it failed.
+        """
+        p = await asyncio.create_subprocess_exec(*self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        p.stdin.write(encode_message(startmsg))
+        reply = await p.stdout.readline()
+        try:
+            _, result, err = json.loads(reply[1:])
+        except ValueError:
+            err = "bad start reply"
+        if err is not None:
+            try:
+                p.kill()
+            except ProcessLookupError:
+                pass
+            return None, reply
+        negotiated = len(startmsg[2]) > 1
+        protocol = result[1] if negotiated else "json"
+        return DaemonWorker(p, json.dumps(startmsg[2]), reply, protocol), reply
+
+    def check_start(self, dirname):
+        """
+        Return the reason to refuse a client that wants to load
+        the integrals from this directory, or None.
+        """
+        if self.data_dirs is None:
+            return None
+        path = os.path.realpath(dirname)
+        if any(os.path.commonpath([path, d]) == d for d in self.data_dirs):
+            return None
+        return f"directory not allowed: {dirname}"
+
+    def take_idle(self, startkey):
+        for i, w in enumerate(self.idle):
+            if w.startkey == startkey and w.alive():
+                return self.idle.pop(i)
+        return None
+
+    def put_idle(self, w):
+        self.idle.append(w)
+        while len(self.idle) > self.max_idle:
+            self.idle.pop(0).kill()
+
+    async def read_message(self, reader, protocol):
+        """
+        Read one message from a client; return the raw bytes, and
+        the decoded (token, method, args) of a JSON message.
+        """
+        if protocol == "binary":
+            header = await reader.readexactly(FRAME_HEADER.size)
+            token, kind, size = FRAME_HEADER.unpack(header)
+            payload = await reader.readexactly(size)
+            if kind != METHOD_JSON:
+                return header + payload, None
+            return header + payload, json.loads(payload)
+        line = await reader.readline()
+        if len(line) == 0:
+            raise asyncio.IncompleteReadError(line, None)
+        return line, json.loads(line)
+
+    def reply(self, writer, protocol, token, reply):
+        """
+        Send a recorded [result, error] reply to the client.
+        """
+        if protocol == "binary":
+            payload = json.dumps(reply).encode("utf-8")
+            writer.write(FRAME_HEADER.pack(token, REPLY_JSON, len(payload)) + payload)
+        else:
+            writer.write(b"@" + encode_message([token] + reply))
+
+    async def serve(self, reader, writer):
+        self.nsessions += 1
+        session = self.nsessions
+        self.nactive += 1
+        w = None
+        try:
+            line = await reader.readline()
+            if len(line) == 0: return
+            startmsg = json.loads(line)
+            dirname = startmsg[2][0]
+            error = self.check_start(dirname)
+            if error is not None:
+                log(f"session {session}: {error}")
+                self.reply(writer, "json", startmsg[0], [None, error])
+                return
+            startkey = json.dumps(startmsg[2])
+            w = self.take_idle(startkey)
+            if w is None:
+                w, reply = await self.spawn(startmsg)
+                if w is None:
+                    # E.g. an older worker not knowing about the
+                    # protocol negotiation: let the client know.
+                    writer.write(reply)
+                    return
+                log(f"session {session}: started a new worker")
+            else:
+                log(f"session {session}: reusing a worker with {len(w.setup)} setup calls done")
+            w.client = writer
+            writer.write(w.startreply)
+            # Answer the setup calls that the worker has already
+            # done; as soon as a call differs, switch to a fresh
+            # worker with the calls so far replayed.
+            pos = 0
+            while True:
+                data, msg = await self.read_message(reader, w.protocol)
+                if msg is None or msg[1] not in SETUP_METHODS:
+                    w.process.stdin.write(data)
+                    break
+                if msg[1] == "family" and os.sep in msg[2][1]:
+                    log(f"session {session}: bad family name: {msg[2][1]}")
+                    self.reply(writer, w.protocol, msg[0], [None, f"bad family name: {msg[2][1]}"])
+                    return
+                key = setup_key(dirname, msg[1], msg[2])
+                if pos < len(w.setup):
+                    if w.setup[pos] == key and w.replies[pos] is not None:
+                        self.reply(writer, w.protocol, msg[0], w.replies[pos])
+                        pos += 1
+                        continue
+                    log(f"session {session}: setup differs at call {pos}, starting a new worker")
+                    old = w
+                    old.client = None
+                    self.put_idle(old)
+                    w, reply = await self.spawn(startmsg)
+                    if w is None: return
+                    w.setup = old.setup[:pos]
+                    w.replies = old.replies[:pos]
+                    w.swallow = pos
+                    for i, k in enumerate(w.setup):
+                        method, args, stamp = json.loads(k)
+                        w.send(i + 1, method, args)
+                    w.client = writer
+                w.setup.append(key)
+                w.replies.append(None)
+                w.pending[msg[0]] = pos
+                pos += 1
+                w.process.stdin.write(data)
+            # Past the setup: just forward the rest.
+            while True:
+                data = await reader.read(1 << 16)
+                if len(data) == 0: break
+                w.process.stdin.write(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, IndexError, TypeError) as e:
+            log(f"session {session}: bad message: {e}")
+        finally:
+            writer.close()
+            if w is not None and w.client is writer:
+                if await w.release():
+                    self.put_idle(w)
+                    log(f"session {session}: done, {len(self.idle)} idle workers")
+                else:
+                    w.kill()
+                    log(f"session {session}: done, worker exited")
+            self.nactive -= 1
+
+async def start_server(address, daemon, allow_remote=False):
+    """
+    Listen on the given address; unless allow_remote is set, only
+    the loopback ones and the Unix sockets are allowed.
+    """
+    if address.startswith("unix:"):
+        return await asyncio.start_unix_server(daemon.serve, path=address[5:])
+    host, port = address.rsplit(":", 1)
+    if not allow_remote and not is_loopback(host):
+        raise ValueError(f"refusing to listen on a non-loopback address {host}; use --allow-remote to allow it")
+    return await asyncio.start_server(daemon.serve, host=host, port=int(port))
+
+def main():
+    address = "localhost:7300"
+    allow_remote = False
+    data_dirs = None
+    max_idle = 16
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["listen=", "allow-remote", "data-dir=", "max-idle=", "help"])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        print("use --help to see the usage", file=sys.stderr)
+        exit(1)
+    for key, value in opts:
+        if key == "--listen": address = value
+        elif key == "--allow-remote": allow_remote = True
+        elif key == "--data-dir": data_dirs = (data_dirs or []) + [value]
+        elif key == "--max-idle": max_idle = int(value)
+        elif key == "--help":
+            print(__doc__.strip())
+            exit(0)
+    command = args if args else [sys.executable, "-m", "pySecDecContrib", "pysecdec_cpuworker"]
+    daemon = Daemon(command, max_idle=max_idle, data_dirs=data_dirs)
+    loop = asyncio.get_event_loop()
+    try:
+        server = loop.run_until_complete(start_server(address, daemon, allow_remote=allow_remote))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    log(f"listening on {address}, running {command}")
+    try:
+        loop.run_until_complete(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in daemon.idle:
+            w.kill()
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
+import math
 import numpy as np
+import os
 
 cbcpt_dn1_100_lattice = np.array((
     1021, 1123, 1237, 1361, 1499, 1657, 1811, 1993, 2203, 2411,
@@ -203,7 +205,7 @@ cbcpt_cfftw2_10_gv = np.array((
     (1,26244027730,14007824995,31591716930,26842308147,29732316964,19894805679,17981118397,29347359790,4732146810),
 ), dtype=np.int64)
 
-def generating_vector(nvariables, minsize):
+def _table_generating_vector(nvariables, minsize):
     if nvariables <= 100:
         i = cbcpt_dn1_100_lattice.searchsorted(np.int64(minsize))
         if i < len(cbcpt_dn1_100_gv):
@@ -212,6 +214,210 @@ def generating_vector(nvariables, minsize):
         i = cbcpt_cfftw2_10_lattice.searchsorted(np.int64(minsize))
         if i < len(cbcpt_cfftw2_10_gv):
             return int(cbcpt_cfftw2_10_lattice[i]), cbcpt_cfftw2_10_gv[i, :nvariables].tolist()
+    return None
+
+# The largest lattice that generating_vector() constructs on the
+# fly; larger ones are used only if precomputed (see main()).
+cbc_max_size = 2**20
+
+# The usual directory to store the constructed generating
+# vectors in (see the cache_dir arguments below).
+default_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "pysecdec", "generating-vectors")
+
+# The smallest size of the lattice size grid used with the step
+# argument of generating_vector().
+cbc_grid_base = 1000
+
+_cbc_memory = {}
+
+def is_prime(n):
+    """
+    Deterministic Miller-Rabin primality test, valid for
+    n < 3.3e24.
+    """
+    if n < 2: return False
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0: return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for a in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1: continue
+        for i in range(r - 1):
+            x = x*x % n
+            if x == n - 1: break
+        else:
+            return False
+    return True
+
+def next_prime(n):
+    """
+    Return the smallest prime that is not smaller than n.
+    """
+    n = max(int(n), 2)
+    while not is_prime(n):
+        n += 1
+    return n
+
+def primitive_root(n):
+    """
+    Return the smallest primitive root modulo a prime n.
+    """
+    factors = []
+    m = n - 1
+    f = 2
+    while f*f <= m:
+        if m % f == 0:
+            factors.append(f)
+            while m % f == 0: m //= f
+        f += 1
+    if m > 1: factors.append(m)
+    for g in range(2, n):
+        if all(pow(g, (n - 1)//f, n) != 1 for f in factors):
+            return g
+    return 1
+
+def _cbc_powers(g, n):
+    # g^j mod n for j = 0 .. n-2, computed by doubling the range.
+    powers = np.empty(n - 1, dtype=np.int64)
+    powers[0] = 1
+    size = 1
+    while size < n - 1:
+        step = min(size, n - 1 - size)
+        powers[size:size + step] = powers[:step]*pow(g, size, n) % n
+        size += step
+    return powers
+
+def cbc_construct(nvariables, n, prefix=()):
+    """
+    Construct a generating vector of a rank-1 lattice with a prime
+    number of points n via the fast component-by-component
+    algorithm of Nuyens and Cools [1], in O(nvariables n log n)
+    time and O(n) memory.
+
+    The vector minimizes the worst-case error in the weighted
+    Korobov space with smoothness alpha=2 and the product weights
+    gamma_j = 1/j^2. The components are chosen one by one; the
+    first components can be given in prefix, so that a shorter
+    vector can be extended.
+
+    [1] D. Nuyens, R. Cools, Math. Comp. 75 (2006) 903-920.
+    """
+    if not is_prime(n):
+        raise ValueError(f"CBC lattice size must be prime, got {n}")
+    if n >= 2**31:
+        raise ValueError(f"CBC lattice size is too large: {n}")
+    m = n - 1
+    powers = _cbc_powers(primitive_root(n), n)
+    # omega(x) = 2 pi^2 B_2(x), on the points g^j/n.
+    x = powers/n
+    psi = 2*np.pi**2*(x*x - x + 1/6)
+    del x
+    # The products over the chosen components, at the points
+    # k = g^-j, so that the error of each candidate z = g^i is a
+    # cyclic convolution: sum_j prod[j] psi[i - j].
+    prod = np.ones(m)
+    # The convolution is done with zero padding to a power of 2,
+    # since m can have large prime factors: psi is extended so
+    # that conv[i + m - 1] is the cyclic result at i.
+    size = 1 << (2*m - 2).bit_length()
+    fpsi = np.fft.rfft(np.concatenate((psi[1:], psi)), size)
+    index = {int(z): i for i, z in enumerate(powers)} if prefix else None
+    j = np.arange(m)
+    genvec = []
+    for s in range(nvariables):
+        if s < len(prefix):
+            i = index[int(prefix[s]) % n]
+        elif s == 0:
+            i = 0
+        else:
+            err = np.fft.irfft(np.fft.rfft(prod, size)*fpsi, size)[m - 1:2*m - 1]
+            # Break the (frequent) ties towards the smallest z.
+            emin = np.min(err)
+            candidates = np.nonzero(err <= emin + 1e-10*abs(emin))[0]
+            i = int(candidates[np.argmin(powers[candidates])])
+        genvec.append(int(powers[i]))
+        prod *= 1 + psi[(i - j) % m]/(s + 1)**2
+    return genvec
+
+def _cbc_cache_file(cache_dir, n):
+    return os.path.join(cache_dir, f"cbc_{n}.npy")
+
+def cbc_cached(nvariables, n, cache_dir=None):
+    """
+    Return the stored generating vector for n points and at
+    least nvariables dimensions (cut to nvariables), or None.
+    The vectors are looked up in memory, and then in cache_dir,
+    if given.
+    """
+    genvec = _cbc_memory.get(n)
+    if (genvec is None or len(genvec) < nvariables) and cache_dir is not None:
+        try:
+            genvec = np.load(_cbc_cache_file(cache_dir, n)).tolist()
+            _cbc_memory[n] = genvec
+        except (OSError, ValueError):
+            pass
+    if genvec is None or len(genvec) < nvariables:
+        return None
+    return genvec[:nvariables]
+
+def cbc_generating_vector(nvariables, n, cache_dir=None):
+    """
+    Return the CBC generating vector for n points and nvariables
+    dimensions, constructing it if not done before. The
+    constructed vectors are kept in memory, and in cache_dir, if
+    given.
+    """
+    genvec = cbc_cached(nvariables, n, cache_dir)
+    if genvec is not None:
+        return genvec
+    genvec = cbc_construct(nvariables, n, prefix=_cbc_memory.get(n, ()))
+    _cbc_memory[n] = genvec
+    if cache_dir is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmpfile = _cbc_cache_file(cache_dir, n) + f".{os.getpid()}.tmp.npy"
+            np.save(tmpfile, np.array(genvec, dtype=np.int64))
+            os.replace(tmpfile, _cbc_cache_file(cache_dir, n))
+        except OSError:
+            pass
+    return genvec
+
+def cbc_grid_size(minsize, step):
+    """
+    Return the smallest prime lattice size of at least minsize
+    points on the grid of sizes growing by the factor 1+step.
+    """
+    k = max(math.ceil(math.log(minsize/cbc_grid_base)/math.log1p(step) - 1e-9), 0)
+    return next_prime(math.ceil(cbc_grid_base*(1 + step)**k))
+
+def generating_vector(nvariables, minsize, step=None, cache_dir=None):
+    """
+    Return a lattice size of at least minsize points, and the
+    generating vector for it in nvariables dimensions.
+
+    The built-in tables are used when possible. A lattice is
+    constructed instead (see cbc_construct()) if the tables have
+    none this large (or this many dimensions), or, if step is
+    given, if the next tabulated size exceeds minsize by more
+    than the factor 1+step. Lattices larger than cbc_max_size
+    are only used if precomputed. The constructed vectors are
+    stored in cache_dir, if given (see cbc_generating_vector()).
+    """
+    found = _table_generating_vector(nvariables, minsize)
+    if found is not None and (step is None or found[0] <= minsize*(1 + step)):
+        return found
+    n = cbc_grid_size(minsize, step) if step is not None else next_prime(math.ceil(minsize))
+    if found is None or n < found[0]:
+        if n <= cbc_max_size:
+            return n, cbc_generating_vector(nvariables, n, cache_dir)
+        genvec = cbc_cached(nvariables, n, cache_dir)
+        if genvec is not None:
+            return n, genvec
+    if found is not None:
+        return found
     raise ValueError(f"No generating vectors for {nvariables} variables of size {minsize}")
 
 def max_lattice_size(nvariables):
@@ -219,4 +425,46 @@ def max_lattice_size(nvariables):
         return int(cbcpt_cfftw2_10_lattice[-1])
     if nvariables <= 100:
         return int(cbcpt_dn1_100_lattice[-1])
-    raise ValueError(f"No generating vectors for {nvariables} variables")
+    return cbc_max_size
+
+def main():
+    """
+    Precompute the generating vectors for a range of lattice
+    sizes, and store them in the cache directory.
+    """
+    import getopt
+    import sys
+    usage = """\
+Usage:
+    python3 -m pySecDec.generating_vectors [options]
+Options:
+    --dimensions=X  construct the vectors for this many dimensions (default: 10)
+    --min=X         start with this lattice size (default: 1e3)
+    --max=X         stop at this lattice size (default: 1e6)
+    --step=X        increase the lattice size by the factor 1+X (default: 0.05)
+    --cache=X       store the vectors in this directory (default: {default_cache_dir})"""
+    nvariables, nmin, nmax, step = 10, 1000, 10**6, 0.05
+    cache_dir = default_cache_dir
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["dimensions=", "min=", "max=", "step=", "cache=", "help"])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        print("use --help to see the usage", file=sys.stderr)
+        exit(1)
+    for key, value in opts:
+        if key == "--dimensions": nvariables = int(value)
+        elif key == "--min": nmin = int(float(value))
+        elif key == "--max": nmax = int(float(value))
+        elif key == "--step": step = float(value)
+        elif key == "--cache": cache_dir = value
+        elif key == "--help":
+            print(usage.format(default_cache_dir=default_cache_dir))
+            exit(0)
+    n = cbc_grid_size(nmin, step)
+    while n <= nmax:
+        genvec = cbc_generating_vector(nvariables, n, cache_dir)
+        print(n, *genvec, flush=True)
+        n = cbc_grid_size(n + 1, step)
+
+if __name__ == "__main__":
+    main()
@@ -1458,17 +1458,95 @@ class DistevalLibrary(object):
 
     :param workers:
         list of string or list of list of string, optional;
-        List of commands that start pySecDec workers.
-        Default: one ``"nice python3 -m pySecDecContrib pysecdec_cpuworker"``
-        per available CPU, or one
+        List of commands that start pySecDec workers. A
+        ``{"connect": "host:port"}`` entry connects to a worker
+        daemon started by ``python3 -m pySecDec.disteval_daemon``
+        instead.
+        Default: one ``"nice python3 -m pySecDecContrib pysecdec_cpuworker -t <n>"``
+        per NUMA node, with ``<n>`` threads for its available CPUs
+        (but one core per GPU), and one
         ``"nice python3 -m pySecDecContrib pysecdec_cudaworker -d <i>"``
         for each available GPU.
 
+    :param coefficient_workers:
+        list of string or list of list of string, optional;
+        List of commands that start the workers expanding the
+        amplitude coefficients that were not compiled (see
+        ``make disteval-coefficients``); these are launched
+        on first use only.
+        Default: two
+        ``"nice python3 -m pySecDecContrib pysecdec_coeffworker"``.
+
+    :param cpu_threads:
+        int, optional;
+        With the default workers, use at most this many
+        threads for the CPU workers (``0`` for GPU workers only).
+        Default: ``None`` (all available).
+
+    :param gpus:
+        int, optional;
+        With the default workers, use at most this many GPUs
+        (``0`` for CPU workers only).
+        Default: ``None`` (all available).
+
+    :param gpu_lattice:
+        int, optional;
+        In a pool of CPU and GPU workers, send the lattices
+        smaller than this many points only to the CPU workers
+        (whose per-job overhead is smaller), and the rest only
+        to the GPU workers.
+        Default: ``None`` (place the jobs by their expected
+        durations only).
+
     :param verbose:
         bool, optional;
         Print the set up and the integration log.
         Default: ``True``.
 
+    :param scheduler:
+        string, optional;
+        How to distribute the integration jobs among the
+        workers: ``"random"`` to pick a random lightly loaded
+        worker, or ``"cost"`` to send the most expensive jobs
+        first to the worker expected to finish them the earliest.
+        Default: ``"random"``.
+
+    :param cache:
+        string, optional;
+        The directory of an on-disk cache of the integration
+        results. The cached lattices are reused by later calls
+        (and later instances) with the same parameter values, and
+        the integration of each kernel is resumed from its largest
+        cached lattice. Default: ``None`` (no caching).
+
+    :param lattice_cache:
+        string, optional;
+        The directory where the generating vectors constructed
+        for the `lattice_step` argument (see below) are stored,
+        so that they are not constructed again by later instances;
+        e.g. ``~/.cache/pysecdec/generating-vectors``, as used by
+        ``python3 -m pySecDec.disteval``.
+        Default: ``None`` (keep them in memory only).
+
+    :param cache_size:
+        unsigned int, optional;
+        The maximal number of per-shift results kept in the
+        cache; the least recently used lattices are evicted
+        first. Default: ``1e6``.
+
+    :param parallel_points:
+        unsigned int, optional;
+        The number of points that :meth:`scan` (or concurrent
+        :meth:`submit` and :meth:`acall` calls) evaluate at once
+        on the shared workers. Default: ``1``.
+
+    :param calibration:
+        string, optional;
+        A file where the worker calibration profiles (speed and
+        overheads) are stored, so that the workers are only
+        benchmarked if no recent profile matches them.
+        Default: ``None`` (benchmark at every startup).
+
     Instances of this class can be called with the
     following arguments:
 
@@ -1533,6 +1611,13 @@ class DistevalLibrary(object):
         lattice_candidates=0 disables the use of the median QMC rule.
         Default: ``0``.
 
+    :param job_time:
+        float, optional;
+        The target duration (in seconds) of a single job. Large
+        lattices are split into index ranges evaluated by several
+        workers at once, so that each job takes about this long.
+        Default: ``1.0``.
+
     :param verbose:
         bool, optional;
         Print the integration log.
@@ -1550,47 +1635,133 @@ class DistevalLibrary(object):
         The format of the returned result, ``"sympy"``,
         ``"mathematica"``, or ``"json"``. Default: ``"sympy"``.
 
+    :param warm_start:
+        dict, optional;
+        The state of a previous evaluation at a nearby point. The
+        kernels found in it start from the same lattices and
+        deformation parameters, skipping the presampling; on
+        return it is updated with the state of this evaluation,
+        so the same (initially empty) dict can be passed to a
+        sequence of calls. Default: ``None`` (cold start).
+
+    :param lattice_step:
+        float, optional;
+        If given, the lattices are at most ``1+lattice_step``
+        times larger than required: when the built-in tables have
+        no such size, a generating vector is constructed with the
+        fast component-by-component algorithm (and stored in
+        `lattice_cache`, if given to :meth:`__init__`).
+        Default: ``None`` (use the built-in tables only).
+
     The call operator returns a single string with the resulting
     value as a series in the regulator powers.
+
+    To evaluate many points, use :meth:`scan`. To evaluate
+    several points at once without blocking, use :meth:`submit`
+    (returning a :class:`concurrent.futures.Future`), or
+    :meth:`acall` from asyncio code. Call :meth:`close` (or use
+    the library as a context manager) to stop the workers.
     '''
 
-    def __init__(self, specification_path, workers=None, verbose=True):
+    def __init__(self, specification_path, workers=None, verbose=True, scheduler="random", cache=None, cache_size=1e6, parallel_points=1, calibration=None, cpu_threads=None, gpus=None, gpu_lattice=None, coefficient_workers=None, lattice_cache=None):
         import asyncio
         import sys
+        import threading
         from . import disteval
-        # Normally this code is not supposed to be called from
-        # within an asyncio event loop, but e.g. Jupyter notebook
-        # kernel insists on starting it automatically, breaking
-        # any internal asyncio usage. See [1,2,3].
-        #
-        # The only solution at the moment is to patch asyncio to
-        # allow nested event loop execution via nest_asyncio.
-        #
-        # [1] https://github.com/jupyter/notebook/issues/3397
-        # [2] https://github.com/ipython/ipykernel/issues/548
-        # [3] https://github.com/python/cpython/issues/66435
-        import nest_asyncio; nest_asyncio.apply()
+        # The workers live in an event loop of their own, run by a
+        # background thread, so that the library works the same
+        # whether or not the caller runs an event loop (as e.g.
+        # the Jupyter notebook kernel does), and so that several
+        # evaluations can share the workers at once.
         disteval.log_file = sys.stderr if verbose else DevNullWriter()
         dirname = os.path.dirname(specification_path)
         if workers is None:
-            workers = disteval.default_worker_commands(dirname)
+            workers = disteval.default_worker_commands(dirname, cpu_threads=cpu_threads, gpus=gpus)
         self.filename = specification_path
         self.dirname = dirname
         self.verbose = verbose
-        self.prepared = asyncio.run(disteval.prepare_eval(workers, dirname, specification_path))
+        self.cache = None
+        self.lattice_cache = None if lattice_cache is None else os.path.expanduser(lattice_cache)
+        self.prepared = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="disteval", daemon=True)
+        self._thread.start()
+        try:
+            # The cache is used from the loop thread only.
+            if cache is not None:
+                self.cache = self._run(self._in_loop(disteval.ResultCache, cache, int(cache_size)))
+            calibration = disteval.CalibrationCache(calibration) if calibration is not None else None
+            self.prepared = self._run(disteval.prepare_eval(workers, dirname, specification_path, scheduler=scheduler, slots=int(parallel_points), calibration=calibration, gpu_lattice=gpu_lattice, coefficient_workers=coefficient_workers))
+            self._slots, self._slots_lock = self._run(self._in_loop(self._make_slots, int(parallel_points)))
+        except BaseException:
+            self.close()
+            raise
+
+    @staticmethod
+    async def _in_loop(function, *args):
+        return function(*args)
+
+    @staticmethod
+    def _make_slots(count):
+        import asyncio
+        slots = asyncio.Queue()
+        for slot in range(count):
+            slots.put_nowait(slot)
+        return slots, asyncio.Lock()
+
+    def _run(self, coroutine):
+        return self._submit(coroutine).result()
 
-    def __call__(self,
+    def _submit(self, coroutine):
+        import asyncio
+        if self._loop.is_closed():
+            coroutine.close()
+            raise RuntimeError("the library is closed")
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def _take_slots(self, count):
+        # Take the slots under a lock, so that a scan waiting for
+        # all of them doesn't deadlock with another one.
+        async with self._slots_lock:
+            return [await self._slots.get() for i in range(count)]
+
+    def _put_slots(self, slots):
+        for slot in slots:
+            self._slots.put_nowait(slot)
+
+    def __call__(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
+
+    async def acall(self, *args, **kwargs):
+        r'''
+        Evaluate the library from an asyncio coroutine: the same
+        as the call operator, but awaitable, so that the caller's
+        event loop keeps running in the meantime.
+        '''
+        import asyncio
+        return await asyncio.wrap_future(self.submit(*args, **kwargs))
+
+    def submit(self,
             parameters={}, real_parameters=[], complex_parameters=[],
             epsabs=1e-10, epsrel=1e-4, timeout=None, points=1e4,
             number_of_presamples=1e4, shifts=32,
-            lattice_candidates=0, standard_lattices=False, 
-            coefficients=None, verbose=None, format="sympy"):
-        import asyncio
+            lattice_candidates=0, standard_lattices=False,
+            coefficients=None, verbose=None, format="sympy", job_time=1.0,
+            warm_start=None, lattice_step=None):
+        r'''
+        Start evaluating the library in the background, and return
+        a :class:`concurrent.futures.Future` of the result. The
+        arguments are the same as for the call operator.
+
+        Up to `parallel_points` (see :meth:`__init__`) evaluations
+        share the workers at once; the others wait for their turn.
+        '''
         import json
         import math
         import sys
         import time
         from . import disteval
+        parameters = dict(parameters)
         if real_parameters or complex_parameters:
             with open(self.filename) as f:
                 spec = json.load(f)
@@ -1606,14 +1777,154 @@ class DistevalLibrary(object):
             epsrel = [epsrel]
         if coefficients is None:
             coefficients = os.path.join(self.dirname, "coefficients")
-        deadline = math.inf if timeout is None else time.time() + timeout
         if verbose is None: verbose = self.verbose
         disteval.log_file = sys.stderr if verbose else DevNullWriter()
-        result = asyncio.run(disteval.do_eval(
-            self.prepared, coefficients, epsabs, epsrel,
-            int(number_of_presamples), int(points), int(shifts),
-            lattice_candidates, standard_lattices,
-            parameters, parameters, deadline))
+        async def evaluate():
+            slots = await self._take_slots(1)
+            try:
+                deadline = math.inf if timeout is None else time.time() + timeout
+                result = await disteval.do_eval(
+                    self.prepared, coefficients, epsabs, epsrel,
+                    int(number_of_presamples), int(points), int(shifts),
+                    lattice_candidates, standard_lattices,
+                    parameters, parameters, deadline, job_time=job_time, cache=self.cache,
+                    slot=slots[0], warmstart=warm_start, lattice_step=lattice_step,
+                    lattice_cache=self.lattice_cache)
+            finally:
+                self._put_slots(slots)
+            return self._format_result(result, format)
+        return self._submit(evaluate())
+
+    def scan(self, points,
+            epsabs=1e-10, epsrel=1e-4, timeout=None, npoints=1e4,
+            number_of_presamples=1e4, shifts=32,
+            lattice_candidates=0, standard_lattices=False,
+            coefficients=None, verbose=None, format="sympy", job_time=1.0,
+            warm_start=None, callback=None, lattice_step=None):
+        r'''
+        Evaluate the library at many points, sharing the workers
+        between up to `parallel_points` (see :meth:`__init__`)
+        points at once.
+
+        :param points:
+            iterable of dict of float;
+            The parameter values at each point, as in the
+            `parameters` argument of the call operator.
+
+        :param npoints:
+            unsigned int, optional;
+            The initial QMC lattice size.
+            Default: ``1e4``.
+
+        :param timeout:
+            float, optional;
+            The maximal integration time (in seconds) of each point.
+            Default: ``None``.
+
+        :param warm_start:
+            dict, optional;
+            As for the call operator; the points are warm-started
+            from the points finished before them. Default: a new
+            empty dict.
+
+        :param callback:
+            function, optional;
+            If given, called as ``callback(i, result)`` as soon
+            as the `i`-th point is done.
+
+        The other arguments are the same as for the call operator.
+        Returns the list of results in the order of `points`.
+        '''
+        import math
+        import sys
+        from . import disteval
+        if not isinstance(epsabs, list) and not isinstance(epsabs, tuple):
+            epsabs = [epsabs]
+        if not isinstance(epsrel, list) and not isinstance(epsrel, tuple):
+            epsrel = [epsrel]
+        if coefficients is None:
+            coefficients = os.path.join(self.dirname, "coefficients")
+        if verbose is None: verbose = self.verbose
+        disteval.log_file = sys.stderr if verbose else DevNullWriter()
+        results = {}
+        def point_cb(i, result):
+            results[i] = self._format_result(result, format)
+            if callback is not None:
+                callback(i, results[i])
+        async def scan():
+            # do_scan() uses all the slots.
+            slots = await self._take_slots(self.prepared.slots)
+            try:
+                await disteval.do_scan(
+                    self.prepared, ((p, p) for p in points), point_cb, coefficients, epsabs, epsrel,
+                    int(number_of_presamples), int(npoints), int(shifts),
+                    lattice_candidates, standard_lattices,
+                    timeout=math.inf if timeout is None else timeout,
+                    job_time=job_time, cache=self.cache, warmstart=warm_start,
+                    lattice_step=lattice_step, lattice_cache=self.lattice_cache)
+            finally:
+                self._put_slots(slots)
+        self._run(scan())
+        return [results[i] for i in range(len(results))]
+
+    def set_workers(self, workers):
+        r'''
+        Change the worker list during the lifetime of the library:
+        the new workers are started (and join the evaluations in
+        progress), and the removed ones are stopped as soon as
+        the jobs they already have are done.
+
+        :param workers:
+            list, the worker commands, as in :meth:`__init__`.
+        '''
+        self._run(self._in_loop(self.prepared.pool.set_commands, list(workers)))
+
+    def watch_cluster(self, cluster_file, interval=10):
+        r'''
+        Check the given cluster.json file every `interval` seconds,
+        and follow the changes of the worker list in it, as with
+        :meth:`set_workers`.
+        '''
+        self._run(self._in_loop(self.prepared.pool.start_watching, cluster_file, interval))
+
+    def close(self):
+        r'''
+        Stop the workers and the background event loop. The library
+        can't be used afterwards. Called automatically when the
+        library is used as a context manager::
+
+            with DistevalLibrary("box1L/disteval/box1L.json") as box1L:
+                print(box1L(parameters={"s": 4.0, "t": -0.75, "s1": 1.25, "msq": 1.0}))
+        '''
+        import asyncio
+        from . import disteval
+        if self._loop.is_closed():
+            return
+        try:
+            if self.prepared is not None:
+                self._run(disteval.shutdown(self.prepared))
+            if self.cache is not None:
+                self._run(self._in_loop(self.cache.close))
+            async def cancel_tasks():
+                tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self._run(cancel_tasks())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _format_result(result, format):
+        from . import disteval
         if format == "sympy":
             return disteval.result_to_sympy(result)
         elif format == "mathematica":
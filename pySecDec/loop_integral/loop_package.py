@@ -33,7 +33,8 @@ def LoopPackage(name, loop_integral, requested_orders=None,
                  split=False, ibp_power_goal=-1,
                  use_iterative_sort=True, use_light_Pak=True,
                  use_dreadnaut=False, use_Pak=True,
-                 processes=None, pylink_qmc_transforms=['korobov3x3']):
+                 processes=None, pylink_qmc_transforms=['korobov3x3'],
+                 disteval_fuse_orders=False, disteval_group_sectors=None):
     '''
     Convert a loop integral into a :func:`pySecDec.code_writer.MakePackage` object
     (suitable for use in :func:`pySecDec.code_writer.sum_package`).
@@ -117,7 +118,10 @@ def LoopPackage(name, loop_integral, requested_orders=None,
         split = split,
         processes = processes,
 
-        pylink_qmc_transforms = pylink_qmc_transforms
+        pylink_qmc_transforms = pylink_qmc_transforms,
+
+        disteval_fuse_orders = disteval_fuse_orders,
+        disteval_group_sectors = disteval_group_sectors
     )
 
 def loop_package(name, loop_integral, requested_orders=None,
@@ -141,6 +145,8 @@ def loop_package(name, loop_integral, requested_orders=None,
                  use_Pak=True,
                  processes=None,
                  pylink_qmc_transforms=['korobov3x3'],
+                 disteval_fuse_orders=False,
+                 disteval_group_sectors=None,
                  package_generator=make_package):
     """
     Decompose, subtract and expand a Feynman
@@ -339,6 +345,26 @@ def loop_package(name, loop_integral, requested_orders=None,
         `New in version 1.5`.
         Default: ``['korobov3x3']``
 
+    :param disteval_fuse_orders:
+        bool, optional;
+        Whether the distributed evaluator should use one
+        kernel per sector that computes all of its expansion
+        orders in a single pass, sharing the common
+        subexpressions, instead of one kernel per order.
+        Default: ``False``
+
+    :param disteval_group_sectors:
+        integer or None, optional;
+        If given, the distributed evaluator puts this many
+        consecutive sectors (which all have the same
+        dimension) into one kernel that computes all of their
+        orders at each lattice point, so that many small
+        sectors are integrated in one job; the sectors share
+        the lattice and the contour deformation parameters.
+        The value of each order of each sector is still
+        tracked separately.
+        Default: ``None``
+
     :param package_generator:
         function;
         The generator function for the integral,
@@ -379,6 +405,8 @@ def loop_package(name, loop_integral, requested_orders=None,
         use_Pak=use_Pak,
         processes=processes,
         pylink_qmc_transforms=pylink_qmc_transforms,
+        disteval_fuse_orders=disteval_fuse_orders,
+        disteval_group_sectors=disteval_group_sectors,
     )._asdict())
 
     if isinstance(loop_integral, LoopIntegralFromGraph):
@@ -17,7 +17,8 @@ def make_package(name, integration_variables, regulators, requested_orders,
                  decomposition_method='iterative_no_primary', normaliz_executable=None,
                  enforce_complex=False, split=False, ibp_power_goal=-1, use_iterative_sort=True,
                  use_light_Pak=True, use_dreadnaut=False, use_Pak=True, processes=None, form_executable=None,
-                 pylink_qmc_transforms=['korobov3x3']):
+                 pylink_qmc_transforms=['korobov3x3'], disteval_fuse_orders=False,
+                 disteval_group_sectors=None):
     r'''
     Decompose, subtract and expand an expression.
     Return it as c++ package.
@@ -334,6 +335,26 @@ def make_package(name, integration_variables, regulators, requested_orders,
 
         `New in version 1.5`.
         Default: ``['korobov3x3']``
+
+    :param disteval_fuse_orders:
+        bool, optional;
+        Whether the distributed evaluator should use one
+        kernel per sector that computes all of its expansion
+        orders in a single pass, sharing the common
+        subexpressions, instead of one kernel per order.
+        Default: ``False``
+
+    :param disteval_group_sectors:
+        integer or None, optional;
+        If given, the distributed evaluator puts this many
+        consecutive sectors (which all have the same
+        dimension) into one kernel that computes all of their
+        orders at each lattice point, so that many small
+        sectors are integrated in one job; the sectors share
+        the lattice and the contour deformation parameters.
+        The value of each order of each sector is still
+        tracked separately.
+        Default: ``None``
     '''
 
     # Build generators_args
@@ -368,7 +389,9 @@ def make_package(name, integration_variables, regulators, requested_orders,
         'use_dreadnaut' : use_dreadnaut,
         'use_Pak' : use_Pak,
         'processes' : processes,
-        'pylink_qmc_transforms' : pylink_qmc_transforms
+        'pylink_qmc_transforms' : pylink_qmc_transforms,
+        'disteval_fuse_orders' : disteval_fuse_orders,
+        'disteval_group_sectors' : disteval_group_sectors
     }
 
     sum_package(
@@ -0,0 +1,953 @@
+from .disteval import *
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import types
+import unittest
+import unittest.mock
+
+class FakeWorker:
+    """
+    A worker that evaluates jobs in order, spending
+    overhead + cost/speed seconds on each.
+    """
+
+    def __init__(self, name, speed, overhead=1e-4, latency=1e-4, features=()):
+        self.name = name
+        self.features = set(features)
+        self.speed = speed
+        self.overhead = overhead
+        self.latency = latency
+        self.callbacks = {}
+        self.queue = asyncio.Queue()
+        self.done = []
+        self.on_exit = None
+        self.task = asyncio.get_event_loop().create_task(self._run())
+
+    def die(self):
+        self.task.cancel()
+        if self.on_exit is not None:
+            self.on_exit(self)
+        callbacks, self.callbacks = self.callbacks, {}
+        for callback, callback_args in callbacks.values():
+            callback(None, WORKER_DIED, self, *callback_args)
+
+    def queue_size(self):
+        return len(self.callbacks)
+
+    def call_cb(self, method, args, callback, callback_args=()):
+        token = len(self.done) + len(self.callbacks) + 1
+        while token in self.callbacks: token += 1
+        self.callbacks[token] = (callback, callback_args)
+        self.queue.put_nowait((token, method, args))
+        return token
+
+    async def _run(self):
+        while True:
+            token, method, args = await self.queue.get()
+            cost = args[0] if method == "job" else 0
+            await asyncio.sleep(self.overhead + cost/self.speed)
+            self.done.append(args)
+            callback, callback_args = self.callbacks.pop(token)
+            callback(args, None, self, *callback_args)
+
+class FakeIntegrator(Worker):
+    """
+    An in-process worker for do_eval(): the kernel sector_<k>
+    integrates k*(1 + sum(x)) + i*k*sum(x^2) over a shifted
+    rank-1 lattice, and the builtin kernels return zero. The
+    time of each job is reported as 1e-5 + 1e-7 seconds per
+    point, and the maximal deformation parameter is maxdeformp. Chunks other than the first one of a lattice give
+    NaN if the deformation parameter exceeds nan_deformp.
+    All the calls are recorded in self.calls.
+    """
+
+    def __init__(self, command, maxdeformp=1.0, nan_deformp=math.inf, features=("integrate_shifts",)):
+        self.name = f"{command}:{id(self)}"
+        self.command = command
+        self.protocol = "json"
+        self.features = set(features)
+        self.serial = 0
+        self.callbacks = {}
+        self.alive = True
+        self.on_exit = None
+        self.last_activity = time.time()
+        self.metrics = None
+        self.heartbeat_task = None
+        self.isa = None
+        self.isa_speedup = 1.0
+        self.process = types.SimpleNamespace(kill=lambda: None)
+        self.reader_task = asyncio.get_event_loop().create_future()
+        self.reader_task.set_result(None)
+        self.maxdeformp = maxdeformp
+        self.nan_deformp = nan_deformp
+        self.kernels = {}
+        self.families = {}
+        self.calls = []
+
+    def call_cb(self, method, args, callback, callback_args=()):
+        token = self.serial = self.serial + 1
+        self.callbacks[token] = (callback, callback_args)
+        self.calls.append((method, args))
+        try:
+            result, error = getattr(self, "do_" + method)(*args), None
+        except Exception as e:
+            result, error = None, str(e)
+        asyncio.get_event_loop().call_soon(self._reply, token, result, error)
+        return token
+
+    def multicall(self, calls):
+        return asyncio.gather(*[self.call(method, *args) for method, args in calls])
+
+    def _reply(self, token, result, error):
+        callback, callback_args = self.callbacks.pop(token)
+        callback(result, error, self, *callback_args)
+
+    def do_ping(self):
+        return None
+
+    def do_family(self, idx, name, dim, realp, complexp, complex_result, lazy=False):
+        self.families[idx] = dim
+        return None
+
+    def do_kernel(self, idx, famidx, name, nresults=None):
+        self.kernels[idx] = (self.families[famidx], float(name.split("_")[1]) if name.startswith("sector_") else 0.0)
+        return 1
+
+    def do_changefamily(self, idx, realp, complexp):
+        return None
+
+    def do_maxdeformp(self, idx, ndeformp, lattice, genvec, shift):
+        return [self.maxdeformp]*ndeformp
+
+    def do_integrate(self, idx, lattice, i1, i2, genvec, shift, deformp):
+        values, n, dt = self.do_integrate_shifts(idx, lattice, i1, i2, genvec, [shift], deformp)
+        return values[0], n, dt
+
+    def do_integrate_shifts(self, idx, lattice, i1, i2, genvec, shifts, deformp):
+        dim, k = self.kernels[idx]
+        values = []
+        for shift in shifts:
+            if k == 0:
+                values.append([0.0, 0.0])
+            elif i1 > 0 and deformp[0] > self.nan_deformp:
+                values.append([math.nan, math.nan])
+            else:
+                j = np.arange(i1, i2, dtype=np.int64)
+                x = (np.outer(j, genvec) % lattice)/lattice + shift
+                x -= np.floor(x)
+                values.append([k*np.sum(1 + np.sum(x, axis=1)), k*np.sum(x**2)])
+        return values, (i2 - i1)*len(shifts), 1e-5 + 1e-7*(i2 - i1)*len(shifts)
+
+FAKE_INTEGRAL = {
+    "type": "integral", "name": "fake", "dimension": 2, "realp": [], "complexp": [],
+    "complex_result": True, "regulators": ["eps"], "requested_orders": [0], "deformp_count": 1,
+    "orders": [{"regulator_powers": [0], "kernels": ["sector_1", "sector_2"]}],
+    "expanded_prefactor": [{"regulator_powers": [0], "coefficient": "1"}], "prefactor": "1",
+    "prefactor_lowest_orders": [0], "prefactor_highest_orders": [0], "lowest_orders": [0],
+    "kernels": ["sector_1", "sector_2"]
+}
+
+# The exact value of FAKE_INTEGRAL: (1 + 2)*(1 + 2/2) + i*(1 + 2)*2/3
+FAKE_VALUE = 6 + 2j
+
+def run_fake_eval(dirname, body, info=FAKE_INTEGRAL, **worker_args):
+    """
+    Prepare FAKE_INTEGRAL (or info) in dirname with a single
+    FakeIntegrator, and return the result of body(prepared)
+    together with the worker.
+    """
+    with open(os.path.join(dirname, f"{info['name']}.json"), "w") as f:
+        json.dump(info, f)
+    # The result cache hashes the integral library.
+    with open(os.path.join(dirname, f"{info['name']}.so"), "w") as f:
+        f.write(json.dumps(info["kernels"]))
+    workers = []
+    async def launch(command, datadir, protocol="binary"):
+        workers.append(FakeIntegrator(command, **worker_args))
+        return workers[-1]
+    async def main():
+        with unittest.mock.patch("pySecDec.disteval.launch_worker", launch):
+            prepared = await prepare_eval(["fake"], dirname, os.path.join(dirname, f"{info['name']}.json"))
+        try:
+            return await body(prepared)
+        finally:
+            await shutdown(prepared)
+    with unittest.mock.patch("pySecDec.disteval.log_file", io.StringIO()):
+        result = asyncio.run(main())
+    return result, workers[0]
+
+def fake_eval(prepared, epsrel=0.5, npoints0=1000, nshifts=8, job_time=1.0, timeout=60, **kwargs):
+    return do_eval(prepared, prepared.datadir, [1e-10], [epsrel], 1000, npoints0, nshifts, 0, True,
+        {}, {}, time.time() + timeout, job_time=job_time, **kwargs)
+
+def fake_result(result):
+    [[powers, (re, im), (ere, eim)]] = result["sums"]["sum0"]
+    return complex(re, im), complex(ere, eim)
+
+class TestBinaryProtocol(unittest.TestCase):
+    def test_integrate_frame(self):
+        msg = encode_binary_message(7, "integrate", (3, 100, 0, 100, [1, 33], [0.25, 0.5], [1.0]))
+        token, kind, size = FRAME_HEADER.unpack_from(msg)
+        self.assertEqual((token, kind, size), (7, METHOD_INTEGRATE, len(msg) - FRAME_HEADER.size))
+        self.assertEqual(INTEGRATE_FRAME.unpack_from(msg, FRAME_HEADER.size), (3, 100, 0, 100, 2, 1))
+
+    def test_integrate_shifts_reply(self):
+        payload = INTEGRATE_SHIFTS_REPLY.pack(200, 0.5) + struct.pack("<4d", 1, 2, 3, 4)
+        result, error = decode_binary_reply(REPLY_INTEGRATE_SHIFTS, payload)
+        self.assertEqual(result, [[[1, 2], [3, 4]], 200, 0.5])
+        self.assertIsNone(error)
+
+    def test_json_in_frame(self):
+        msg = encode_binary_message(1, "kernel", (0, 0, "gauge"))
+        token, kind, size = FRAME_HEADER.unpack_from(msg)
+        self.assertEqual(kind, METHOD_JSON)
+        self.assertEqual(decode_message(b"@" + msg[FRAME_HEADER.size:]), [1, "kernel", [0, 0, "gauge"]])
+
+class TestCostScheduler(unittest.TestCase):
+    def test_all_jobs_done_once(self):
+        async def main():
+            par = CostScheduler()
+            fast = FakeWorker("fast", speed=1e5)
+            slow = FakeWorker("slow", speed=1e4)
+            par.add_worker(fast)
+            par.add_worker(slow)
+            results = []
+            for cost in [1, 10, 100, 1000, 5, 50, 500]:
+                par.call_cb("job", (cost,), lambda r, e, w: results.append(r[0]), (), cost=cost)
+            await par.drain()
+            return results, fast.done
+        results, fast_done = asyncio.run(main())
+        self.assertEqual(sorted(results), [1, 5, 10, 50, 100, 500, 1000])
+        # The longest job should go to the fast worker.
+        self.assertIn((1000,), fast_done)
+
+    def test_cancel(self):
+        async def main():
+            par = CostScheduler()
+            par.add_worker(FakeWorker("w", speed=1e5))
+            results = []
+            jobs = [
+                par.call_cb("job", (cost,), lambda r, e, w: results.append(r[0]), (), cost=cost)
+                for cost in [10, 20, 30]
+            ]
+            self.assertTrue(par.cancel_cb(jobs[1]))
+            self.assertFalse(par.cancel_cb(jobs[1]))
+            await par.drain()
+            return results
+        self.assertEqual(sorted(asyncio.run(main())), [10, 30])
+
+    def test_steal_from_slow_worker(self):
+        async def main():
+            par = CostScheduler()
+            slow = FakeWorker("slow", speed=10)
+            par.add_worker(slow)
+            winner = []
+            par.call_cb("job", (1,), lambda r, e, w: winner.append(w.name), (), cost=1)
+            fast = FakeWorker("fast", speed=1e4)
+            par.add_worker(fast)
+            await par.drain()
+            return winner
+        self.assertEqual(asyncio.run(main()), ["fast"])
+
+class TestResultCache(unittest.TestCase):
+    def test_store_and_lookup(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname)
+            key = ResultCache.kernel_key("fam", "sector_1_order_0", "0123", [2.0], [(1.0, 0.5)])
+            cache.store(key, 100, [1, 33], [0.5], [[0.1, 0.2], [0.3, 0.4]], [1+2j, 3+4j], 10.0, 200.0, 0.5)
+            cache.store(key, 1000, [1, 233], [0.5], [[0.1, 0.2]], [5+6j])
+            cache.close()
+            cache = ResultCache(dirname)
+            self.assertEqual(cache.lookup(key, 100, [1, 33], [0.5], 32), ([1+2j, 3+4j], (10.0, 200.0, 0.5)))
+            self.assertEqual(cache.lookup(key, 100, [1, 33], [0.25], 32)[0], [])
+            self.assertEqual(cache.largest(key, 2), (100, [1, 33], (0.5,)))
+            self.assertEqual(cache.largest(key, 1), (1000, [1, 233], (0.5,)))
+            self.assertIsNone(cache.largest(key, 3))
+            cache.close()
+
+    def test_replaced_shifts_size(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname)
+            key = ResultCache.kernel_key("fam", "sector_1_order_0", "0123", [], [])
+            cache.store(key, 100, [1, 33], [0.5], [[0.1, 0.2], [0.3, 0.4]], [1+2j, 3+4j])
+            cache.store(key, 100, [1, 33], [0.5], [[0.3, 0.4], [0.5, 0.6]], [5+6j, 7+8j])
+            self.assertEqual(cache.size, 3)
+            self.assertEqual(cache.lookup_shifts(key, 100, [1, 33], [0.5], 32)[:2],
+                ([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]], [1+2j, 5+6j, 7+8j]))
+            cache.close()
+
+    def test_partial_hit(self):
+        # The second run finds 4 of its 8 shifts in the cache,
+        # and must evaluate 4 other ones.
+        def shifts(w):
+            return [tuple(shift)
+                for method, args in w.calls if method == "integrate_shifts" and args[0] > 0
+                for shift in args[5]]
+        with tempfile.TemporaryDirectory() as dirname:
+            async def body(prepared, nshifts):
+                cache = ResultCache(os.path.join(dirname, "cache"))
+                try:
+                    return await fake_eval(prepared, nshifts=nshifts, cache=cache)
+                finally:
+                    cache.close()
+            result1, w1 = run_fake_eval(dirname, lambda prepared: body(prepared, 4))
+            result2, w2 = run_fake_eval(dirname, lambda prepared: body(prepared, 8))
+        self.assertEqual(len(shifts(w1)), 2*4)
+        self.assertEqual(len(shifts(w2)), 2*4)
+        self.assertEqual(set(shifts(w1)) & set(shifts(w2)), set())
+        value, error = fake_result(result2)
+        self.assertLess(abs(value - FAKE_VALUE), 1e-2)
+
+    def test_median_genvec(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname)
+            key = ResultCache.integrand_key("fam", "sector_1_order_0", "0123")
+            self.assertIsNone(cache.median_genvec(key, 1021))
+            cache.store_median_genvec(key, 1021, [1, 374])
+            cache.close()
+            cache = ResultCache(dirname)
+            self.assertEqual(cache.median_genvec(key, 1021), [1, 374])
+            self.assertIsNone(cache.median_genvec(key, 1123))
+            cache.close()
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname, maxsize=4)
+            for lattice in (100, 200, 300):
+                cache.store("k", lattice, [1, 2], [1.0], [[0.1, 0.1], [0.2, 0.2]], [1j, 2j])
+            self.assertEqual(cache.lookup("k", 100, [1, 2], [1.0], 32)[0], [])
+            self.assertEqual(cache.lookup("k", 300, [1, 2], [1.0], 32)[0], [1j, 2j])
+            cache.close()
+
+class TestCalibrationCache(unittest.TestCase):
+    def test_store_and_lookup(self):
+        def worker(name, command):
+            return types.SimpleNamespace(name=name, command=command, protocol="binary",
+                speed=1e8, int_overhead=1e-6, overhead=1e-5, latency=1e-4,
+                isa="avx2", isa_speedup=2.5)
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, "sub", "calibration.json")
+            cache = CalibrationCache(filename, ttl=60)
+            cache.store(worker("host1:123", ["cpuworker"]))
+            cache.save()
+            cache = CalibrationCache(filename, ttl=60)
+            # Only the process id may differ.
+            self.assertEqual(cache.lookup(worker("host1:456", ["cpuworker"]))["speed"], 1e8)
+            self.assertEqual(cache.lookup(worker("host1:456", ["cpuworker"]))["isa_speedup"], 2.5)
+            self.assertIsNone(cache.lookup(worker("host2:123", ["cpuworker"])))
+            self.assertIsNone(cache.lookup(worker("host1:123", ["cpuworker", "-t", "2"])))
+            cache.profiles[CalibrationCache.worker_key(worker("host1:123", ["cpuworker"]))]["time"] -= 100
+            self.assertIsNone(cache.lookup(worker("host1:123", ["cpuworker"])))
+
+    def test_isa_change_is_outdated(self):
+        # A worker that now loads other kernels needs a new benchmark.
+        w = types.SimpleNamespace(name="host1:123", isa="avx512")
+        profile = {"speed": 1e8, "int_overhead": 1e-6, "overhead": 1e-5, "isa": "avx2"}
+        self.assertFalse(asyncio.run(check_calibration(w, profile)))
+
+class TestMetrics(unittest.TestCase):
+    def test_jobs(self):
+        metrics = Metrics(trace=True)
+        metrics.kernel_names[3] = "k2"
+        w = types.SimpleNamespace(name="host:1")
+        metrics.add_worker(w)
+        metrics.sent(w, 1, "integrate", (3, 1000, 0, 1000), 100)
+        metrics.sent(w, 2, "ping", (), 10)
+        metrics.received(w, 1, ((1.0, 0.0), 1000, 0.5), None, 50)
+        metrics.received(w, 2, None, None, 10)
+        snap = metrics.snapshot()
+        ws = snap["workers"]["host:1"]
+        self.assertEqual((ws["jobs"], ws["calls"], ws["queue"], ws["busy"]), (1, 2, 0, 0.5))
+        self.assertEqual((ws["bytes_sent"], ws["bytes_received"]), (110, 60))
+        self.assertEqual(set(ws["latency"]), {"integrate", "ping"})
+        self.assertEqual(snap["kernels"]["k2"]["points_per_second"], 2000)
+        jobs = [e for e in metrics.trace if e["ph"] == "X"]
+        self.assertEqual((len(jobs), jobs[0]["name"], jobs[0]["dur"]), (1, "k2", 0.5e6))
+
+class TestIntegralWeights(unittest.TestCase):
+    def test_weights(self):
+        info = {
+            "name": "I",
+            "expanded_prefactor": [
+                {"regulator_powers": [-1], "coefficient": "-s"},
+                {"regulator_powers": [0], "coefficient": "log(s)+EulerGamma"},
+                {"regulator_powers": [1], "coefficient": "2"}
+            ],
+            "orders": [
+                {"regulator_powers": [-1], "kernels": ["a"]},
+                {"regulator_powers": [0], "kernels": ["a", "b"]},
+                {"regulator_powers": [1], "kernels": ["b"]}
+            ]
+        }
+        kernel2idx = {("I", "a"): 0, ("I", "b"): 1}
+        weights = IntegralWeights(info, kernel2idx)
+        self.assertEqual(weights.parameters, ["s"])
+        pref = weights.prefactor_values([{"s": -2.0}, {"s": 3.0}])
+        self.assertEqual(pref.shape, (2, 3))
+        self.assertAlmostEqual(pref[0, 1], np.log(2) + 1j*np.pi + np.euler_gamma)
+        self.assertAlmostEqual(pref[1, 0], -3)
+        self.assertAlmostEqual(pref[1, 2], 2)
+        rows = {}
+        # (-s/eps + L + 2 eps)*(1 + c eps)*(a/eps + (a+b) + b eps) up to eps^0,
+        # with L = log(s) + EulerGamma and c = 5.
+        weights.add_weights(rows, 0, pref[1], [[0], [1]], [1, 5], [0])
+        L = np.log(3) + np.euler_gamma
+        self.assertEqual(sorted(rows.keys()), [(0, (-2,)), (0, (-1,)), (0, (0,))])
+        np.testing.assert_allclose(rows[0, (-2,)], [-3, 0])
+        np.testing.assert_allclose(rows[0, (-1,)], [L - 15 - 3, -3])
+        np.testing.assert_allclose(rows[0, (0,)], [2 + 5*L + L - 15, L - 15 - 3])
+        with self.assertRaises(ValueError):
+            weights.prefactor_values([{"t": 1.0}])
+
+    def test_fused_components(self):
+        # With fused orders the weights refer to the components
+        # of the kernels, which are named after their kernel.
+        info = {
+            "name": "I",
+            "expanded_prefactor": [{"regulator_powers": [0], "coefficient": "1"}],
+            "orders": [
+                {"regulator_powers": [-1], "kernels": ["s1_n1"]},
+                {"regulator_powers": [0], "kernels": ["s1_0", "s2_0"]}
+            ]
+        }
+        comp2idx = {("I", "s1_n1"): 0, ("I", "s1_0"): 1, ("I", "s2_0"): 2}
+        kern_comps = [[0, 1], [2]]
+        self.assertEqual(component_names(kern_comps), ["k0.0", "k0.1", "k1"])
+        weights = IntegralWeights(info, comp2idx)
+        rows = {}
+        weights.add_weights(rows, 0, weights.prefactor_values([{}])[0], [[0]], [2], [0])
+        np.testing.assert_allclose(rows[0, (-1,)], [2, 0, 0])
+        np.testing.assert_allclose(rows[0, (0,)], [0, 2, 2])
+
+class TestWorkerFailure(unittest.TestCase):
+    def check_requeue(self, scheduler):
+        async def main():
+            par = scheduler()
+            good = FakeWorker("good", speed=1e4)
+            bad = FakeWorker("bad", speed=1e4)
+            par.add_worker(good)
+            par.add_worker(bad)
+            results = []
+            for cost in range(1, 21):
+                par.call_cb("job", (cost,), lambda r, e, w: results.append((r[0], w.name)), (), cost=cost)
+            await asyncio.sleep(0.002)
+            bad.die()
+            await par.drain()
+            return par, results
+        par, results = asyncio.run(main())
+        self.assertEqual(sorted(r for r, w in results), list(range(1, 21)))
+        self.assertEqual(par.failures, ["bad"])
+        self.assertEqual(len(par.workers), 1)
+        self.assertGreater(len(par.retried), 0)
+
+    def test_cost_scheduler(self):
+        self.check_requeue(CostScheduler)
+
+    def test_random_scheduler(self):
+        self.check_requeue(RandomScheduler)
+
+class TestWorkerPool(unittest.TestCase):
+    def check_membership(self, scheduler):
+        async def main():
+            par = scheduler()
+            launched = []
+            async def launch(cmd):
+                w = FakeWorker(f"{cmd}{len(launched)}", speed=1e4)
+                w.command, w.alive, w.heartbeat_task = cmd, True, None
+                def kill():
+                    w.alive = False
+                    w.die()
+                w.process = types.SimpleNamespace(kill=kill)
+                launched.append(w)
+                par.add_worker(w)
+                return w
+            pool = WorkerPool(par, launch)
+            await asyncio.gather(*pool.set_commands(["a", "b"], retry=False))
+            results = []
+            for cost in range(1, 21):
+                par.call_cb("job", (cost,), lambda r, e, w: results.append(r[0]), (), cost=cost)
+            await asyncio.sleep(0.002)
+            await asyncio.gather(*pool.set_commands(["a", "c", "c"]))
+            await par.drain()
+            while pool.retiring:
+                await asyncio.sleep(0.01)
+            return par, launched, results
+        par, launched, results = asyncio.run(main())
+        self.assertEqual(sorted(results), list(range(1, 21)))
+        self.assertEqual(sorted(w.name for w in par.workers), ["a0", "c2", "c3"])
+        b = launched[1]
+        self.assertFalse(b.alive)
+        self.assertGreater(len(b.done), 0)
+        self.assertEqual((par.failures, par.retried), ([], []))
+
+    def test_cost_scheduler(self):
+        self.check_membership(CostScheduler)
+
+    def test_random_scheduler(self):
+        self.check_membership(RandomScheduler)
+
+class TestCoefficientService(unittest.TestCase):
+    def test_launch_on_first_call(self):
+        async def main():
+            coefficients = CoefficientService(["c", "c"], ".")
+            launched = []
+            async def launch(cmd):
+                w = FakeWorker(f"{cmd}{len(launched)}", speed=1.0)
+                w.command, w.alive = cmd, True
+                launched.append(w)
+                coefficients.sched.add_worker(w)
+                return w
+            coefficients.pool.launch = launch
+            await asyncio.sleep(0.001)
+            self.assertEqual(launched, [])
+            results = []
+            for i in range(4):
+                coefficients.call_cb("evalf", (i,), lambda r, e, w: results.append(r[0]), ())
+            await coefficients.sched.drain()
+            return launched, results
+        launched, results = asyncio.run(main())
+        self.assertEqual(len(launched), 2)
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+
+    def check_failed_launch(self, nfailing):
+        async def main():
+            coefficients = CoefficientService(["c", "c"], ".")
+            launched = []
+            async def launch(cmd):
+                launched.append(cmd)
+                if len(launched) <= nfailing:
+                    raise WorkerException("no such worker")
+                w = FakeWorker(f"{cmd}{len(launched)}", speed=1.0)
+                w.command, w.alive = cmd, True
+                coefficients.sched.add_worker(w)
+                return w
+            coefficients.pool.launch = launch
+            results = []
+            for i in range(4):
+                coefficients.call_cb("evalf", (i,), lambda r, e, w: results.append(e or r[0]), ())
+            await asyncio.wait_for(coefficients.sched.drain(), timeout=5)
+            coefficients.pool.close()
+            return coefficients, results
+        return asyncio.run(main())
+
+    def test_failed_launch(self):
+        # The calls fail instead of waiting for a worker forever.
+        coefficients, results = self.check_failed_launch(2)
+        self.assertEqual(results, ["could not launch any coefficient workers: no such worker"]*4)
+        self.assertFalse(coefficients.started)
+
+    def test_partly_failed_launch(self):
+        coefficients, results = self.check_failed_launch(1)
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+
+    def test_cluster_file(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, "cluster.json")
+            self.assertEqual(len(load_coefficient_commands(filename, 3)), 3)
+            with open(filename, "w") as f:
+                f.write('{"cluster": [{"command": ["w"]}], "coefficients": [{"command": ["c"], "count": 2}]}')
+            self.assertEqual(read_cluster_file(filename), [["w"]])
+            self.assertEqual(load_coefficient_commands(filename, 3), [["c"], ["c"]])
+            with open(filename, "w") as f:
+                f.write('{"cluster": [{"command": ["w"]}]}')
+            self.assertEqual(len(load_coefficient_commands(filename, 1)), 1)
+
+class TestDeviceRouting(unittest.TestCase):
+    def check_routing(self, scheduler):
+        async def main(gpu):
+            par = scheduler(gpu_lattice=1000)
+            par.add_worker(FakeWorker("cpu", speed=1e4))
+            if gpu:
+                par.add_worker(FakeWorker("gpu", speed=1e6, overhead=1e-3, features=("gpu",)))
+            results = []
+            for lattice in [100, 5000]*10:
+                par.call_cb("integrate", (0, lattice, 0, lattice), lambda r, e, w: results.append((r[1], w.name)), (), cost=lattice)
+            await par.drain()
+            return set(results)
+        self.assertEqual(asyncio.run(main(True)), {(100, "cpu"), (5000, "gpu")})
+        # Without GPU workers, the CPU ones get everything.
+        self.assertEqual(asyncio.run(main(False)), {(100, "cpu"), (5000, "cpu")})
+
+    def test_cost_scheduler(self):
+        self.check_routing(CostScheduler)
+
+    def test_random_scheduler(self):
+        self.check_routing(RandomScheduler)
+
+    def check_features(self, scheduler):
+        # The "integrate_shifts" jobs only go to the workers that
+        # know it, even if they join later.
+        async def main():
+            par = scheduler()
+            par.add_worker(FakeWorker("old", speed=1e6))
+            results = []
+            for method in ["integrate", "integrate_shifts"]*10:
+                par.call_cb(method, (0, 100, 0, 100), lambda r, e, w, method: results.append((method, w.name)), (method,), cost=100)
+            await asyncio.sleep(0.1)
+            par.add_worker(FakeWorker("new", speed=1e4, features=("integrate_shifts",)))
+            await par.drain()
+            return set(results)
+        self.assertEqual(asyncio.run(main()), {("integrate", "old"), ("integrate_shifts", "new")})
+
+    def test_features_cost_scheduler(self):
+        self.check_features(CostScheduler)
+
+    def test_features_random_scheduler(self):
+        self.check_features(RandomScheduler)
+
+    def test_local_threads(self):
+        self.assertEqual(local_worker_threads([8, 8], 0), [7, 8])
+        self.assertEqual(local_worker_threads([8, 8], 2), [5, 8])
+        self.assertEqual(local_worker_threads([2], 1), [])
+        self.assertEqual(local_worker_threads([1], 0), [1])
+        self.assertEqual(local_worker_threads([8, 8], 1, cpu_threads=10), [6, 4])
+        self.assertEqual(local_worker_threads([8, 8], 1, cpu_threads=0), [])
+
+class TestJobGroup(unittest.TestCase):
+    def test_drain_own_jobs(self):
+        async def main():
+            par = CostScheduler()
+            par.add_worker(FakeWorker("w", speed=1e4))
+            g1 = JobGroup(par)
+            g2 = JobGroup(par)
+            results = []
+            g1.call_cb("job", (1,), lambda r, e, w: results.append(r[0]), (), cost=1)
+            g2.call_cb("job", (1000,), lambda r, e, w: results.append(r[0]), (), cost=1000)
+            tag = g1.call_cb("job", (2,), lambda r, e, w: results.append(r[0]), (), cost=2)
+            self.assertTrue(g1.cancel_cb(tag))
+            await g1.drain()
+            self.assertEqual(results, [1])
+            await g2.drain()
+            return results
+        self.assertEqual(asyncio.run(main()), [1, 1000])
+
+class TestScanInput(unittest.TestCase):
+    def test_csv(self):
+        points = list(read_scan_points(io.StringIO("s, t\n1.0, -2\n3, 4+1j\n")))
+        self.assertEqual(points, [{"s": "1.0", "t": "-2"}, {"s": "3", "t": "4+1j"}])
+        self.assertEqual(parse_value(points[1]["t"]), 4+1j)
+
+    def test_jsonl(self):
+        points = list(read_scan_points(io.StringIO('{"s": 1.0, "coeff-t": 2}\n\n{"s": 3, "int-t": 5}\n')))
+        self.assertEqual(len(points), 2)
+        self.assertEqual(split_valuemap(points[0]), ({"s": 1.0}, {"s": 1.0, "t": 2}))
+        self.assertEqual(split_valuemap(points[1]), ({"s": 3, "t": 5}, {"s": 3}))
+
+# A JSON worker that only answers "start" and "ping". With
+# "old" as its argument it exits on the protocol negotiation,
+# like the workers that predate it; with a file name, it exits
+# at the first start (as if it failed for an unrelated reason)
+# and works normally afterwards.
+START_WORKER = r'''
+import json, os, sys
+for line in sys.stdin:
+    token, method, args = json.loads(line)
+    result = None
+    if method == "start":
+        if len(args) > 1:
+            if sys.argv[1] == "old": sys.exit(1)
+            if not os.path.exists(sys.argv[1]):
+                open(sys.argv[1], "w").close()
+                sys.exit(1)
+            result = [f"fake:{os.getpid()}", "json", []]
+        else:
+            result = f"fake:{os.getpid()}"
+    print("@" + json.dumps([token, result, None]), flush=True)
+'''
+
+class TestLatticeSplitting(unittest.TestCase):
+    def integrate_calls(self, w):
+        # (kernel, lattice, shift) -> [(i1, i2), ...]
+        jobs = {}
+        for method, args in w.calls:
+            if method == "integrate_shifts" and args[0] > 0:
+                idx, lattice, i1, i2, genvec, shifts, deformp = args
+                for shift in shifts:
+                    jobs.setdefault((idx, lattice, tuple(shift)), []).append((i1, i2))
+        return jobs
+
+    def test_bounds_tile_lattice(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            result, w = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, epsrel=1e-4, job_time=3e-5))
+        value, error = fake_result(result)
+        self.assertLess(abs(value - FAKE_VALUE), 1e-3)
+        jobs = self.integrate_calls(w)
+        self.assertGreater(len(jobs), 0)
+        for (idx, lattice, shift), chunks in jobs.items():
+            self.assertGreater(len(chunks), 1)
+            chunks.sort()
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], lattice)
+            for (a1, a2), (b1, b2) in zip(chunks, chunks[1:]):
+                self.assertEqual(a2, b1)
+
+    def test_partial_sums(self):
+        # With a single round, the chunked and the unchunked runs
+        # integrate the same lattices and shifts.
+        with tempfile.TemporaryDirectory() as dirname:
+            whole, w1 = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, job_time=1.0))
+            split, w2 = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, job_time=3e-5))
+        self.assertEqual(sorted(self.integrate_calls(w1)), sorted(self.integrate_calls(w2)))
+        self.assertTrue(all(len(c) == 1 for c in self.integrate_calls(w1).values()))
+        self.assertTrue(all(len(c) > 1 for c in self.integrate_calls(w2).values()))
+        (v1, e1), (v2, e2) = fake_result(whole), fake_result(split)
+        self.assertAlmostEqual(v1, v2, delta=1e-12)
+        self.assertAlmostEqual(e1, e2, delta=1e-12)
+
+    def test_nan_reschedules(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            result, w = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, job_time=3e-5), nan_deformp=0.95)
+        value, error = fake_result(result)
+        self.assertLess(abs(value - FAKE_VALUE), 1e-2)
+        deformps = {args[-1][0] for method, args in w.calls if method == "integrate_shifts" and args[0] > 0}
+        # A single decrease: the NaN of the other chunks of the
+        # cancelled jobs must not decrease it again.
+        self.assertEqual(sorted(deformps), [0.9, 1.0])
+
+    def test_no_workers(self):
+        # While all the workers are gone, the jobs are not split
+        # (there is no speed to go by), and wait for the workers.
+        with tempfile.TemporaryDirectory() as dirname:
+            checkpoint = os.path.join(dirname, "checkpoint.json")
+            run_fake_eval(dirname, lambda prepared: fake_eval(prepared, checkpoint=checkpoint))
+            with open(checkpoint, "r") as f:
+                state = json.load(f)
+            async def body(prepared):
+                w, = prepared.sched.workers
+                prepared.sched.retire_worker(w)
+                asyncio.get_event_loop().call_later(0.1, prepared.sched.add_worker, w)
+                return await fake_eval(prepared, job_time=3e-5, resume=state)
+            result, w = run_fake_eval(dirname, body)
+        value, error = fake_result(result)
+        self.assertLess(abs(value - FAKE_VALUE), 1e-2)
+        jobs = self.integrate_calls(w)
+        self.assertGreater(len(jobs), 0)
+        self.assertTrue(all(len(c) == 1 for c in jobs.values()))
+
+class TestWarmStart(unittest.TestCase):
+    def run_points(self, change=None):
+        # Evaluate two points in a row, optionally changing the
+        # warm start state in between; return the state after the
+        # first point, and the result and the worker calls of the
+        # second one.
+        async def body(prepared):
+            warmstart = {}
+            await fake_eval(prepared, epsrel=1e-6, warmstart=warmstart)
+            first = json.loads(json.dumps(warmstart))
+            if change is not None:
+                change(warmstart)
+            # The kernels that are not warm-started will get
+            # a different deformation parameter.
+            w, = prepared.sched.workers
+            w.maxdeformp = 0.5
+            ncalls = len(w.calls)
+            result = await fake_eval(prepared, epsrel=1e-6, warmstart=warmstart)
+            return first, result, w.calls[ncalls:]
+        with tempfile.TemporaryDirectory() as dirname:
+            (first, result, calls), w = run_fake_eval(dirname, body, maxdeformp=0.7)
+        return first, result, calls
+
+    def test_warm_start(self):
+        first, result, calls = self.run_points()
+        self.assertEqual(sorted(first["fake"]), ["sector_1", "sector_2"])
+        self.assertEqual(first["fake"]["sector_1"]["components"], ["sector_1"])
+        self.assertEqual([method for method, args in calls if method == "maxdeformp"], [])
+        for ker, idx in (("sector_1", 1), ("sector_2", 2)):
+            jobs = [args for method, args in calls if method == "integrate_shifts" and args[0] == idx]
+            self.assertEqual(jobs[0][1], first["fake"][ker]["lattice"])
+            self.assertGreater(jobs[0][1], 1021)
+            self.assertEqual({tuple(args[-1]) for args in jobs}, {(0.7,)})
+        value, error = fake_result(result)
+        self.assertLess(abs(value - FAKE_VALUE), 1e-3)
+
+    def test_different_components(self):
+        def change(warmstart):
+            warmstart["fake"]["sector_1"]["components"] = ["sector_1_order_0", "sector_1_order_1"]
+        first, result, calls = self.run_points(change)
+        self.assertEqual([args[0] for method, args in calls if method == "maxdeformp"], [1])
+        jobs = [args for method, args in calls if method == "integrate_shifts" and args[0] == 1]
+        self.assertEqual(jobs[0][1], 1021)
+        self.assertEqual({tuple(args[-1]) for args in jobs}, {(0.5,)})
+        jobs = [args for method, args in calls if method == "integrate_shifts" and args[0] == 2]
+        self.assertEqual(jobs[0][1], first["fake"]["sector_2"]["lattice"])
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            checkpoint = os.path.join(dirname, "checkpoint.json")
+            resumed = os.path.join(dirname, "resumed.json")
+            # The last checkpoint is made before the last round.
+            result, w = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, epsrel=1e-6, checkpoint=checkpoint))
+            with open(checkpoint, "r") as f:
+                state = json.load(f)
+            self.assertEqual(state["kernels"], [["fake", "sector_1"], ["fake", "sector_2"]])
+            self.assertEqual(state["stage"], 2)
+            self.assertTrue(all(l > 1021 for l in state["lattices"]))
+            # Resuming saves the same state right away; with the
+            # deadline already passed, it stops there.
+            run_fake_eval(dirname, lambda prepared: fake_eval(prepared, epsrel=1e-6, timeout=0, checkpoint=resumed, resume=state))
+            with open(resumed, "r") as f:
+                self.assertEqual(json.load(f), state)
+            # The last round is repeated with the saved lattices.
+            result2, w2 = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, epsrel=1e-6, resume=state))
+        self.assertEqual([args for method, args in w2.calls if method == "maxdeformp"], [])
+        self.assertEqual(
+            {(args[0], args[1], tuple(args[4])) for method, args in w2.calls if method == "integrate_shifts" and args[0] > 0},
+            {(i + 1, l, tuple(g)) for i, (l, g) in enumerate(zip(state["lattices"], state["genvecs"]))})
+        (value, error), (value2, error2) = fake_result(result), fake_result(result2)
+        self.assertLess(abs(value2 - value), 5*abs(error))
+
+    def test_resume_with_cache(self):
+        # The cached lattices and deformation parameters don't
+        # override the checkpointed ones.
+        with tempfile.TemporaryDirectory() as dirname:
+            checkpoint = os.path.join(dirname, "checkpoint.json")
+            async def body(prepared, **kwargs):
+                cache = ResultCache(os.path.join(dirname, "cache"))
+                try:
+                    return await fake_eval(prepared, epsrel=1e-6, cache=cache, **kwargs)
+                finally:
+                    cache.close()
+            run_fake_eval(dirname, lambda prepared: body(prepared, checkpoint=checkpoint))
+            with open(checkpoint, "r") as f:
+                state = json.load(f)
+            state["deformp"] = [[0.25], [0.25]]
+            result, w = run_fake_eval(dirname, lambda prepared: body(prepared, resume=state))
+        self.assertEqual(
+            {tuple(args[6]) for method, args in w.calls if method == "integrate_shifts" and args[0] > 0},
+            {(0.25,)})
+
+    def test_mismatch(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            checkpoint = os.path.join(dirname, "checkpoint.json")
+            run_fake_eval(dirname, lambda prepared: fake_eval(prepared, checkpoint=checkpoint))
+            with open(checkpoint, "r") as f:
+                state = json.load(f)
+            with self.assertRaisesRegex(ValueError, "different kernels"):
+                run_fake_eval(dirname, lambda prepared: fake_eval(prepared, resume=dict(state, kernels=[["fake", "sector_1"]])))
+            with self.assertRaisesRegex(ValueError, "different parameter values"):
+                run_fake_eval(dirname, lambda prepared: fake_eval(prepared, resume=dict(state, parameters={"s": [1.0, 0.0]})))
+
+class TestLatticeConstruction(unittest.TestCase):
+    def test_lattice_cache(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cachedir = os.path.join(dirname, "lattices")
+            result, w = run_fake_eval(dirname, lambda prepared: fake_eval(prepared, npoints0=1500, lattice_step=0.001, lattice_cache=cachedir))
+            lattices = {args[1] for method, args in w.calls if method == "integrate_shifts" and args[0] > 0}
+            self.assertEqual(sorted(os.listdir(cachedir)), sorted(f"cbc_{n}.npy" for n in lattices | {1009}))
+        value, error = fake_result(result)
+        self.assertLess(abs(value - FAKE_VALUE), 1e-2)
+
+class TestLaunchWorker(unittest.TestCase):
+    def launch(self, dirname, arg):
+        script = os.path.join(dirname, "worker.py")
+        with open(script, "w") as f:
+            f.write(START_WORKER)
+        command = [sys.executable, script, arg]
+        async def main():
+            w = await launch_worker(command, dirname, maxtimeout=0.1)
+            await w.call("ping")
+            w.process.kill()
+            await w.process.wait()
+            return w
+        return command, asyncio.run(main())
+
+    def test_old_worker(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            command, w = self.launch(dirname, "old")
+        self.assertEqual(w.features, set())
+        self.assertIn(repr(command), json_only_commands)
+
+    def test_failed_negotiation(self):
+        # A worker that quits once is not taken for an old one.
+        with tempfile.TemporaryDirectory() as dirname:
+            command, w = self.launch(dirname, os.path.join(dirname, "flag"))
+        self.assertNotIn(repr(command), json_only_commands)
+
+    def test_attempts(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            command = [os.path.join(dirname, "missing")]
+            with self.assertRaisesRegex(WorkerException, "failed to start"):
+                asyncio.run(launch_worker(command, dirname, maxtimeout=0.1, attempts=2))
+
+    def test_unknown_protocol(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            with self.assertRaisesRegex(ValueError, "unknown protocol"):
+                asyncio.run(prepare_eval([], dirname, os.path.join(dirname, "x.json"), protocol="binray"))
+
+class TestThreadedCpuWorker(unittest.TestCase):
+    """
+    The real CPU worker with `-t 4`, built from the sources
+    together with the builtin kernel library, loaded as two
+    families with a kernel each.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import pySecDecContrib
+        import subprocess
+        from .code_writer.template_parser import parse_template_file
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.dirname = dirname = cls.tmpdir.name
+        worker = os.path.join(os.path.dirname(pySecDecContrib.__file__), "disteval", "cpuworker.cpp")
+        distsrc = os.path.join(os.path.dirname(__file__), "code_writer", "templates", "make_package", "distsrc")
+        for filename in ("builtin.cpp", "common_cpu.h"):
+            parse_template_file(os.path.join(distsrc, filename), os.path.join(dirname, filename))
+        try:
+            subprocess.check_call(["g++", "-std=c++14", "-O2", "-pthread", "-o", os.path.join(dirname, "cpuworker"), worker, "-ldl"])
+            subprocess.check_call(["g++", "-std=c++14", "-O3", "-funsafe-math-optimizations", "-fPIC", "-shared", "-o", os.path.join(dirname, "builtin.so"), os.path.join(dirname, "builtin.cpp")])
+        except (OSError, subprocess.CalledProcessError) as e:
+            cls.tmpdir.cleanup()
+            raise unittest.SkipTest(f"can't build the CPU worker: {e}")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def run_worker(self, body):
+        async def main():
+            w = await launch_worker([os.path.join(self.dirname, "cpuworker"), "-t", "4"], self.dirname)
+            try:
+                for i in range(2):
+                    await w.call("family", i, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)
+                    await w.call("kernel", i, i, "gauge")
+                return await body(w)
+            finally:
+                w.process.kill()
+                await w.process.wait()
+        return asyncio.run(main())
+
+    def test_job_time(self):
+        # Concurrent jobs of several chunks each share the threads,
+        # but each should only be charged for its own points.
+        async def body(w):
+            await benchmark_worker(w)
+            lattice, genvec = generating_vector(2, 10**6)
+            results = await asyncio.gather(*[
+                w.call("integrate", 0, lattice, 0, 10**5, genvec, [0.3, 0.8], [1.0, 1.0])
+                for i in range(32)
+            ])
+            return [(dt - w.int_overhead)*w.speed/dn for v, dn, dt in results]
+        bubbles = self.run_worker(body)
+        self.assertLess(abs(sum(bubbles)/len(bubbles) - 1), 0.25)
+
+    def test_change_family(self):
+        # Changing the parameters of a family waits for the jobs
+        # of that family only.
+        async def body(w):
+            done = []
+            async def call(name, method, *args):
+                await w.call(method, *args)
+                done.append(name)
+            lattice, genvec = generating_vector(2, 10**7)
+            await asyncio.gather(
+                call("integrate", "integrate", 0, lattice, 0, lattice, genvec, [0.3, 0.8], [1.0, 1.0]),
+                call("change 1", "changefamily", 1, (2.0, 0.1, 0.2, 0.4), ()),
+                call("maxdeformp 1", "maxdeformp", 1, 0, 10**3, generating_vector(2, 10**3)[1], [0.3, 0.8]),
+                call("change 0", "changefamily", 0, (2.0, 0.1, 0.2, 0.4), ()))
+            return done
+        done = self.run_worker(body)
+        self.assertEqual(done, ["change 1", "maxdeformp 1", "integrate", "change 0"])
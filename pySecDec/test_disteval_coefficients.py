@@ -0,0 +1,38 @@
+from .disteval_coefficients import *
+import json
+import os
+import sympy as sp
+import tempfile
+import unittest
+
+class TestCompileCoefficient(unittest.TestCase):
+    def test_two_regulators(self):
+        text = "(s+2*eps)^2/(eps*(1-alpha)*(m-eps))+I*sqrt(s)*alpha^2"
+        data = compile_coefficient(text, ["eps", "alpha"], [1, 1])
+        self.assertEqual(data["parameters"], ["m", "s"])
+        # The alpha^2 term is beyond the requested order.
+        self.assertEqual(sorted(data["powers"]), [[-1, 0], [-1, 1], [0, 0], [0, 1], [1, 0], [1, 1]])
+        result = CompiledCoefficient(data)({"s": 3, "m": 0.5}, [0, 1])
+        eps, alpha = sp.symbols("eps alpha")
+        expected = sp.series(sp.series(
+            (3 + 2*eps)**2/(eps*(1 - alpha)*(sp.Rational(1, 2) - eps)), eps, 0, 1).removeO(), alpha, 0, 2).removeO().expand()
+        self.assertEqual(set(result), {(-1, 0), (-1, 1), (0, 0), (0, 1)})
+        for (i, j), value in result.items():
+            self.assertAlmostEqual(value, complex(expected.coeff(eps, i).coeff(alpha, j)))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, "c.txt")
+            with open(filename, "w") as f:
+                f.write("x/eps+x^2")
+            with open(filename + COMPILED_SUFFIX, "w") as f:
+                json.dump(compile_coefficient("x/eps+x^2", ["eps"], [0]), f)
+            cc = load_compiled_coefficient(filename, ["eps"], [0])
+            self.assertEqual(cc({"x": 2}, [0]), {(-1,): 2, (0,): 4})
+            self.assertIsNone(load_compiled_coefficient(filename, ["eps"], [1]))
+            self.assertIsNone(load_compiled_coefficient(filename, ["alpha"], [0]))
+            # A changed source needs recompiling.
+            with open(filename, "w") as f:
+                f.write("x/eps")
+            os.utime(filename, ns=(0, 0))
+            self.assertIsNone(load_compiled_coefficient(filename, ["eps"], [0]))
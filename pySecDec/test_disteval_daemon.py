@@ -0,0 +1,160 @@
+from .disteval import launch_worker, WorkerException
+from .disteval_daemon import *
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+# A worker that only knows the setup calls, using the JSON
+# protocol; like the real ones, it can't load a family twice,
+# and replies to "family" with its instruction set.
+FAKE_WORKER = r'''
+import json, os, sys
+families = []
+kernels = []
+for line in sys.stdin:
+    token, method, args = json.loads(line)
+    result, error = None, None
+    if method == "start":
+        features = ["lazy_kernels"] if "lazy" in sys.argv else []
+        result = [f"fake:{os.getpid()}", "json", features] if len(args) > 1 else f"fake:{os.getpid()}"
+    elif method == "family":
+        if args[0] != len(families): error = "bad family index"
+        else: families.append(args); result = "fake-isa"
+    elif method == "changefamily":
+        families[args[0]][3:5] = args[1:3]
+    elif method == "kernel":
+        if args[0] != len(kernels): error = "bad kernel index"
+        else: kernels.append(args); result = args[3] if len(args) > 3 else None
+    elif method != "ping":
+        error = "unknown method"
+    print("@" + json.dumps([token, result, error]), flush=True)
+'''
+
+def run_sessions(dirname, session, setups, args=(), **daemon_args):
+    """
+    Start a daemon with FAKE_WORKER (with the given command line
+    arguments, and Daemon arguments), and run session(address,
+    dirname, setup) for each setup in turn; return the list of
+    their results, and the number of idle workers after each.
+    """
+    async def main():
+        with open(os.path.join(dirname, "worker.py"), "w") as f:
+            f.write(FAKE_WORKER)
+        daemon = Daemon([sys.executable, os.path.join(dirname, "worker.py"), *args], **daemon_args)
+        address = "unix:" + os.path.join(dirname, "daemon.sock")
+        server = await start_server(address, daemon)
+        results = []
+        nidle = []
+        for setup in setups:
+            results.append(await session(address, dirname, setup))
+            # Let the daemon take the worker back.
+            for i in range(100):
+                await asyncio.sleep(0.01)
+                if daemon.nactive == 0: break
+            nidle.append(len(daemon.idle))
+        server.close()
+        for w in daemon.idle:
+            w.kill()
+            await w.process.wait()
+        return results, nidle
+    return asyncio.run(main())
+
+class TestDaemon(unittest.TestCase):
+    def test_worker_reuse(self):
+        async def session(address, dirname, families):
+            w = await launch_worker({"connect": address}, dirname)
+            replies = [await w.call("family", 0, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)]
+            await w.call("kernel", 0, 0, "gauge")
+            for i, fam in enumerate(families):
+                replies.append(await w.call("family", i + 1, fam, 3, (), (), False))
+            await w.call("ping")
+            w.process.kill()
+            await w.process.wait()
+            return replies
+        with tempfile.TemporaryDirectory() as dirname:
+            setups = (["a"], ["a"], ["a", "b"], ["b"])
+            replies, nidle = run_sessions(dirname, session, setups)
+        # The replies are the same from a reused worker.
+        self.assertEqual(replies, [["fake-isa"]*(1 + len(families)) for families in setups])
+        # The same setup reuses the worker; a longer setup reuses
+        # it too; a different one needs a new worker.
+        self.assertEqual(nidle, [1, 1, 1, 2])
+
+    def test_kernel_results(self):
+        # A kernel of fused orders returns several results.
+        async def session(address, dirname, nresults):
+            w = await launch_worker({"connect": address}, dirname)
+            await w.call("family", 0, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)
+            await w.call("family", 1, "a", 3, (), (), False)
+            replies = [await w.call("kernel", 0, 0, "gauge")]
+            replies.append(await w.call("kernel", 1, 1, "sector_1", nresults))
+            w.process.kill()
+            await w.process.wait()
+            return replies
+        with tempfile.TemporaryDirectory() as dirname:
+            replies, nidle = run_sessions(dirname, session, (3, 3, 2))
+        self.assertEqual(replies, [[None, 3], [None, 3], [None, 2]])
+        self.assertEqual(nidle, [1, 1, 2])
+
+    def test_lazy_kernels(self):
+        # The families of a worker with lazy kernels have a
+        # trailing flag, as sent by prepare_eval(); here even the
+        # first one, which the daemon uses to wait for the jobs.
+        async def session(address, dirname, families):
+            w = await launch_worker({"connect": address}, dirname)
+            self.assertIn("lazy_kernels", w.features)
+            for i, fam in enumerate(families):
+                await w.call("family", i, fam, 3, (), (), False, True)
+            w.process.kill()
+            await w.process.wait()
+        with tempfile.TemporaryDirectory() as dirname:
+            replies, nidle = run_sessions(dirname, session, (["a"], ["a"]), args=["lazy"])
+        self.assertEqual(nidle, [1, 1])
+
+    def test_rebuilt_library(self):
+        # A worker that has loaded a library that was rebuilt
+        # since then is not reused.
+        async def session(address, dirname, content):
+            if content is not None:
+                with open(os.path.join(dirname, "a.so"), "w") as f:
+                    f.write(content)
+            w = await launch_worker({"connect": address}, dirname)
+            await w.call("family", 0, "builtin", 2, (2.0, 0.1, 0.2, 0.3), (), True)
+            await w.call("family", 1, "a", 3, (), (), False)
+            w.process.kill()
+            await w.process.wait()
+        with tempfile.TemporaryDirectory() as dirname:
+            replies, nidle = run_sessions(dirname, session, ("old", None, "rebuilt"))
+        self.assertEqual(nidle, [1, 1, 2])
+
+    def test_data_dirs(self):
+        async def session(address, dirname, subdir):
+            path = os.path.join(dirname, subdir)
+            os.makedirs(path, exist_ok=True)
+            try:
+                w = await launch_worker({"connect": address}, path, attempts=1)
+            except WorkerException:
+                return "refused"
+            try:
+                await w.call("family", 0, "../a", 3, (), (), False)
+            except WorkerException:
+                return "bad family"
+            finally:
+                w.process.kill()
+                await w.process.wait()
+        with tempfile.TemporaryDirectory() as dirname:
+            replies, nidle = run_sessions(dirname, session, ("allowed", "other"),
+                    data_dirs=[os.path.join(dirname, "allowed")])
+        self.assertEqual(replies, ["bad family", "refused"])
+
+    def test_loopback_only(self):
+        async def main(address, **kwargs):
+            server = await start_server(address, Daemon(["true"]), **kwargs)
+            server.close()
+            await server.wait_closed()
+        asyncio.run(main("127.0.0.1:0"))
+        asyncio.run(main("0.0.0.0:0", allow_remote=True))
+        with self.assertRaisesRegex(ValueError, "non-loopback"):
+            asyncio.run(main("0.0.0.0:0"))
@@ -0,0 +1,57 @@
+from .generating_vectors import *
+from . import generating_vectors
+import numpy as np
+import os
+import tempfile
+import unittest
+
+def slow_cbc(nvariables, n):
+    # The plain O(nvariables n^2) construction, for reference.
+    omega = lambda x: 2*np.pi**2*(x*x - x + 1/6)
+    k = np.arange(n)
+    prod = np.ones(n)
+    genvec = []
+    for s in range(nvariables):
+        if s == 0:
+            z = 1
+        else:
+            err = np.array([prod @ omega(k*z % n/n) for z in range(1, n)])
+            z = 1 + int(np.nonzero(err <= np.min(err) + 1e-10*abs(np.min(err)))[0][0])
+        genvec.append(z)
+        prod *= 1 + omega(k*z % n/n)/(s + 1)**2
+    return genvec
+
+class TestPrimes(unittest.TestCase):
+    def test_next_prime(self):
+        self.assertEqual([next_prime(n) for n in (0, 2, 4, 1000, 2147483640)], [2, 2, 5, 1009, 2147483647])
+        self.assertFalse(is_prime(3215031751))
+        self.assertEqual(primitive_root(101), 2)
+
+class TestCBC(unittest.TestCase):
+    def test_fast_equals_slow(self):
+        for n in (101, 1009):
+            self.assertEqual(cbc_construct(5, n), slow_cbc(5, n))
+
+    def test_extend(self):
+        self.assertEqual(cbc_construct(5, 1009, prefix=cbc_construct(3, 1009)), cbc_construct(5, 1009))
+
+    def test_generating_vector(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            # The tables are used when dense enough.
+            self.assertEqual(generating_vector(3, 1100, step=0.1, cache_dir=dirname)[0], 1123)
+            n, genvec = generating_vector(3, 12345, step=0.02, cache_dir=dirname)
+            self.assertTrue(12345 <= n <= 12345*1.02 and is_prime(n))
+            self.assertEqual(len(genvec), 3)
+            # More dimensions than the tables have.
+            n, genvec = generating_vector(120, 5000, cache_dir=dirname)
+            self.assertEqual((n, len(genvec)), (5003, 120))
+            generating_vectors._cbc_memory.clear()
+            self.assertIsNone(cbc_cached(120, 5003))
+            self.assertEqual(cbc_cached(120, 5003, dirname), genvec)
+            self.assertIsNone(cbc_cached(121, 5003, dirname))
+            # Without a cache directory, the vectors are only
+            # kept in memory.
+            generating_vectors._cbc_memory.clear()
+            n, genvec = generating_vector(4, 2000, step=0.01)
+            self.assertEqual(cbc_cached(4, n), genvec)
+            self.assertFalse(os.path.exists(os.path.join(dirname, f"cbc_{n}.npy")))
@@ -1,5 +1,13 @@
 from . import integral_interface as ii
+from .test_disteval import FakeIntegrator, FAKE_INTEGRAL, FAKE_VALUE
+import asyncio
+import io
+import json
+import os
+import tempfile
+import types
 import unittest
+import unittest.mock
 import pytest
 
 #@pytest.mark.active
@@ -133,3 +141,83 @@ class TestParsing(unittest.TestCase):
               '(3+4*I) + (7+8*I)*eps + O[eps]^2'),
              ('(-90-10*I)*eps + O[eps]^2',
               '(-2-3*I)*eps + O[eps]^2')]
+
+class TestDistevalLibrary(unittest.TestCase):
+    '''
+    DistevalLibrary with the in-process fake workers of the
+    disteval tests.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filename = os.path.join(self.tmpdir.name, "fake.json")
+        with open(self.filename, "w") as f:
+            json.dump(FAKE_INTEGRAL, f)
+        self.workers = []
+        self.killed = []
+        async def launch(command, datadir, protocol="binary"):
+            w = FakeIntegrator(command)
+            w.process = types.SimpleNamespace(kill=lambda: self.killed.append(w))
+            self.workers.append(w)
+            return w
+        for patcher in [
+                unittest.mock.patch("pySecDec.disteval.launch_worker", launch),
+                unittest.mock.patch("pySecDec.disteval.log_file", io.StringIO())]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def library(self, **kwargs):
+        return ii.DistevalLibrary(self.filename, workers=["fake"], verbose=False, **kwargs)
+
+    def value(self, result):
+        value, error = result["sums"]["sum0"][(0,)]
+        return value
+
+    def test_submit(self):
+        with self.library(parallel_points=2) as lib:
+            futures = [
+                lib.submit(epsrel=0.5, points=1000, number_of_presamples=1000, shifts=8, format="json")
+                for i in range(3)
+            ]
+            values = [self.value(f.result(timeout=60)) for f in futures]
+        for value in values:
+            self.assertLess(abs(value - FAKE_VALUE), 1e-2)
+        # Both slots had kernels (1, 2 and 3, 4) evaluated.
+        w, = self.workers
+        kernels = {args[0] for method, args in w.calls if method == "integrate_shifts"}
+        self.assertTrue({1, 2, 3, 4} <= kernels)
+
+    def test_acall(self):
+        async def main(lib):
+            ticks = []
+            async def tick():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+            ticker = asyncio.ensure_future(tick())
+            try:
+                results = await asyncio.gather(*[
+                    lib.acall(epsrel=0.5, points=1000, number_of_presamples=1000, shifts=8, format="json")
+                    for i in range(2)
+                ])
+            finally:
+                ticker.cancel()
+            return results, len(ticks)
+        with self.library(parallel_points=2) as lib:
+            results, nticks = asyncio.run(main(lib))
+        for result in results:
+            self.assertLess(abs(self.value(result) - FAKE_VALUE), 1e-2)
+        # The caller's loop kept running meanwhile.
+        self.assertGreater(nticks, 1)
+
+    def test_close(self):
+        lib = self.library()
+        lib.close()
+        self.assertEqual(self.killed, self.workers)
+        self.assertFalse(lib._thread.is_alive())
+        self.assertTrue(lib._loop.is_closed())
+        with self.assertRaisesRegex(RuntimeError, "closed"):
+            lib.submit()
+        # Closing again does nothing.
+        lib.close()
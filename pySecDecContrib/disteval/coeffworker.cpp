@@ -0,0 +1,425 @@
+#define __STDC_FORMAT_MACROS
+#include <inttypes.h>
+#include <stdarg.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
+#include <map>
+#include <string>
+#include <vector>
+
+#include <ginac/ginac.h>
+#include <ginac/parser.h>
+#include <streambuf>
+#include <istream>
+#include <fstream>
+#include <sstream>
+
+// The coefficient worker: it expands the amplitude coefficients
+// in the regulators with GiNaC and evaluates them numerically
+// (the "evalf" command). This is kept apart from the integration
+// workers, so that those don't need to load GiNaC at all.
+//
+// It only speaks the JSON protocol: one "[token,method,args]"
+// line per command, one "@[token,result,error]" line per reply.
+
+#ifdef unlikely
+    #undef unlikely
+#endif
+
+#if __GNUC__
+    #define unlikely(x) __builtin_expect((x), 0)
+#else
+    #define unlikely(x) (x)
+#endif
+
+typedef double real_t;
+typedef struct { double re, im; } complex_t;
+
+#define MAXPATH 4095
+#define MAXNAME 255
+
+// Global state
+
+static char workername[MAXNAME];
+static char *input_line = NULL;
+static char *input_p = NULL;
+static size_t input_linesize = 0;
+
+#define input_getchar() (*input_p++)
+#define input_peekchar() (*input_p)
+
+static double
+timestamp()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec*1e-9;
+}
+
+// Replies
+
+// Send a reply given the JSON text of its "result,error" part.
+static void
+reply_json_text(uint64_t token, const char *text, size_t size)
+{
+    printf("@[%" PRIu64 ",%.*s]\n", token, (int)size, text);
+    fflush(stdout);
+}
+
+static void
+reply_json(uint64_t token, const char *fmt, ...)
+{
+    char buf[1024];
+    va_list ap;
+    va_start(ap, fmt);
+    int n = vsnprintf(buf, sizeof(buf), fmt, ap);
+    va_end(ap);
+    if (n < (int)sizeof(buf)) {
+        reply_json_text(token, buf, n);
+    } else {
+        char *bigbuf = (char*)malloc(n + 1);
+        va_start(ap, fmt);
+        vsnprintf(bigbuf, n + 1, fmt, ap);
+        va_end(ap);
+        reply_json_text(token, bigbuf, n);
+        free(bigbuf);
+    }
+}
+
+// Parsing
+
+static void
+parse_fail()
+{
+    fprintf(stderr, "%s] input parsing failed:\n", workername);
+    fprintf(stderr, "%s", input_line);
+    for (char *p = input_line + 1; p < input_p; p++)
+        putc('-', stderr);
+    fprintf(stderr, "^\n");
+    exit(1);
+}
+
+static void
+match_c(char c)
+{
+    if (unlikely(c != input_getchar())) {parse_fail();}
+}
+
+static void
+match_str(const char *s)
+{
+    for (; *s; s++) {
+        int c = input_getchar();
+        if (unlikely(c != *s)) {parse_fail();}
+    }
+}
+
+static uint64_t
+parse_uint()
+{
+    char *end = NULL;
+    long long x = strtoll(input_p, &end, 10);
+    if (unlikely(input_p == end)) parse_fail();
+    input_p = end;
+    return (uint64_t)x;
+}
+
+static int64_t
+parse_int()
+{
+    char *end = NULL;
+    long long x = strtoll(input_p, &end, 10);
+    if (unlikely(input_p == end)) parse_fail();
+    input_p = end;
+    return (int64_t)x;
+}
+
+static void
+parse_str(char *str, size_t maxn)
+{
+    match_c('"');
+    for (size_t i = 0; ; i++) {
+        if (unlikely(i >= maxn)) parse_fail();
+        int c = input_getchar();
+        if (unlikely(c == '\\')) {
+            int cc = input_getchar();
+            switch (cc) {
+                case '"': case '\\': case '/': str[i] = cc; break;
+                case 'b': str[i] = '\b'; break;
+                case 'f': str[i] = '\f'; break;
+                case 'n': str[i] = '\n'; break;
+                case 'r': str[i] = '\r'; break;
+                case 't': str[i] = '\t'; break;
+                default: parse_fail();
+            }
+        } else if (unlikely(c == '"')) {
+            str[i] = 0;
+            break;
+        } else {
+            str[i] = c;
+        }
+    }
+}
+
+// GiNaC-related code
+
+struct FixedStreamBuf : public std::streambuf {
+    FixedStreamBuf(char* s, size_t n) { setg(s, s, s + n); }
+};
+
+static GiNaC::ex
+ginac_read_string(GiNaC::parser &reader, char *str, size_t size)
+{
+    FixedStreamBuf buf(str, size);
+    std::istream i(&buf);
+    return reader(i);
+}
+
+static GiNaC::ex
+ginac_read_string(GiNaC::parser &reader, char *str)
+{
+    return ginac_read_string(reader, str, strlen(str));
+}
+
+template <typename F> void
+term_iter(const GiNaC::ex &e, F yield)
+{
+    if (GiNaC::is_a<GiNaC::add>(e)) {
+        for (const auto &t : e) {
+            yield(t);
+        }
+    } else {
+        yield(e);
+    }
+}
+
+template <typename F> void
+factor_iter(const GiNaC::ex &e, F yield)
+{
+    if (GiNaC::is_a<GiNaC::mul>(e)) {
+        for (const auto &f : e) {
+            if (GiNaC::is_a<GiNaC::power>(f)) {
+                yield(f.op(0), GiNaC::ex_to<GiNaC::numeric>(f.op(1)).to_int());
+            } else {
+                yield(f, 1);
+            }
+        }
+    } else {
+        if (GiNaC::is_a<GiNaC::power>(e)) {
+            yield(e.op(0), GiNaC::ex_to<GiNaC::numeric>(e.op(1)).to_int());
+        } else {
+            yield(e, 1);
+        }
+    }
+}
+
+static std::map<std::vector<int>, GiNaC::ex>
+ginac_bracket(const GiNaC::ex &expr, const GiNaC::exvector &X)
+{
+    std::map<std::vector<int>, GiNaC::ex> result;
+    std::map<GiNaC::ex, int, GiNaC::ex_is_less> x2id;
+    for (unsigned i = 0; i < X.size(); i++) {
+        x2id[X[i]] = i;
+    }
+    term_iter(expr.expand(), [&](const GiNaC::ex &term) {
+        std::vector<int> stemidx(X.size());
+        GiNaC::exvector coef;
+        factor_iter(term, [&](const GiNaC::ex &factor, int power) {
+            auto it = x2id.find(factor);
+            if (it != x2id.end()) {
+                stemidx[it->second] = power;
+            } else {
+                if (power == 1) {
+                    coef.push_back(factor);
+                } else {
+                    coef.push_back(pow(factor, power));
+                }
+            }
+        });
+        result[stemidx] += GiNaC::mul(coef);
+    });
+    return result;
+}
+
+static double
+parse_cmd_evalf(uint64_t token)
+{
+    char filename[MAXPATH];
+    parse_str(filename, sizeof(filename));
+    // Keep the parsed coefficients, so that the next points only
+    // substitute and expand them; the parser is kept too, so that
+    // the symbols of the substitution table would match.
+    static GiNaC::parser reader;
+    static std::map<std::string, std::pair<struct timespec, GiNaC::ex>> parsed;
+    double t1 = timestamp();
+    struct stat st;
+    if (stat(filename, &st) != 0) {
+        reply_json(token, "null,\"failed to open '%s'\"", filename);
+        exit(1);
+    }
+    auto it = parsed.find(filename);
+    if (it == parsed.end() ||
+            it->second.first.tv_sec != st.st_mtim.tv_sec ||
+            it->second.first.tv_nsec != st.st_mtim.tv_nsec) {
+        std::ifstream inf(filename);
+        if (!inf) {
+            reply_json(token, "null,\"failed to open '%s'\"", filename);
+            exit(1);
+        }
+        parsed[filename] = std::make_pair(st.st_mtim, reader(inf));
+        it = parsed.find(filename);
+    }
+    GiNaC::ex expr = it->second.second;
+    GiNaC::exmap table;
+    match_str(",{");
+    char varname[MAXNAME];
+    if (input_peekchar() != '}') {
+        char value[MAXPATH];
+        for (;;) {
+            parse_str(varname, sizeof(varname));
+            match_c(':');
+            parse_str(value, sizeof(value));
+            table[ginac_read_string(reader, varname)] = ginac_read_string(reader, value);
+            if (input_peekchar() != ',') break;
+            input_getchar();
+        }
+    }
+    match_str("},[");
+    expr = expr.subs(table);
+    GiNaC::exvector varlist;
+    for (;;) {
+        match_c('[');
+        parse_str(varname, sizeof(varname));
+        match_c(',');
+        int64_t order = parse_int();
+        match_c(']');
+        auto x = ginac_read_string(reader, varname);
+        varlist.push_back(x);
+        expr = GiNaC::series_to_poly(expr.series(x, order+1));
+        if (input_peekchar() != ',') break;
+        input_getchar();
+    }
+    match_str("]]]\n");
+    auto br = ginac_bracket(expr.expand(), varlist);
+    std::map<std::vector<int>, complex_t> brc;
+    for (auto &&kv : br) {
+        GiNaC::ex val = kv.second.evalf();
+        GiNaC::ex val_re = val.real_part();
+        GiNaC::ex val_im = val.imag_part();
+        if (GiNaC::is_a<GiNaC::numeric>(val_re) && GiNaC::is_a<GiNaC::numeric>(val_im)) {
+            double re = GiNaC::ex_to<GiNaC::numeric>(val_re).to_double();
+            double im = GiNaC::ex_to<GiNaC::numeric>(val_im).to_double();
+            brc[kv.first] = complex_t{re, im};
+        } else {
+            reply_json(token, "null,\"the coefficient is not numeric after substitution\"");
+            return 0;
+        }
+    }
+    double t2 = timestamp();
+    std::string text = "[";
+    char buf[64];
+    bool first = true;
+    for (auto &&kv : brc) {
+        if (first) { first = false; } else { text += ','; }
+        text += "[[";
+        bool first2 = true;
+        for (auto &&i : kv.first) {
+            if (first2) { first2 = false; } else { text += ','; }
+            snprintf(buf, sizeof(buf), "%d", i);
+            text += buf;
+        }
+        snprintf(buf, sizeof(buf), "],[%.16e,%.16e]]", kv.second.re, kv.second.im);
+        text += buf;
+    }
+    text += "],null";
+    reply_json_text(token, text.data(), text.size());
+    return t2 - t1;
+}
+
+// Main RPC cycle
+
+static double
+handle_one_command()
+{
+    match_c('[');
+    uint64_t token = parse_uint();
+    match_c(','); match_c('"');
+    int c = input_getchar();
+    if (c == 'e') {
+        match_str("valf\",[");
+        return parse_cmd_evalf(token);
+    }
+    if (c == 'p') {
+        match_str("ing\",[]]\n");
+        reply_json(token, "null,null");
+        return 0;
+    }
+    if (c == 's') {
+        char dirname[MAXPATH + 1];
+        match_str("tart\",[");
+        parse_str(dirname, sizeof(dirname));
+        bool negotiate = false;
+        if (input_peekchar() == ',') {
+            // Protocol negotiation: only JSON is supported here,
+            // whatever is asked for.
+            negotiate = true;
+            match_str(",[");
+            char protocol[MAXNAME];
+            while (input_peekchar() != ']') {
+                parse_str(protocol, sizeof(protocol));
+                if (input_peekchar() == ',') input_getchar();
+            }
+            match_c(']');
+        }
+        match_str("]]\n");
+        int r = chdir(dirname);
+        if (r != 0) {
+            reply_json(token, "null,\"failed to chdir '%s': %d\"", dirname, r);
+        } else if (negotiate) {
+            reply_json(token, "[\"%s\",\"json\",[\"evalf\"]],null", workername);
+        } else {
+            reply_json(token, "\"%s\",null", workername);
+        }
+        return 0;
+    }
+    parse_fail();
+    return 0;
+}
+
+static void
+fill_workername()
+{
+    char host[MAXNAME] = {};
+    gethostname(host, sizeof(host));
+    long pid = getpid();
+    snprintf(workername, sizeof(workername), "%s:%ld", host, pid);
+}
+
+int
+main(int argc, char *argv[])
+{
+    fill_workername();
+    if (argc != 1) {
+        fprintf(stderr, "%s] usage: %s\n", workername, argv[0]);
+        exit(1);
+    }
+    setvbuf(stdin, NULL, _IOFBF, 1024*1024);
+    setvbuf(stdout, NULL, _IOFBF, 1024*1024);
+    setvbuf(stderr, NULL, _IOLBF, 1024*1024);
+    double workt = 0;
+    double t1 = timestamp();
+    uint64_t ncalls = 0;
+    while (getline(&input_line, &input_linesize, stdin) >= 0) {
+        input_p = input_line;
+        workt += handle_one_command();
+        ncalls++;
+    }
+    double t2 = timestamp();
+    fprintf(stderr, "%s] Done in %.3gs: %" PRIu64 " calls, %.3g%% useful time\n",
+            workername, t2-t1, ncalls, 100*workt/(t2-t1));
+}
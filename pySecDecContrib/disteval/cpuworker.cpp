@@ -4,21 +4,18 @@
 #include <errno.h>
 #include <inttypes.h>
 #include <math.h>
+#include <pthread.h>
+#include <stdarg.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <time.h>
 #include <unistd.h>
+#include <deque>
+#include <string>
 #include <vector>
 
-#include <ginac/ginac.h>
-#include <ginac/parser.h>
-#include <streambuf>
-#include <istream>
-#include <fstream>
-#include <sstream>
-
 #ifdef unlikely
     #undef unlikely
 #endif
@@ -35,6 +32,9 @@ typedef struct { double re, im; } complex_t;
 #define MAXPATH 4095
 #define MAXNAME 255
 #define MAXDIM 32
+#define MAXSHIFTS 64
+#define MAXRESULTS 1024
+#define MINCHUNK 16384
 
 typedef int (*IntegrateF)(
     void * presult,
@@ -77,10 +77,25 @@ struct Family {
     bool complex_result;
     void* so_handle;
     char name[MAXNAME + 1];
+    // A lazily registered family only has its library chosen;
+    // it is opened when its first kernel is loaded.
+    char path[2*MAXNAME + 16];
+    // The number of unfinished jobs in threaded mode (guarded
+    // by the pool lock).
+    uint64_t njobs;
 };
 
+// A kernel may return several values at once (e.g. all the
+// orders of a sector, when built with fused orders): then the
+// library also exports `<name>__nresults`, and the integration
+// function writes that many complex_t values.
+//
+// A lazily registered kernel is only resolved (with nresults
+// checked against the expected value) on its first use.
 struct Kernel {
     uint64_t familyidx;
+    uint64_t nresults;
+    bool loaded;
     IntegrateF fn_integrate;
     MaxdeformpF fn_maxdeformp;
     FpolycheckF fn_fpolycheck;
@@ -91,6 +106,8 @@ struct Kernel {
 
 struct StartCmd {
     char dirname[MAXPATH + 1];
+    bool negotiate;
+    bool binary;
 };
 
 struct FamilyCmd {
@@ -100,12 +117,15 @@ struct FamilyCmd {
     real_t realp[MAXDIM];
     complex_t complexp[MAXDIM];
     bool complex_result;
+    bool lazy;
 };
 
 struct KernelCmd {
     uint64_t index;
     uint64_t familyidx;
     char name[MAXNAME + 1];
+    bool lazy;
+    uint64_t nresults;
 };
 
 struct PresampleCmd {
@@ -126,6 +146,136 @@ struct IntegrateCmd {
     real_t deformp[MAXDIM];
 };
 
+struct IntegrateShiftsCmd {
+    uint64_t kernelidx;
+    uint64_t lattice;
+    uint64_t i1;
+    uint64_t i2;
+    uint64_t nshifts;
+    uint64_t genvec[MAXDIM];
+    real_t shift[MAXSHIFTS][MAXDIM];
+    real_t deformp[MAXDIM];
+};
+
+// Binary protocol
+//
+// After a successful negotiation via the "start" command, each
+// message in both directions becomes a frame: a FrameHeader
+// followed by `size` bytes of payload. All the numbers are
+// little-endian. The frequent commands have fixed-layout
+// payloads; the rest are sent as JSON messages inside a frame.
+
+struct FrameHeader {
+    uint64_t token;
+    uint32_t kind;
+    uint32_t size;
+};
+
+#define METHOD_JSON 0
+#define METHOD_INTEGRATE 1
+#define METHOD_MAXDEFORMP 2
+#define METHOD_PING 3
+#define METHOD_INTEGRATE_SHIFTS 4
+
+#define REPLY_JSON 0
+#define REPLY_INTEGRATE 1
+#define REPLY_REALS 2
+#define REPLY_INTEGRATE_SHIFTS 3
+
+struct IntegrateFrame {
+    uint64_t kernelidx;
+    uint64_t lattice;
+    uint64_t i1;
+    uint64_t i2;
+    uint64_t ndim;
+    uint64_t ndeformp;
+    // uint64_t genvec[ndim];
+    // real_t shift[ndim];
+    // real_t deformp[ndeformp];
+};
+
+struct IntegrateShiftsFrame {
+    uint64_t kernelidx;
+    uint64_t lattice;
+    uint64_t i1;
+    uint64_t i2;
+    uint64_t ndim;
+    uint64_t ndeformp;
+    uint64_t nshifts;
+    // uint64_t genvec[ndim];
+    // real_t shift[nshifts][ndim];
+    // real_t deformp[ndeformp];
+};
+
+struct MaxdeformpFrame {
+    uint64_t kernelidx;
+    uint64_t ndeformp;
+    uint64_t lattice;
+    uint64_t ndim;
+    // uint64_t genvec[ndim];
+    // real_t shift[ndim];
+};
+
+struct IntegrateReply {
+    real_t re;
+    real_t im;
+    uint64_t npoints;
+    real_t dt;
+};
+
+struct IntegrateShiftsReply {
+    uint64_t npoints;
+    real_t dt;
+    // complex_t result[nshifts][nresults];
+};
+
+// Threaded mode
+//
+// With `-t N`, integration commands become jobs in a queue that
+// N threads work on, while the main thread keeps reading the
+// input. Each job is split into chunks of lattice indices of
+// a single shift, so that a large job is spread over all the
+// threads, and several small jobs run concurrently. The
+// "changefamily" command first waits for the jobs of that family
+// to finish, so that the other families (e.g. the other points
+// of a scan) keep integrating meanwhile; "maxdeformp" and "ping"
+// do not wait. All other commands first wait for the queue to
+// empty, so the threads never see families and kernels added.
+//
+// A job reports the CPU time of its chunks summed over the
+// threads and divided by N: the wall time from its first chunk
+// to its last would include the chunks of the other jobs that
+// ran in between, while the speed from the worker benchmark
+// is that of a single job spread over all the threads.
+
+struct Job {
+    uint64_t token;
+    bool multishift;
+    IntegrateShiftsCmd cmd;
+    uint64_t chunksize;
+    uint64_t chunkspershift;
+    uint64_t nchunks;
+    uint64_t nextchunk;
+    uint64_t donechunks;
+    uint64_t npoints;
+    double worktime;
+    bool failed;
+    bool haserror;
+    char error[3*MAXNAME];
+    std::vector<complex_t> result;
+};
+
+static struct ThreadPool {
+    int nthreads = 0;
+    std::vector<pthread_t> threads;
+    std::deque<Job*> queue;
+    uint64_t njobs = 0;
+    double useful_time = 0;
+    pthread_mutex_t lock = PTHREAD_MUTEX_INITIALIZER;
+    pthread_cond_t cond_job = PTHREAD_COND_INITIALIZER;
+    pthread_cond_t cond_idle = PTHREAD_COND_INITIALIZER;
+} pool;
+
 // Global data
 static char workername[MAXNAME];
 static std::vector<Family> families;
@@ -133,6 +283,12 @@ static std::vector<Kernel> kernels;
 static char *input_line = NULL;
 static char *input_p = NULL;
 static size_t input_linesize = 0;
+static bool binary_protocol = false;
+static const char *forced_isa = NULL;
+// Statistics of the library and kernel loading.
+static uint64_t nloaded_families = 0;
+static uint64_t nloaded_kernels = 0;
+static double load_time = 0;
 
 #define input_getchar() (*input_p++)
 #define input_peekchar() (*input_p)
@@ -145,14 +301,236 @@ timestamp()
     return ts.tv_sec + ts.tv_nsec*1e-9;
 }
 
+// The CPU time of the calling thread, which (unlike the wall
+// time) does not grow while the thread waits for a processor.
+static double
+thread_cputime()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    return ts.tv_sec + ts.tv_nsec*1e-9;
+}
+
+// Instruction sets
+
+// The kernel libraries may come in several variants, "name.so"
+// being the portable one, and "name.<isa>.so" compiled for a
+// specific instruction set (see DISTEVAL_ISAS in the Makefile).
+// These are tried from the best to the worst.
+static const char *isa_names[] = {"avx512", "avx2", "sse2"};
+
+static bool
+isa_supported(const char *isa)
+{
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+    __builtin_cpu_init();
+    if (strcmp(isa, "avx512") == 0)
+        return __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma");
+    if (strcmp(isa, "avx2") == 0)
+        return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma");
+    if (strcmp(isa, "sse2") == 0)
+        return __builtin_cpu_supports("sse2");
+#endif
+    return false;
+}
+
+// Open the best variant of "name" for this processor, or the one
+// for the given instruction set, if not NULL ("generic" meaning
+// the portable one). Set *isa to the chosen variant.
+static void *
+open_library(const char *name, const char **isa, char *path, size_t pathsize)
+{
+    if (*isa == NULL) {
+        for (const char *candidate : isa_names) {
+            if (!isa_supported(candidate)) continue;
+            snprintf(path, pathsize, "./%s.%s.so", name, candidate);
+            if (access(path, F_OK) != 0) continue;
+            void *so_handle = dlopen(path, RTLD_LAZY | RTLD_LOCAL);
+            if (so_handle != NULL) {
+                *isa = candidate;
+                return so_handle;
+            }
+            fprintf(stderr, "%s] failed to open '%s': %s\n", workername, path, dlerror());
+        }
+        *isa = "generic";
+    }
+    if (strcmp(*isa, "generic") == 0) {
+        snprintf(path, pathsize, "./%s.so", name);
+    } else {
+        snprintf(path, pathsize, "./%s.%s.so", name, *isa);
+    }
+    return dlopen(path, RTLD_LAZY | RTLD_LOCAL);
+}
+
+// Same as open_library(), but only choose the variant by the
+// presence of the file, without opening it.
+static void
+choose_library(const char *name, const char **isa, char *path, size_t pathsize)
+{
+    if (*isa == NULL) {
+        for (const char *candidate : isa_names) {
+            if (!isa_supported(candidate)) continue;
+            snprintf(path, pathsize, "./%s.%s.so", name, candidate);
+            if (access(path, F_OK) == 0) {
+                *isa = candidate;
+                return;
+            }
+        }
+        *isa = "generic";
+    }
+    if (strcmp(*isa, "generic") == 0) {
+        snprintf(path, pathsize, "./%s.so", name);
+    } else {
+        snprintf(path, pathsize, "./%s.%s.so", name, *isa);
+    }
+}
+
+static bool
+isnan_any(const complex_t *result, size_t n)
+{
+    for (size_t i = 0; i < n; i++)
+        if (isnan(result[i].re) || isnan(result[i].im)) return true;
+    return false;
+}
+
+// Replies
+
+static void
+reply_frame(uint64_t token, uint32_t kind, const void *data, size_t size)
+{
+    FrameHeader h = {token, kind, (uint32_t)size};
+    flockfile(stdout);
+    fwrite(&h, sizeof(h), 1, stdout);
+    fwrite(data, 1, size, stdout);
+    fflush(stdout);
+    funlockfile(stdout);
+}
+
+// Send a reply given the JSON text of its "result,error" part.
+static void
+reply_json_text(uint64_t token, const char *text, size_t size)
+{
+    flockfile(stdout);
+    if (binary_protocol) {
+        FrameHeader h = {token, REPLY_JSON, (uint32_t)size + 2};
+        fwrite(&h, sizeof(h), 1, stdout);
+        putchar('[');
+        fwrite(text, 1, size, stdout);
+        putchar(']');
+    } else {
+        printf("@[%" PRIu64 ",%.*s]\n", token, (int)size, text);
+    }
+    fflush(stdout);
+    funlockfile(stdout);
+}
+
+static void
+reply_json(uint64_t token, const char *fmt, ...)
+{
+    char buf[1024];
+    va_list ap;
+    va_start(ap, fmt);
+    int n = vsnprintf(buf, sizeof(buf), fmt, ap);
+    va_end(ap);
+    if (n < (int)sizeof(buf)) {
+        reply_json_text(token, buf, n);
+    } else {
+        char *bigbuf = (char*)malloc(n + 1);
+        va_start(ap, fmt);
+        vsnprintf(bigbuf, n + 1, fmt, ap);
+        va_end(ap);
+        reply_json_text(token, bigbuf, n);
+        free(bigbuf);
+    }
+}
+
+static void
+reply_integrate(uint64_t token, const complex_t &result, uint64_t npoints, double dt, const char *error)
+{
+    bool isnan_result = isnan(result.re) || isnan(result.im);
+    if (binary_protocol && error == NULL) {
+        IntegrateReply r = {result.re, result.im, npoints, dt};
+        reply_frame(token, REPLY_INTEGRATE, &r, sizeof(r));
+    } else if (error != NULL) {
+        reply_json(token, "[[NaN,NaN],%" PRIu64 ",%.4e],\"%s\"", npoints, dt, error);
+    } else if (isnan_result) {
+        reply_json(token, "[[NaN,NaN],%" PRIu64 ",%.4e],null", npoints, dt);
+    } else {
+        reply_json(token, "[[%.16e,%.16e],%" PRIu64 ",%.4e],null", result.re, result.im, npoints, dt);
+    }
+}
+
+// Reply with n values: one per shift, or, for the kernels with
+// several results, all the results of the first shift, then of
+// the second one, etc.
+static void
+reply_integrate_shifts(uint64_t token, const complex_t *result, size_t n, uint64_t npoints, double dt, const char *error)
+{
+    if (binary_protocol && error == NULL) {
+        IntegrateShiftsReply r = {npoints, dt};
+        FrameHeader h = {token, REPLY_INTEGRATE_SHIFTS, (uint32_t)(sizeof(r) + n*sizeof(complex_t))};
+        flockfile(stdout);
+        fwrite(&h, sizeof(h), 1, stdout);
+        fwrite(&r, sizeof(r), 1, stdout);
+        fwrite(result, sizeof(complex_t), n, stdout);
+        fflush(stdout);
+        funlockfile(stdout);
+        return;
+    }
+    std::string text = "[[";
+    char buf[96];
+    for (size_t i = 0; i < n; i++) {
+        if (i != 0) text += ',';
+        if (isnan(result[i].re) || isnan(result[i].im)) {
+            text += "[NaN,NaN]";
+        } else {
+            snprintf(buf, sizeof(buf), "[%.16e,%.16e]", result[i].re, result[i].im);
+            text += buf;
+        }
+    }
+    snprintf(buf, sizeof(buf), "],%" PRIu64 ",%.4e],", npoints, dt);
+    text += buf;
+    if (error != NULL) {
+        text += '"';
+        text += error;
+        text += '"';
+    } else {
+        text += "null";
+    }
+    reply_json_text(token, text.data(), text.size());
+}
+
+static void
+reply_reals(uint64_t token, const real_t *values, size_t n)
+{
+    if (binary_protocol) {
+        reply_frame(token, REPLY_REALS, values, n*sizeof(real_t));
+    } else {
+        std::string text = "[";
+        char buf[32];
+        for (size_t i = 0; i < n; i++) {
+            if (i != 0) text += ',';
+            snprintf(buf, sizeof(buf), "%.16e", values[i]);
+            text += buf;
+        }
+        text += "],null";
+        reply_json_text(token, text.data(), text.size());
+    }
+}
+
+// Commands
+
 static double
 cmd_start(uint64_t token, StartCmd &c)
 {
     int r = chdir(c.dirname);
-    if (r == 0) {
-        printf("@[%" PRIu64 ",\"%s\",null]\n", token, workername);
+    if (r != 0) {
+        reply_json(token, "null,\"failed to chdir '%s': %d\"", c.dirname, r);
+    } else if (c.negotiate) {
+        reply_json(token, "[\"%s\",\"%s\",[\"integrate_shifts\",\"lazy_kernels\"]],null", workername, c.binary ? "binary" : "json");
+        binary_protocol = c.binary;
     } else {
-        printf("@[%" PRIu64 ",null,\"failed to chdir '%s': %d\"]\n", token, c.dirname, r);
+        reply_json(token, "\"%s\",null", workername);
     }
     return 0;
 }
@@ -161,80 +539,153 @@ static double
 cmd_family(uint64_t token, FamilyCmd &c)
 {
     assert(c.index == families.size());
-    char buf[MAXNAME+8];
-    snprintf(buf, sizeof(buf), "./%s.so", c.name);
-    void *so_handle = dlopen(buf, RTLD_LAZY | RTLD_LOCAL);
-    if (so_handle == NULL) {
-        printf("@[%" PRIu64 ",null,\"failed to open '%s': %s\"]\n", token, buf, strerror(errno));
-        return 0;
+    // A "name@isa" family is loaded from that variant of the library.
+    const char *isa = forced_isa;
+    char *at = strchr(c.name, '@');
+    if (at != NULL) {
+        *at = 0;
+        isa = at + 1;
     }
     Family fam = {};
+    if (c.lazy) {
+        choose_library(c.name, &isa, fam.path, sizeof(fam.path));
+    } else {
+        double t1 = timestamp();
+        fam.so_handle = open_library(c.name, &isa, fam.path, sizeof(fam.path));
+        if (fam.so_handle == NULL) {
+            reply_json(token, "null,\"failed to open '%s': %s\"", fam.path, strerror(errno));
+            return 0;
+        }
+        load_time += timestamp() - t1;
+        nloaded_families++;
+    }
     fam.dimension = c.dimension;
     memcpy(fam.realp, c.realp, sizeof(fam.realp));
     memcpy(fam.complexp, c.complexp, sizeof(fam.complexp));
     fam.complex_result = c.complex_result;
-    fam.so_handle = so_handle;
     memcpy(fam.name, c.name, sizeof(fam.name));
     families.push_back(fam);
-    printf("@[%" PRIu64 ",null,null]\n", token);
+    reply_json(token, "\"%s\",null", isa);
     return 0;
 }
 
+static void wait_for_family(uint64_t familyidx);
+
 static double
 cmd_change_family_parameters(uint64_t token, FamilyCmd &c)
 {
     assert(c.index < families.size());
+    wait_for_family(c.index);
     Family &fam = families[c.index];
     memcpy(fam.realp, c.realp, sizeof(fam.realp));
     memcpy(fam.complexp, c.complexp, sizeof(fam.complexp));
-    printf("@[%" PRIu64 ",null,null]\n", token);
+    reply_json(token, "null,null");
     return 0;
 }
 
+// Open the library of a lazily registered family; on failure
+// reply with an error and return false.
+static bool
+load_family(uint64_t token, Family &fam)
+{
+    double t1 = timestamp();
+    fam.so_handle = dlopen(fam.path, RTLD_LAZY | RTLD_LOCAL);
+    if (fam.so_handle == NULL) {
+        reply_json(token, "null,\"failed to open '%s': %s\"", fam.path, dlerror());
+        return false;
+    }
+    load_time += timestamp() - t1;
+    nloaded_families++;
+    return true;
+}
+
+// Resolve the functions of a kernel (opening its library if
+// needed); on failure reply with an error and return false.
+// If expected is not 0, the kernel must return that many values.
+static bool
+load_kernel(uint64_t token, Kernel &ker, uint64_t expected)
+{
+    Family &fam = families[ker.familyidx];
+    if (fam.so_handle == NULL && !load_family(token, fam)) return false;
+    double t1 = timestamp();
+    char buf[2*MAXNAME+18];
+    snprintf(buf, sizeof(buf), "%s__%s", fam.name, ker.name);
+    ker.fn_integrate = (IntegrateF)dlsym(fam.so_handle, buf);
+    if (ker.fn_integrate == NULL) {
+        reply_json(token, "null,\"function not found: %s\"", buf);
+        return false;
+    }
+    snprintf(buf, sizeof(buf), "%s__%s__nresults", fam.name, ker.name);
+    const int *nresults = (const int*)dlsym(fam.so_handle, buf);
+    ker.nresults = nresults != NULL ? *nresults : 1;
+    if (ker.nresults < 1 || ker.nresults > MAXRESULTS) {
+        reply_json(token, "null,\"bad number of results in %s: %" PRIu64 "\"", buf, ker.nresults);
+        return false;
+    }
+    if (expected != 0 && ker.nresults != expected) {
+        reply_json(token, "null,\"kernel %s.%s has %" PRIu64 " results instead of %" PRIu64 "\"", fam.name, ker.name, ker.nresults, expected);
+        return false;
+    }
+    snprintf(buf, sizeof(buf), "%s__%s__maxdeformp", fam.name, ker.name);
+    ker.fn_maxdeformp = (MaxdeformpF)dlsym(fam.so_handle, buf);
+    snprintf(buf, sizeof(buf), "%s__%s__fpolycheck", fam.name, ker.name);
+    ker.fn_fpolycheck = (FpolycheckF)dlsym(fam.so_handle, buf);
+    ker.loaded = true;
+    load_time += timestamp() - t1;
+    nloaded_kernels++;
+    return true;
+}
+
+// Make sure the kernel is loaded before it is used; on failure
+// reply with an error and return false.
+static bool
+use_kernel(uint64_t token, uint64_t kernelidx)
+{
+    if (unlikely(kernelidx >= kernels.size())) {
+        reply_json(token, "null,\"kernel %" PRIu64 " was not loaded\"", kernelidx);
+        return false;
+    }
+    Kernel &ker = kernels[kernelidx];
+    if (ker.loaded) return true;
+    return load_kernel(token, ker, ker.nresults);
+}
+
 static double
 cmd_kernel(uint64_t token, KernelCmd &c)
 {
     assert(c.familyidx < families.size());
     assert(c.index == kernels.size());
-    const Family &fam = families[c.familyidx];
-    char buf[2*MAXNAME+18];
     Kernel ker = {};
     ker.familyidx = c.familyidx;
-    snprintf(buf, sizeof(buf), "%s__%s", fam.name, c.name);
-    ker.fn_integrate = (IntegrateF)dlsym(fam.so_handle, buf);
-    if (ker.fn_integrate == NULL) {
-        printf("@[%" PRIu64 ",null,\"function not found: %s\"]\n", token, buf);
+    memcpy(ker.name, c.name, sizeof(ker.name));
+    if (c.lazy) {
+        // Trust the expected number of results for now; it is
+        // checked when the kernel is loaded.
+        ker.nresults = c.nresults;
+    } else if (!load_kernel(token, ker, 0)) {
         return 0;
     }
-    snprintf(buf, sizeof(buf), "%s__%s__maxdeformp", fam.name, c.name);
-    ker.fn_maxdeformp = (MaxdeformpF)dlsym(fam.so_handle, buf);
-    snprintf(buf, sizeof(buf), "%s__%s__fpolycheck", fam.name, c.name);
-    ker.fn_fpolycheck = (FpolycheckF)dlsym(fam.so_handle, buf);
-    memcpy(ker.name, c.name, sizeof(ker.name));
     kernels.push_back(ker);
-    printf("@[%" PRIu64 ",null,null]\n", token);
+    reply_json(token, "%" PRIu64 ",null", ker.nresults);
     return 0;
 }
 
 static double
 cmd_presample(uint64_t token, PresampleCmd &c)
 {
-    if (unlikely(c.kernelidx >= kernels.size())) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " was not loaded\"]\n", token, c.kernelidx);
-        return 0;
-    }
+    if (unlikely(!use_kernel(token, c.kernelidx))) return 0;
     const Kernel &ker = kernels[c.kernelidx];
     const Family &fam = families[ker.familyidx];
     if (unlikely(c.ndeformp == 0)) {
-        printf("@[%" PRIu64 ",[],null]\n", token);
+        reply_json(token, "[],null");
         return 0;
     }
     if (unlikely(ker.fn_maxdeformp == NULL)) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " has no *__maxdefomp function\"]\n", token, c.kernelidx);
+        reply_json(token, "null,\"kernel %" PRIu64 " has no *__maxdefomp function\"", c.kernelidx);
         return 0;
     }
     if (unlikely(ker.fn_fpolycheck == NULL)) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " has no *__fpolycheck function\"]\n", token, c.kernelidx);
+        reply_json(token, "null,\"kernel %" PRIu64 " has no *__fpolycheck function\"", c.kernelidx);
         return 0;
     }
     double deformp[MAXDIM] = {};
@@ -251,40 +702,232 @@ cmd_presample(uint64_t token, PresampleCmd &c)
         for (uint64_t i = 0; i < c.ndeformp; i++) deformp[i] *= 0.9;
     }
     double t2 = timestamp();
-    printf("@[%" PRIu64 ",[", token);
-    for (uint64_t i = 0; i < c.ndeformp; i++) {
-        if (i != 0) putchar(',');
-        printf("%.16e", deformp[i]);
-    }
-    printf("],null]\n");
+    reply_reals(token, deformp, c.ndeformp);
     return t2-t1;
 }
 
+static double submit_job(uint64_t token, bool multishift, const IntegrateShiftsCmd &c);
+
 static double
 cmd_integrate(uint64_t token, IntegrateCmd &c)
 {
-    if (unlikely(c.kernelidx >= kernels.size())) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " was not loaded\"]\n", token, c.kernelidx);
-        return 0;
+    if (unlikely(!use_kernel(token, c.kernelidx))) return 0;
+    if (pool.nthreads > 0) {
+        IntegrateShiftsCmd cc = {c.kernelidx, c.lattice, c.i1, c.i2, 1};
+        memcpy(cc.genvec, c.genvec, sizeof(c.genvec));
+        memcpy(cc.shift[0], c.shift, sizeof(c.shift));
+        memcpy(cc.deformp, c.deformp, sizeof(c.deformp));
+        return submit_job(token, false, cc);
     }
     const Kernel &ker = kernels[c.kernelidx];
     const Family &fam = families[ker.familyidx];
-    complex_t result = {};
+    complex_t result[MAXRESULTS] = {};
     double t1 = timestamp();
-    int r = ker.fn_integrate(&result,
+    int r = ker.fn_integrate(result,
         c.lattice, c.i1, c.i2, c.genvec, c.shift,
         fam.realp, fam.complexp, c.deformp);
     double t2 = timestamp();
-    if (unlikely((isnan(result.re) || isnan(result.im)) ^ (r != 0))) {
-        printf("@[%" PRIu64 ",[[NaN,NaN],%" PRIu64 ",%.4e],\"NaN != sign check error %d in %s.%s\"]\n", token, c.i2-c.i1, t2-t1, r, fam.name, ker.name);
-    } else if (isnan(result.re) || isnan(result.im)) {
-        printf("@[%" PRIu64 ",[[NaN,NaN],%" PRIu64 ",%.4e],null]\n", token, c.i2-c.i1, t2-t1);
+    char error[3*MAXNAME];
+    bool haserror = false;
+    if (unlikely(isnan_any(result, ker.nresults) ^ (r != 0))) {
+        snprintf(error, sizeof(error), "NaN != sign check error %d in %s.%s", r, fam.name, ker.name);
+        haserror = true;
+    }
+    if (ker.nresults == 1) {
+        reply_integrate(token, result[0], c.i2-c.i1, t2-t1, haserror ? error : NULL);
     } else {
-        printf("@[%" PRIu64 ",[[%.16e,%.16e],%" PRIu64 ",%.4e],null]\n", token, result.re, result.im, c.i2-c.i1, t2-t1);
+        reply_integrate_shifts(token, result, ker.nresults, c.i2-c.i1, t2-t1, haserror ? error : NULL);
+    }
+    return t2-t1;
+}
+
+static double
+cmd_integrate_shifts(uint64_t token, IntegrateShiftsCmd &c)
+{
+    if (unlikely(!use_kernel(token, c.kernelidx))) return 0;
+    if (pool.nthreads > 0) {
+        return submit_job(token, true, c);
     }
+    const Kernel &ker = kernels[c.kernelidx];
+    const Family &fam = families[ker.familyidx];
+    const uint64_t nres = ker.nresults;
+    std::vector<complex_t> result(c.nshifts*nres);
+    char error[3*MAXNAME];
+    bool failed = false, haserror = false;
+    uint64_t npoints = 0;
+    double t1 = timestamp();
+    for (uint64_t s = 0; s < c.nshifts; s++) {
+        complex_t *res = &result[s*nres];
+        // A NaN in any shift makes the whole set useless to the
+        // caller (it will retry with a smaller deformp), so don't
+        // waste time on the remaining shifts.
+        if (failed) {
+            for (uint64_t k = 0; k < nres; k++) res[k] = complex_t{NAN, NAN};
+            continue;
+        }
+        int r = ker.fn_integrate(res,
+            c.lattice, c.i1, c.i2, c.genvec, c.shift[s],
+            fam.realp, fam.complexp, c.deformp);
+        npoints += c.i2-c.i1;
+        bool isnan_result = isnan_any(res, nres);
+        if (unlikely(isnan_result ^ (r != 0))) {
+            snprintf(error, sizeof(error), "NaN != sign check error %d in %s.%s", r, fam.name, ker.name);
+            for (uint64_t k = 0; k < nres; k++) res[k] = complex_t{NAN, NAN};
+            isnan_result = true;
+            haserror = true;
+        }
+        failed = isnan_result;
+    }
+    double t2 = timestamp();
+    reply_integrate_shifts(token, result.data(), result.size(), npoints, t2-t1, haserror ? error : NULL);
     return t2-t1;
 }
 
+// Thread pool
+
+static void
+finish_job(Job *job)
+{
+    double dt = job->worktime/pool.nthreads;
+    const char *error = job->haserror ? job->error : NULL;
+    if (job->multishift || job->result.size() > 1) {
+        reply_integrate_shifts(job->token, job->result.data(), job->result.size(), job->npoints, dt, error);
+    } else {
+        reply_integrate(job->token, job->result[0], job->npoints, dt, error);
+    }
+    Family &fam = families[kernels[job->cmd.kernelidx].familyidx];
+    delete job;
+    pthread_mutex_lock(&pool.lock);
+    bool idle = --pool.njobs == 0;
+    if (--fam.njobs == 0 || idle) pthread_cond_broadcast(&pool.cond_idle);
+    pthread_mutex_unlock(&pool.lock);
+}
+
+static void *
+integration_thread(void *arg)
+{
+    (void)arg;
+    for (;;) {
+        pthread_mutex_lock(&pool.lock);
+        while (pool.queue.empty()) {
+            pthread_cond_wait(&pool.cond_job, &pool.lock);
+        }
+        Job *job = pool.queue.front();
+        uint64_t chunk = job->nextchunk++;
+        if (job->nextchunk == job->nchunks) pool.queue.pop_front();
+        bool skip = job->failed;
+        pthread_mutex_unlock(&pool.lock);
+        const IntegrateShiftsCmd &c = job->cmd;
+        const Kernel &ker = kernels[c.kernelidx];
+        const Family &fam = families[ker.familyidx];
+        const uint64_t nres = ker.nresults;
+        uint64_t s = chunk/job->chunkspershift;
+        uint64_t i1 = c.i1 + (chunk % job->chunkspershift)*job->chunksize;
+        uint64_t i2 = i1 + job->chunksize < c.i2 ? i1 + job->chunksize : c.i2;
+        complex_t result[MAXRESULTS] = {};
+        int r = 0;
+        double t1 = 0, t2 = 0;
+        if (!skip) {
+            t1 = thread_cputime();
+            r = ker.fn_integrate(result,
+                c.lattice, i1, i2, c.genvec, c.shift[s],
+                fam.realp, fam.complexp, c.deformp);
+            t2 = thread_cputime();
+        }
+        pthread_mutex_lock(&pool.lock);
+        complex_t *res = &job->result[s*nres];
+        if (skip) {
+            // A NaN in any chunk makes the whole job useless to
+            // the caller (it will retry with a smaller deformp).
+            for (uint64_t k = 0; k < nres; k++) res[k] = complex_t{NAN, NAN};
+        } else {
+            bool isnan_result = isnan_any(result, nres);
+            if (unlikely(isnan_result ^ (r != 0))) {
+                snprintf(job->error, sizeof(job->error), "NaN != sign check error %d in %s.%s", r, fam.name, ker.name);
+                job->haserror = true;
+                for (uint64_t k = 0; k < nres; k++) result[k] = complex_t{NAN, NAN};
+                isnan_result = true;
+            }
+            job->failed |= isnan_result;
+            for (uint64_t k = 0; k < nres; k++) {
+                res[k].re += result[k].re;
+                res[k].im += result[k].im;
+            }
+            job->npoints += i2 - i1;
+            job->worktime += t2 - t1;
+            pool.useful_time += t2 - t1;
+        }
+        bool last = ++job->donechunks == job->nchunks;
+        pthread_mutex_unlock(&pool.lock);
+        if (last) finish_job(job);
+    }
+    return NULL;
+}
+
+static double
+submit_job(uint64_t token, bool multishift, const IntegrateShiftsCmd &c)
+{
+    Job *job = new Job();
+    job->token = token;
+    job->multishift = multishift;
+    job->cmd = c;
+    job->result.assign(c.nshifts*kernels[c.kernelidx].nresults, complex_t{0, 0});
+    // Aim for a few chunks per thread, but not too small ones.
+    uint64_t npoints = c.i2 > c.i1 ? c.i2 - c.i1 : 0;
+    uint64_t target = (npoints*c.nshifts + 4*pool.nthreads - 1)/(4*pool.nthreads);
+    job->chunksize = target > MINCHUNK ? target : MINCHUNK;
+    job->chunkspershift = npoints > 0 ? (npoints + job->chunksize - 1)/job->chunksize : 1;
+    job->nchunks = job->chunkspershift*c.nshifts;
+    pthread_mutex_lock(&pool.lock);
+    pool.njobs++;
+    families[kernels[c.kernelidx].familyidx].njobs++;
+    if (job->nchunks > 0) {
+        pool.queue.push_back(job);
+        pthread_cond_broadcast(&pool.cond_job);
+        pthread_mutex_unlock(&pool.lock);
+    } else {
+        pthread_mutex_unlock(&pool.lock);
+        finish_job(job);
+    }
+    return 0;
+}
+
+// Wait until all the submitted jobs are done.
+static void
+wait_for_jobs()
+{
+    if (pool.nthreads == 0) return;
+    pthread_mutex_lock(&pool.lock);
+    while (pool.njobs > 0) {
+        pthread_cond_wait(&pool.cond_idle, &pool.lock);
+    }
+    pthread_mutex_unlock(&pool.lock);
+}
+
+// Wait until all the submitted jobs of a family are done.
+static void
+wait_for_family(uint64_t familyidx)
+{
+    if (pool.nthreads == 0) return;
+    pthread_mutex_lock(&pool.lock);
+    while (families[familyidx].njobs > 0) {
+        pthread_cond_wait(&pool.cond_idle, &pool.lock);
+    }
+    pthread_mutex_unlock(&pool.lock);
+}
+
+static void
+start_threads(int nthreads)
+{
+    pool.nthreads = nthreads;
+    pool.threads.resize(nthreads);
+    for (int i = 0; i < nthreads; i++) {
+        pthread_create(&pool.threads[i], NULL, &integration_thread, NULL);
+    }
+}
+
+// Parsing
+
 static void
 parse_fail()
 {
@@ -331,16 +974,6 @@ parse_uint()
     return (uint64_t)x;
 }
 
-static int64_t
-parse_int()
-{
-    char *end = NULL;
-    long long x = strtoll(input_p, &end, 10);
-    if (unlikely(input_p == end)) parse_fail();
-    input_p = end;
-    return (int64_t)x;
-}
-
 static real_t
 parse_real()
 {
@@ -408,161 +1041,6 @@ parse_str(char *str, size_t maxn)
     }
 }
 
-// GiNaC-related code
-
-struct FixedStreamBuf : public std::streambuf {
-    FixedStreamBuf(char* s, size_t n) { setg(s, s, s + n); }
-};
-
-static GiNaC::ex
-ginac_read_string(GiNaC::parser &reader, char *str, size_t size)
-{
-    FixedStreamBuf buf(str, size);
-    std::istream i(&buf);
-    return reader(i);
-}
-
-static GiNaC::ex
-ginac_read_string(GiNaC::parser &reader, char *str)
-{
-    return ginac_read_string(reader, str, strlen(str));
-}
-
-template <typename F> void
-term_iter(const GiNaC::ex &e, F yield)
-{
-    if (GiNaC::is_a<GiNaC::add>(e)) {
-        for (const auto &t : e) {
-            yield(t);
-        }
-    } else {
-        yield(e);
-    }
-}
-
-template <typename F> void
-factor_iter(const GiNaC::ex &e, F yield)
-{
-    if (GiNaC::is_a<GiNaC::mul>(e)) {
-        for (const auto &f : e) {
-            if (GiNaC::is_a<GiNaC::power>(f)) {
-                yield(f.op(0), GiNaC::ex_to<GiNaC::numeric>(f.op(1)).to_int());
-            } else {
-                yield(f, 1);
-            }
-        }
-    } else {
-        if (GiNaC::is_a<GiNaC::power>(e)) {
-            yield(e.op(0), GiNaC::ex_to<GiNaC::numeric>(e.op(1)).to_int());
-        } else {
-            yield(e, 1);
-        }
-    }
-}
-
-static std::map<std::vector<int>, GiNaC::ex>
-ginac_bracket(const GiNaC::ex &expr, const GiNaC::exvector &X)
-{
-    std::map<std::vector<int>, GiNaC::ex> result;
-    std::map<GiNaC::ex, int, GiNaC::ex_is_less> x2id;
-    for (unsigned i = 0; i < X.size(); i++) {
-        x2id[X[i]] = i;
-    }
-    term_iter(expr.expand(), [&](const GiNaC::ex &term) {
-        std::vector<int> stemidx(X.size());
-        GiNaC::exvector coef;
-        factor_iter(term, [&](const GiNaC::ex &factor, int power) {
-            auto it = x2id.find(factor);
-            if (it != x2id.end()) {
-                stemidx[it->second] = power;
-            } else {
-                if (power == 1) {
-                    coef.push_back(factor);
-                } else {
-                    coef.push_back(pow(factor, power));
-                }
-            }
-        });
-        result[stemidx] += GiNaC::mul(coef);
-    });
-    return result;
-}
-
-static double
-parse_cmd_evalf(uint64_t token)
-{
-    char filename[MAXPATH];
-    parse_str(filename, sizeof(filename));
-    GiNaC::parser reader;
-    double t1 = timestamp();
-    std::ifstream inf(filename);
-    if (!inf) {
-        printf("@[%" PRIu64 ",null,\"failed to open '%s'\"]\n", token, filename);
-        exit(1);
-    }
-    GiNaC::ex expr = reader(inf);
-    GiNaC::exmap table;
-    match_str(",{");
-    char varname[MAXNAME];
-    if (input_peekchar() != '}') {
-        char value[MAXPATH];
-        for (;;) {
-            parse_str(varname, sizeof(varname));
-            match_c(':');
-            parse_str(value, sizeof(value));
-            table[ginac_read_string(reader, varname)] = ginac_read_string(reader, value);
-            if (input_peekchar() != ',') break;
-            input_getchar();
-        }
-    }
-    match_str("},[");
-    expr = expr.subs(table);
-    GiNaC::exvector varlist;
-    for (;;) {
-        match_c('[');
-        parse_str(varname, sizeof(varname));
-        match_c(',');
-        int64_t order = parse_int();
-        match_c(']');
-        auto x = ginac_read_string(reader, varname);
-        varlist.push_back(x);
-        expr = GiNaC::series_to_poly(expr.series(x, order+1));
-        if (input_peekchar() != ',') break;
-        input_getchar();
-    }
-    match_str("]]]\n");
-    auto br = ginac_bracket(expr.expand(), varlist);
-    std::map<std::vector<int>, complex_t> brc;
-    for (auto &&kv : br) {
-        GiNaC::ex val = kv.second.evalf();
-        GiNaC::ex val_re = val.real_part();
-        GiNaC::ex val_im = val.imag_part();
-        if (GiNaC::is_a<GiNaC::numeric>(val_re) && GiNaC::is_a<GiNaC::numeric>(val_im)) {
-            double re = GiNaC::ex_to<GiNaC::numeric>(val_re).to_double();
-            double im = GiNaC::ex_to<GiNaC::numeric>(val_im).to_double();
-            brc[kv.first] = complex_t{re, im};
-        } else {
-            printf("@[%" PRIu64 ",null,\"the coefficient is not numeric after substitution\"]\n", token);
-            return 0;
-        }
-    }
-    double t2 = timestamp();
-    printf("@[%" PRIu64 ",[", token);
-    bool first = true;
-    for (auto &&kv : brc) {
-        if (first) { first = false; } else { putchar(','); }
-        printf("[[");
-        bool first2 = true;
-        for (auto &&i : kv.first) {
-            if (first2) { first2 = false; } else { putchar(','); }
-            printf("%d", i);
-        }
-        printf("],[%.16e,%.16e]]", kv.second.re, kv.second.im);
-    }
-    printf("],null]\n");
-    return t2 - t1;
-}
-
 // Main RPC cycle
 
 static double
@@ -572,9 +1050,36 @@ handle_one_command()
     uint64_t token = parse_uint();
     match_c(','); match_c('"');
     int c = input_getchar();
+    if (c != 'i' && c != 'p' && c != 'm' && c != 'c') wait_for_jobs();
     if (c == 'i') {
+        match_str("ntegrate");
+        if (input_peekchar() == '_') {
+            IntegrateShiftsCmd c = {};
+            match_str("_shifts\",[");
+            c.kernelidx = parse_uint();
+            match_c(',');
+            c.lattice = parse_uint();
+            match_c(',');
+            c.i1 = parse_uint();
+            match_c(',');
+            c.i2 = parse_uint();
+            match_c(',');
+            parse_uint_array(c.genvec, MAXDIM);
+            match_c(',');
+            match_c('[');
+            while (input_peekchar() != ']') {
+                if (unlikely(c.nshifts >= MAXSHIFTS)) parse_fail();
+                parse_real_array(c.shift[c.nshifts++], MAXDIM);
+                if (input_peekchar() == ',') input_getchar();
+            }
+            match_c(']');
+            match_c(',');
+            parse_real_array(c.deformp, MAXDIM);
+            match_str("]]\n");
+            return cmd_integrate_shifts(token, c);
+        }
         IntegrateCmd c = {};
-        match_str("ntegrate\",[");
+        match_str("\",[");
         c.kernelidx = parse_uint();
         match_c(',');
         c.lattice = parse_uint();
@@ -608,7 +1113,7 @@ handle_one_command()
     }
     if (c == 'p') {
         match_str("ing\",[]]\n");
-        printf("@[%" PRIu64 ",null,null]\n", token);
+        reply_json(token, "null,null");
         return 0;
     }
     if (c == 'f') {
@@ -625,6 +1130,11 @@ handle_one_command()
         parse_complex_array(c.complexp, MAXDIM);
         match_c(',');
         c.complex_result = parse_bool();
+        // Optionally, a flag to open the library on demand.
+        if (input_peekchar() == ',') {
+            input_getchar();
+            c.lazy = parse_bool();
+        }
         match_str("]]\n");
         return cmd_family(token, c);
     }
@@ -647,6 +1157,13 @@ handle_one_command()
         c.familyidx = parse_uint();
         match_c(',');
         parse_str(c.name, sizeof(c.name));
+        // Optionally, the expected number of results: then the
+        // kernel is only resolved on its first use.
+        if (input_peekchar() == ',') {
+            input_getchar();
+            c.lazy = true;
+            c.nresults = parse_uint();
+        }
         match_str("]]\n");
         return cmd_kernel(token, c);
     }
@@ -654,17 +1171,114 @@ handle_one_command()
         StartCmd c = {};
         match_str("tart\",[");
         parse_str(c.dirname, sizeof(c.dirname));
+        if (input_peekchar() == ',') {
+            // Protocol negotiation: a list of protocol names.
+            c.negotiate = true;
+            match_str(",[");
+            char protocol[MAXNAME];
+            while (input_peekchar() != ']') {
+                parse_str(protocol, sizeof(protocol));
+                if (strcmp(protocol, "binary") == 0) c.binary = true;
+                if (input_peekchar() == ',') input_getchar();
+            }
+            match_c(']');
+        }
         match_str("]]\n");
         return cmd_start(token, c);
     }
-    if (c == 'e') {
-        match_str("valf\",[");
-        return parse_cmd_evalf(token);
-    }
     parse_fail();
     return 0;
 }
 
+static void
+frame_fail(const FrameHeader &h)
+{
+    fprintf(stderr, "%s] malformed frame: kind=%" PRIu32 ", size=%" PRIu32 "\n", workername, h.kind, h.size);
+    exit(1);
+}
+
+static double
+handle_one_frame(const FrameHeader &h)
+{
+    const char *p = input_line;
+    if (h.kind == METHOD_INTEGRATE) {
+        IntegrateFrame f;
+        IntegrateCmd c = {};
+        if (unlikely(h.size < sizeof(f))) frame_fail(h);
+        memcpy(&f, p, sizeof(f)); p += sizeof(f);
+        if (unlikely(f.ndim > MAXDIM || f.ndeformp > MAXDIM)) frame_fail(h);
+        if (unlikely(h.size != sizeof(f) + f.ndim*(sizeof(uint64_t) + sizeof(real_t)) + f.ndeformp*sizeof(real_t))) frame_fail(h);
+        c.kernelidx = f.kernelidx;
+        c.lattice = f.lattice;
+        c.i1 = f.i1;
+        c.i2 = f.i2;
+        memcpy(c.genvec, p, f.ndim*sizeof(uint64_t)); p += f.ndim*sizeof(uint64_t);
+        memcpy(c.shift, p, f.ndim*sizeof(real_t)); p += f.ndim*sizeof(real_t);
+        memcpy(c.deformp, p, f.ndeformp*sizeof(real_t));
+        return cmd_integrate(h.token, c);
+    }
+    if (h.kind == METHOD_INTEGRATE_SHIFTS) {
+        IntegrateShiftsFrame f;
+        IntegrateShiftsCmd c = {};
+        if (unlikely(h.size < sizeof(f))) frame_fail(h);
+        memcpy(&f, p, sizeof(f)); p += sizeof(f);
+        if (unlikely(f.ndim > MAXDIM || f.ndeformp > MAXDIM || f.nshifts > MAXSHIFTS)) frame_fail(h);
+        if (unlikely(h.size != sizeof(f) + f.ndim*sizeof(uint64_t) + f.nshifts*f.ndim*sizeof(real_t) + f.ndeformp*sizeof(real_t))) frame_fail(h);
+        c.kernelidx = f.kernelidx;
+        c.lattice = f.lattice;
+        c.i1 = f.i1;
+        c.i2 = f.i2;
+        c.nshifts = f.nshifts;
+        memcpy(c.genvec, p, f.ndim*sizeof(uint64_t)); p += f.ndim*sizeof(uint64_t);
+        for (uint64_t s = 0; s < f.nshifts; s++) {
+            memcpy(c.shift[s], p, f.ndim*sizeof(real_t)); p += f.ndim*sizeof(real_t);
+        }
+        memcpy(c.deformp, p, f.ndeformp*sizeof(real_t));
+        return cmd_integrate_shifts(h.token, c);
+    }
+    if (h.kind == METHOD_MAXDEFORMP) {
+        MaxdeformpFrame f;
+        PresampleCmd c = {};
+        if (unlikely(h.size < sizeof(f))) frame_fail(h);
+        memcpy(&f, p, sizeof(f)); p += sizeof(f);
+        if (unlikely(f.ndim > MAXDIM || f.ndeformp > MAXDIM)) frame_fail(h);
+        if (unlikely(h.size != sizeof(f) + f.ndim*(sizeof(uint64_t) + sizeof(real_t)))) frame_fail(h);
+        c.kernelidx = f.kernelidx;
+        c.ndeformp = f.ndeformp;
+        c.lattice = f.lattice;
+        memcpy(c.genvec, p, f.ndim*sizeof(uint64_t)); p += f.ndim*sizeof(uint64_t);
+        memcpy(c.shift, p, f.ndim*sizeof(real_t));
+        return cmd_presample(h.token, c);
+    }
+    if (h.kind == METHOD_PING) {
+        reply_json(h.token, "null,null");
+        return 0;
+    }
+    if (h.kind == METHOD_JSON) {
+        input_p = input_line;
+        return handle_one_command();
+    }
+    frame_fail(h);
+    return 0;
+}
+
+// Read one message from stdin into input_line; return false on EOF.
+static bool
+read_message(FrameHeader &h)
+{
+    if (!binary_protocol) {
+        return getline(&input_line, &input_linesize, stdin) >= 0;
+    }
+    if (fread(&h, sizeof(h), 1, stdin) != 1) return false;
+    if (input_linesize < (size_t)h.size + 1) {
+        input_linesize = (size_t)h.size + 1;
+        input_line = (char*)realloc(input_line, input_linesize);
+    }
+    if (fread(input_line, 1, h.size, stdin) != h.size) return false;
+    input_line[h.size] = 0;
+    return true;
+}
+
 static void
 fill_workername()
 {
@@ -674,10 +1288,29 @@ fill_workername()
     snprintf(workername, sizeof(workername), "%s:%ld", host, pid);
 }
 
-int main() {
+void
+usage(const char *argv0)
+{
+    fprintf(stderr, "%s] usage: %s [-t threads] [-i generic|sse2|avx2|avx512]\n", workername, argv0);
+    exit(1);
+}
+
+int
+main(int argc, char *argv[])
+{
     fill_workername();
+    int nthreads = 0;
+    for (int opt; (opt = getopt(argc, argv, "t:i:")) != -1;) {
+        switch (opt) {
+        case 't': nthreads = atoi(optarg); break;
+        case 'i': forced_isa = optarg; break;
+        default: usage(argv[0]); break;
+        }
+    }
+    if (optind < argc || nthreads < 0) usage(argv[0]);
+    if (nthreads > 0) start_threads(nthreads);
     setvbuf(stdin, NULL, _IOFBF, 1024*1024);
-    setvbuf(stdout, NULL, _IOLBF, 1024*1024);
+    setvbuf(stdout, NULL, _IOFBF, 1024*1024);
     setvbuf(stderr, NULL, _IOLBF, 1024*1024);
     double readt = 0;
     double workt = 0;
@@ -686,12 +1319,21 @@ int main() {
     bool quit = false;
     while (!quit) {
         lastt = timestamp();
-        if (getline(&input_line, &input_linesize, stdin) < 0) break;
+        FrameHeader h;
+        if (!read_message(h)) break;
         readt += timestamp() - lastt;
-        input_p = input_line;
-        workt += handle_one_command();
+        if (binary_protocol) {
+            workt += handle_one_frame(h);
+        } else {
+            input_p = input_line;
+            workt += handle_one_command();
+        }
     }
+    wait_for_jobs();
     double t2 = timestamp();
+    if (nthreads > 0) workt += pool.useful_time/nthreads;
     fprintf(stderr, "%s] Done in %.3gs: %.3g%% useful time, %.3g%% read time; work ended %.3gs ago\n",
             workername, lastt-t1, 100*workt/(lastt-t1), 100*readt/(lastt-t1), t2-lastt);
+    fprintf(stderr, "%s] Loaded %" PRIu64 " of %zu kernels from %" PRIu64 " of %zu libraries in %.3gs\n",
+            workername, nloaded_kernels, kernels.size(), nloaded_families, families.size(), load_time);
 }
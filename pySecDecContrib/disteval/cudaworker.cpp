@@ -5,23 +5,19 @@
 #include <inttypes.h>
 #include <math.h>
 #include <pthread.h>
+#include <stdarg.h>
 #include <stddef.h>
 #include <stdint.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 #include <time.h>
 #include <unistd.h>
+#include <string>
 #include <vector>
 
 #include "minicuda.h"
 
-#include <ginac/ginac.h>
-#include <ginac/parser.h>
-#include <streambuf>
-#include <istream>
-#include <fstream>
-#include <sstream>
-
 #ifdef unlikely
     #undef unlikely
 #endif
@@ -38,6 +34,8 @@ typedef struct { real_t re, im; } complex_t;
 #define MAXPATH 4095
 #define MAXNAME 255
 #define MAXDIM 32
+#define MAXSHIFTS 64
+#define MAXRESULTS 1024
 #define NTHREADS 1
 #define MAXQUEUE 16
 
@@ -85,8 +83,13 @@ struct Family {
     char name[MAXNAME + 1];
 };
 
+// A kernel may return several values at once (e.g. all the
+// orders of a sector, when built with fused orders): then the
+// library also exports `<name>__nresults`, and the CUDA kernel
+// writes the block sums of the k-th value at result[k*nblocks].
 struct Kernel {
     uint64_t familyidx;
+    uint64_t nresults;
     IntegrateF fn_integrate;
     MaxdeformpF fn_maxdeformp;
     FpolycheckF fn_fpolycheck;
@@ -98,6 +101,8 @@ struct Kernel {
 
 struct StartCmd {
     char dirname[MAXPATH + 1];
+    bool negotiate;
+    bool binary;
 };
 
 struct FamilyCmd {
@@ -123,17 +128,93 @@ struct PresampleCmd {
     real_t shift[MAXDIM];
 };
 
+// Both "integrate" (multishift=false, nshifts=1) and
+// "integrate_shifts" commands.
 struct IntegrateCmd {
     uint64_t token;
     uint64_t kernelidx;
     uint64_t lattice;
     uint64_t i1;
     uint64_t i2;
+    bool multishift;
+    uint64_t nshifts;
     uint64_t genvec[MAXDIM];
-    real_t shift[MAXDIM];
+    real_t shift[MAXSHIFTS][MAXDIM];
     real_t deformp[MAXDIM];
 };
 
+// Binary protocol
+//
+// After a successful negotiation via the "start" command, each
+// message in both directions becomes a frame: a FrameHeader
+// followed by `size` bytes of payload. All the numbers are
+// little-endian. The frequent commands have fixed-layout
+// payloads; the rest are sent as JSON messages inside a frame.
+
+struct FrameHeader {
+    uint64_t token;
+    uint32_t kind;
+    uint32_t size;
+};
+
+#define METHOD_JSON 0
+#define METHOD_INTEGRATE 1
+#define METHOD_MAXDEFORMP 2
+#define METHOD_PING 3
+#define METHOD_INTEGRATE_SHIFTS 4
+
+#define REPLY_JSON 0
+#define REPLY_INTEGRATE 1
+#define REPLY_REALS 2
+#define REPLY_INTEGRATE_SHIFTS 3
+
+struct IntegrateFrame {
+    uint64_t kernelidx;
+    uint64_t lattice;
+    uint64_t i1;
+    uint64_t i2;
+    uint64_t ndim;
+    uint64_t ndeformp;
+    // uint64_t genvec[ndim];
+    // real_t shift[ndim];
+    // real_t deformp[ndeformp];
+};
+
+struct IntegrateShiftsFrame {
+    uint64_t kernelidx;
+    uint64_t lattice;
+    uint64_t i1;
+    uint64_t i2;
+    uint64_t ndim;
+    uint64_t ndeformp;
+    uint64_t nshifts;
+    // uint64_t genvec[ndim];
+    // real_t shift[nshifts][ndim];
+    // real_t deformp[ndeformp];
+};
+
+struct MaxdeformpFrame {
+    uint64_t kernelidx;
+    uint64_t ndeformp;
+    uint64_t lattice;
+    uint64_t ndim;
+    // uint64_t genvec[ndim];
+    // real_t shift[ndim];
+};
+
+struct IntegrateReply {
+    real_t re;
+    real_t im;
+    uint64_t npoints;
+    real_t dt;
+};
+
+struct IntegrateShiftsReply {
+    uint64_t npoints;
+    real_t dt;
+    // complex_t result[nshifts];
+};
+
 struct CudaParameterData {
     uint64_t genvec[MAXDIM];
     real_t shift[MAXDIM];
@@ -162,6 +243,7 @@ static struct GlobalState {
     char *input_line = NULL;
     char *input_p = NULL;
     size_t input_linesize = 0;
+    bool binary_protocol = false;
     double useful_time = 0;
     struct GlobalCudaState {
         CUdevice device;
@@ -192,6 +274,143 @@ timestamp()
     return ts.tv_sec + ts.tv_nsec*1e-9;
 }
 
+static bool
+isnan_any(const complex_t *result, size_t n)
+{
+    for (size_t i = 0; i < n; i++)
+        if (isnan(result[i].re) || isnan(result[i].im)) return true;
+    return false;
+}
+
+// Replies
+//
+// Replies are sent both from the main thread and from the
+// integration threads, so each one is written under the stdout
+// lock.
+
+static void
+reply_frame(uint64_t token, uint32_t kind, const void *data, size_t size)
+{
+    FrameHeader h = {token, kind, (uint32_t)size};
+    flockfile(stdout);
+    fwrite(&h, sizeof(h), 1, stdout);
+    fwrite(data, 1, size, stdout);
+    fflush(stdout);
+    funlockfile(stdout);
+}
+
+// Send a reply given the JSON text of its "result,error" part.
+static void
+reply_json_text(uint64_t token, const char *text, size_t size)
+{
+    flockfile(stdout);
+    if (G.binary_protocol) {
+        FrameHeader h = {token, REPLY_JSON, (uint32_t)size + 2};
+        fwrite(&h, sizeof(h), 1, stdout);
+        putchar('[');
+        fwrite(text, 1, size, stdout);
+        putchar(']');
+    } else {
+        printf("@[%" PRIu64 ",%.*s]\n", token, (int)size, text);
+    }
+    fflush(stdout);
+    funlockfile(stdout);
+}
+
+static void
+reply_json(uint64_t token, const char *fmt, ...)
+{
+    char buf[1024];
+    va_list ap;
+    va_start(ap, fmt);
+    int n = vsnprintf(buf, sizeof(buf), fmt, ap);
+    va_end(ap);
+    if (n < (int)sizeof(buf)) {
+        reply_json_text(token, buf, n);
+    } else {
+        char *bigbuf = (char*)malloc(n + 1);
+        va_start(ap, fmt);
+        vsnprintf(bigbuf, n + 1, fmt, ap);
+        va_end(ap);
+        reply_json_text(token, bigbuf, n);
+        free(bigbuf);
+    }
+}
+
+static void
+reply_integrate(uint64_t token, const complex_t &result, uint64_t npoints, double dt, const char *error)
+{
+    bool isnan_result = isnan(result.re) || isnan(result.im);
+    if (G.binary_protocol && error == NULL) {
+        IntegrateReply r = {result.re, result.im, npoints, dt};
+        reply_frame(token, REPLY_INTEGRATE, &r, sizeof(r));
+    } else if (error != NULL) {
+        reply_json(token, "[[NaN,NaN],%" PRIu64 ",%.4e],\"%s\"", npoints, dt, error);
+    } else if (isnan_result) {
+        reply_json(token, "[[NaN,NaN],%" PRIu64 ",%.4e],null", npoints, dt);
+    } else {
+        reply_json(token, "[[%.16e,%.16e],%" PRIu64 ",%.4e],null", result.re, result.im, npoints, dt);
+    }
+}
+
+// Reply with n values: one per shift, or, for the kernels with
+// several results, all the results of the first shift, then of
+// the second one, etc.
+static void
+reply_integrate_shifts(uint64_t token, const complex_t *result, size_t n, uint64_t npoints, double dt, const char *error)
+{
+    if (G.binary_protocol && error == NULL) {
+        IntegrateShiftsReply r = {npoints, dt};
+        FrameHeader h = {token, REPLY_INTEGRATE_SHIFTS, (uint32_t)(sizeof(r) + n*sizeof(complex_t))};
+        flockfile(stdout);
+        fwrite(&h, sizeof(h), 1, stdout);
+        fwrite(&r, sizeof(r), 1, stdout);
+        fwrite(result, sizeof(complex_t), n, stdout);
+        fflush(stdout);
+        funlockfile(stdout);
+        return;
+    }
+    std::string text = "[[";
+    char buf[96];
+    for (size_t i = 0; i < n; i++) {
+        if (i != 0) text += ',';
+        if (isnan(result[i].re) || isnan(result[i].im)) {
+            text += "[NaN,NaN]";
+        } else {
+            snprintf(buf, sizeof(buf), "[%.16e,%.16e]", result[i].re, result[i].im);
+            text += buf;
+        }
+    }
+    snprintf(buf, sizeof(buf), "],%" PRIu64 ",%.4e],", npoints, dt);
+    text += buf;
+    if (error != NULL) {
+        text += '"';
+        text += error;
+        text += '"';
+    } else {
+        text += "null";
+    }
+    reply_json_text(token, text.data(), text.size());
+}
+
+static void
+reply_reals(uint64_t token, const real_t *values, size_t n)
+{
+    if (G.binary_protocol) {
+        reply_frame(token, REPLY_REALS, values, n*sizeof(real_t));
+    } else {
+        std::string text = "[";
+        char buf[32];
+        for (size_t i = 0; i < n; i++) {
+            if (i != 0) text += ',';
+            snprintf(buf, sizeof(buf), "%.16e", values[i]);
+            text += buf;
+        }
+        text += "],null";
+        reply_json_text(token, text.data(), text.size());
+    }
+}
+
 // Work queue
 
 static void
@@ -244,13 +463,20 @@ cmd_start(uint64_t token, StartCmd &c)
 {
     int r = chdir(c.dirname);
     if (r != 0) {
-        printf("@[%" PRIu64 ",null,\"failed to chdir '%s': %d\"]\n", token, c.dirname, r);
+        reply_json(token, "null,\"failed to chdir '%s': %d\"", c.dirname, r);
         return;
     }
     CU(cuModuleLoad, &G.cuda.builtin_module, "./builtin.fatbin");
     CU(cuModuleGetFunction, &G.cuda.fn_sum_d_b128_x1024, G.cuda.builtin_module, "sum_d_b128_x1024");
     CU(cuModuleGetFunction, &G.cuda.fn_sum_c_b128_x1024, G.cuda.builtin_module, "sum_c_b128_x1024");
-    printf("@[%" PRIu64 ",\"%s\",null]\n", token, G.workername);
+    if (c.negotiate) {
+        // The "gpu" feature lets disteval route the jobs between
+        // the CPU and the GPU workers of a mixed pool.
+        reply_json(token, "[\"%s\",\"%s\",[\"integrate_shifts\",\"gpu\"]],null", G.workername, c.binary ? "binary" : "json");
+        G.binary_protocol = c.binary;
+    } else {
+        reply_json(token, "\"%s\",null", G.workername);
+    }
 }
 
 static void
@@ -262,12 +488,12 @@ cmd_family(uint64_t token, FamilyCmd &c)
     snprintf(buf, sizeof(buf), "./%s.so", c.name);
     fam.so_handle = dlopen(buf, RTLD_LAZY | RTLD_LOCAL);
     if (fam.so_handle == NULL) {
-        printf("@[%" PRIu64 ",null,\"failed to open '%s': %s\"]\n", token, buf, strerror(errno));
+        reply_json(token, "null,\"failed to open '%s': %s\"", buf, strerror(errno));
         return;
     }
     snprintf(buf, sizeof(buf), "./%s.fatbin", c.name);
     if (cuModuleLoad(&fam.cuda_module, buf) != 0) {
-        printf("@[%" PRIu64 ",null,\"failed to open '%s'\"]\n", token, buf);
+        reply_json(token, "null,\"failed to open '%s'\"", buf);
         return;
     }
     fam.dimension = c.dimension;
@@ -276,7 +502,7 @@ cmd_family(uint64_t token, FamilyCmd &c)
     fam.complex_result = c.complex_result;
     memcpy(fam.name, c.name, sizeof(fam.name));
     G.families.push_back(fam);
-    printf("@[%" PRIu64 ",null,null]\n", token);
+    reply_json(token, "null,null");
 }
 
 static void
@@ -286,7 +512,7 @@ cmd_change_family_parameters(uint64_t token, FamilyCmd &c)
     Family &fam = G.families[c.index];
     memcpy(fam.realp, c.realp, sizeof(fam.realp));
     memcpy(fam.complexp, c.complexp, sizeof(fam.complexp));
-    printf("@[%" PRIu64 ",null,null]\n", token);
+    reply_json(token, "null,null");
 }
 
 static void
@@ -301,11 +527,18 @@ cmd_kernel(uint64_t token, KernelCmd &c)
     snprintf(buf, sizeof(buf), "%s__%s", fam.name, c.name);
     ker.fn_integrate = (IntegrateF)dlsym(fam.so_handle, buf);
     if (ker.fn_integrate == NULL) {
-        printf("@[%" PRIu64 ",null,\"function not found: %s\"]\n", token, buf);
+        reply_json(token, "null,\"function not found: %s\"", buf);
         return;
     }
     if (cuModuleGetFunction(&ker.cuda_fn_integrate, fam.cuda_module, buf) != 0) {
-        printf("@[%" PRIu64 ",null,\"CUDA function not found: %s\"]\n", token, buf);
+        reply_json(token, "null,\"CUDA function not found: %s\"", buf);
+        return;
+    }
+    snprintf(buf, sizeof(buf), "%s__%s__nresults", fam.name, c.name);
+    const int *nresults = (const int*)dlsym(fam.so_handle, buf);
+    ker.nresults = nresults != NULL ? *nresults : 1;
+    if (ker.nresults < 1 || ker.nresults > MAXRESULTS) {
+        reply_json(token, "null,\"bad number of results in %s: %" PRIu64 "\"", buf, ker.nresults);
         return;
     }
     snprintf(buf, sizeof(buf), "%s__%s__maxdeformp", fam.name, c.name);
@@ -314,28 +547,28 @@ cmd_kernel(uint64_t token, KernelCmd &c)
     ker.fn_fpolycheck = (FpolycheckF)dlsym(fam.so_handle, buf);
     memcpy(ker.name, c.name, sizeof(ker.name));
     G.kernels.push_back(ker);
-    printf("@[%" PRIu64 ",null,null]\n", token);
+    reply_json(token, "%" PRIu64 ",null", ker.nresults);
 }
 
 static void
 cmd_presample(uint64_t token, PresampleCmd &c)
 {
     if (unlikely(c.kernelidx >= G.kernels.size())) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " was not loaded\"]\n", token, c.kernelidx);
+        reply_json(token, "null,\"kernel %" PRIu64 " was not loaded\"", c.kernelidx);
         return;
     }
     const Kernel &ker = G.kernels[c.kernelidx];
     const Family &fam = G.families[ker.familyidx];
     if (unlikely(c.ndeformp == 0)) {
-        printf("@[%" PRIu64 ",[],null]\n", token);
+        reply_json(token, "[],null");
         return;
     }
     if (unlikely(ker.fn_maxdeformp == NULL)) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " has no *__maxdefomp function\"]\n", token, c.kernelidx);
+        reply_json(token, "null,\"kernel %" PRIu64 " has no *__maxdefomp function\"", c.kernelidx);
         return;
     }
     if (unlikely(ker.fn_fpolycheck == NULL)) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " has no *__fpolycheck function\"]\n", token, c.kernelidx);
+        reply_json(token, "null,\"kernel %" PRIu64 " has no *__fpolycheck function\"", c.kernelidx);
         return;
     }
     double deformp[MAXDIM] = {};
@@ -353,12 +586,7 @@ cmd_presample(uint64_t token, PresampleCmd &c)
             deformp[i] *= 0.9;
     }
     double t2 = timestamp();
-    printf("@[%" PRIu64 ",[", token);
-    for (uint64_t i = 0; i < c.ndeformp; i++) {
-        if (i != 0) putchar(',');
-        printf("%.16e", deformp[i]);
-    }
-    printf("],null]\n");
+    reply_reals(token, deformp, c.ndeformp);
     G.useful_time += t2-t1;
 }
 
@@ -375,74 +603,92 @@ worker_thread(void *ps)
         obtain_integrate_cmd(c);
         const Kernel &ker = G.kernels[c.kernelidx];
         const Family &fam = G.families[ker.familyidx];
-        if (0) { // CPU path
-            complex_t result = {};
-            double t1 = timestamp();
-            int r = ker.fn_integrate(&result,
-                c.lattice, c.i1, c.i2, c.genvec, c.shift,
-                fam.realp, fam.complexp, c.deformp);
-            double t2 = timestamp();
-            if (unlikely((isnan(result.re) || isnan(result.im)) ^ (r != 0))) {
-                printf("@[%" PRIu64 ",[[NaN,NaN],%" PRIu64 ",%.4e],\"NaN != sign check error %d in %s.%s\"]\n", c.token, c.i2-c.i1, t2-t1, r, fam.name, ker.name);
-            } else if (isnan(result.re) || isnan(result.im)) {
-                printf("@[%" PRIu64 ",[[NaN,NaN],%" PRIu64 ",%.4e],null]\n", c.token, c.i2-c.i1, t2-t1);
-            } else {
-                printf("@[%" PRIu64 ",[[%.16e,%.16e],%" PRIu64 ",%.4e],null]\n", c.token, result.re, result.im, c.i2-c.i1, t2-t1);
+        const uint64_t nres = ker.nresults;
+        std::vector<complex_t> result(c.nshifts*nres);
+        char error[3*MAXNAME];
+        bool failed = false, haserror = false;
+        uint64_t npoints = 0;
+        double t1 = timestamp();
+        for (uint64_t sh = 0; sh < c.nshifts; sh++) {
+            complex_t *res = &result[sh*nres];
+            // A NaN in any shift makes the whole set useless to the
+            // caller, so don't waste time on the remaining shifts.
+            if (failed) {
+                for (uint64_t k = 0; k < nres; k++) res[k] = complex_t{NAN, NAN};
+                continue;
             }
-            s.useful_time += t2-t1;
-        }
-        if (1) { // CUDA path
-            uint64_t threads = 128, pt_per_thread = 8;
-            uint64_t blocksperbatch = fam.complex_result ? s.buffer_size/sizeof(complex_t) : s.buffer_size/sizeof(real_t);
-            uint64_t ptperbatch = blocksperbatch * (threads*pt_per_thread);
-            complex_t result = {0, 0};
-            memcpy(s.params->genvec, c.genvec, sizeof(c.genvec));
-            memcpy(s.params->shift, c.shift, sizeof(c.shift));
-            memcpy(s.params->realp, fam.realp, sizeof(fam.realp));
-            memcpy(s.params->complexp, fam.complexp, sizeof(fam.complexp));
-            memcpy(s.params->deformp, c.deformp, sizeof(c.deformp));
-            double t1 = timestamp();
-            CU(cuMemcpyHtoDAsync, s.params_d, s.params, sizeof(CudaParameterData), s.stream);
-            CUdeviceptr genvec_d = s.params_d + offsetof(CudaParameterData, genvec);
-            CUdeviceptr shift_d = s.params_d + offsetof(CudaParameterData, shift);
-            CUdeviceptr realp_d = s.params_d + offsetof(CudaParameterData, realp);
-            CUdeviceptr complexp_d = s.params_d + offsetof(CudaParameterData, complexp);
-            CUdeviceptr deformp_d = s.params_d + offsetof(CudaParameterData, deformp);
-            for (uint64_t i1 = c.i1; i1 < c.i2; i1 += ptperbatch) {
-                uint64_t i2 = i1 + ptperbatch < c.i2 ? i1 + ptperbatch : c.i2;
-                uint64_t blocks = (i2 - i1 + threads*pt_per_thread - 1)/(threads*pt_per_thread);
-                void *args[] = {&s.buffer_d, &c.lattice, &i1, &i2, &genvec_d, &shift_d, &realp_d, &complexp_d, &deformp_d, NULL };
-                CU(cuLaunchKernel, ker.cuda_fn_integrate, blocks, 1, 1, threads, 1, 1, 0, s.stream, args, NULL);
-                void *sum_args[] = {&s.buffer_d, &s.buffer_d, &blocks, NULL};
-                CUfunction fn_sum = fam.complex_result ? G.cuda.fn_sum_c_b128_x1024 : G.cuda.fn_sum_d_b128_x1024;
-                while (blocks > 1) {
-                    uint64_t reduced = (blocks + 1024-1)/1024;
-                    CU(cuLaunchKernel, fn_sum, reduced, 1, 1, 128, 1, 1, 0, s.stream, sum_args, NULL);
-                    blocks = reduced;
+            for (uint64_t k = 0; k < nres; k++) res[k] = complex_t{0, 0};
+            npoints += c.i2-c.i1;
+            if (0) { // CPU path
+                int r = ker.fn_integrate(res,
+                    c.lattice, c.i1, c.i2, c.genvec, c.shift[sh],
+                    fam.realp, fam.complexp, c.deformp);
+                if (unlikely(isnan_any(res, nres) ^ (r != 0))) {
+                    snprintf(error, sizeof(error), "NaN != sign check error %d in %s.%s", r, fam.name, ker.name);
+                    for (uint64_t k = 0; k < nres; k++) res[k] = complex_t{NAN, NAN};
+                    haserror = true;
                 }
-                s.result->re = 0;
-                s.result->im = 0;
-                CU(cuMemcpyDtoHAsync, s.result, s.buffer_d, fam.complex_result ? sizeof(complex_t) : sizeof(real_t), s.stream);
-                // Without this CU_CTX_SCHED_BLOCKING_SYNC doesn't work,
-                // and cuStreamSynchronize spins with 100% CPU usage.
-                // With this, both CU_CTX_SCHED_BLOCKING_SYNC and
-                // CU_CTX_SCHED_YIELD have the same result: 0% CPU usage
-                // during cuStreamSynchronize.
-                // It's not clear how cuLaunchHostFunc is related here
-                // at all, and the whole thing is completely undocumented.
-                CU(cuLaunchHostFunc, s.stream, stupid_cuda_dummy, NULL);
-                CU(cuStreamSynchronize, s.stream);
-                result.re += s.result->re;
-                result.im += s.result->im;
             }
-            double t2 = timestamp();
-            if (isnan(result.re) || isnan(result.im)) {
-                printf("@[%" PRIu64 ",[[NaN,NaN],%" PRIu64 ",%.4e],null]\n", c.token, c.i2-c.i1, t2-t1);
-            } else {
-                printf("@[%" PRIu64 ",[[%.16e,%.16e],%" PRIu64 ",%.4e],null]\n", c.token, result.re, result.im, c.i2-c.i1, t2-t1);
+            if (1) { // CUDA path
+                uint64_t threads = 128, pt_per_thread = 8;
+                size_t valuesize = fam.complex_result ? sizeof(complex_t) : sizeof(real_t);
+                // Each of the results gets its own part of the buffer.
+                uint64_t blocksperbatch = s.buffer_size/valuesize/nres;
+                uint64_t ptperbatch = blocksperbatch * (threads*pt_per_thread);
+                memcpy(s.params->genvec, c.genvec, sizeof(c.genvec));
+                memcpy(s.params->shift, c.shift[sh], sizeof(c.shift[sh]));
+                memcpy(s.params->realp, fam.realp, sizeof(fam.realp));
+                memcpy(s.params->complexp, fam.complexp, sizeof(fam.complexp));
+                memcpy(s.params->deformp, c.deformp, sizeof(c.deformp));
+                CU(cuMemcpyHtoDAsync, s.params_d, s.params, sizeof(CudaParameterData), s.stream);
+                CUdeviceptr genvec_d = s.params_d + offsetof(CudaParameterData, genvec);
+                CUdeviceptr shift_d = s.params_d + offsetof(CudaParameterData, shift);
+                CUdeviceptr realp_d = s.params_d + offsetof(CudaParameterData, realp);
+                CUdeviceptr complexp_d = s.params_d + offsetof(CudaParameterData, complexp);
+                CUdeviceptr deformp_d = s.params_d + offsetof(CudaParameterData, deformp);
+                for (uint64_t i1 = c.i1; i1 < c.i2; i1 += ptperbatch) {
+                    uint64_t i2 = i1 + ptperbatch < c.i2 ? i1 + ptperbatch : c.i2;
+                    uint64_t blocks = (i2 - i1 + threads*pt_per_thread - 1)/(threads*pt_per_thread);
+                    void *args[] = {&s.buffer_d, &c.lattice, &i1, &i2, &genvec_d, &shift_d, &realp_d, &complexp_d, &deformp_d, NULL };
+                    CU(cuLaunchKernel, ker.cuda_fn_integrate, blocks, 1, 1, threads, 1, 1, 0, s.stream, args, NULL);
+                    CUfunction fn_sum = fam.complex_result ? G.cuda.fn_sum_c_b128_x1024 : G.cuda.fn_sum_d_b128_x1024;
+                    for (uint64_t k = 0; k < nres; k++) {
+                        CUdeviceptr part_d = s.buffer_d + k*blocks*valuesize;
+                        uint64_t n = blocks;
+                        void *sum_args[] = {&part_d, &part_d, &n, NULL};
+                        while (n > 1) {
+                            uint64_t reduced = (n + 1024-1)/1024;
+                            CU(cuLaunchKernel, fn_sum, reduced, 1, 1, 128, 1, 1, 0, s.stream, sum_args, NULL);
+                            n = reduced;
+                        }
+                        s.result[k].re = 0;
+                        s.result[k].im = 0;
+                        CU(cuMemcpyDtoHAsync, &s.result[k], part_d, valuesize, s.stream);
+                    }
+                    // Without this CU_CTX_SCHED_BLOCKING_SYNC doesn't work,
+                    // and cuStreamSynchronize spins with 100% CPU usage.
+                    // With this, both CU_CTX_SCHED_BLOCKING_SYNC and
+                    // CU_CTX_SCHED_YIELD have the same result: 0% CPU usage
+                    // during cuStreamSynchronize.
+                    // It's not clear how cuLaunchHostFunc is related here
+                    // at all, and the whole thing is completely undocumented.
+                    CU(cuLaunchHostFunc, s.stream, stupid_cuda_dummy, NULL);
+                    CU(cuStreamSynchronize, s.stream);
+                    for (uint64_t k = 0; k < nres; k++) {
+                        res[k].re += s.result[k].re;
+                        res[k].im += s.result[k].im;
+                    }
+                }
             }
-            s.useful_time += t2-t1;
+            failed = isnan_any(res, nres);
         }
+        double t2 = timestamp();
+        if (c.multishift || result.size() > 1) {
+            reply_integrate_shifts(c.token, result.data(), result.size(), npoints, t2-t1, haserror ? error : NULL);
+        } else {
+            reply_integrate(c.token, result[0], npoints, t2-t1, haserror ? error : NULL);
+        }
+        s.useful_time += t2-t1;
     }
     return NULL;
 }
@@ -451,7 +697,7 @@ static void
 cmd_integrate(uint64_t token, IntegrateCmd &c)
 {
     if (unlikely(c.kernelidx >= G.kernels.size())) {
-        printf("@[%" PRIu64 ",null,\"kernel %" PRIu64 " was not loaded\"]\n", token, c.kernelidx);
+        reply_json(token, "null,\"kernel %" PRIu64 " was not loaded\"", c.kernelidx);
         return;
     }
     submit_integrate_cmd(c);
@@ -481,7 +727,7 @@ init(int devindex)
         CU(cuStreamCreate, &ts.stream, CU_STREAM_NON_BLOCKING);
         CU(cuMemAlloc, &ts.params_d, sizeof(CudaParameterData));
         CU(cuMemAllocHost, (void**)&ts.params, sizeof(*ts.params));
-        CU(cuMemAllocHost, (void**)&ts.result, sizeof(*ts.result));
+        CU(cuMemAllocHost, (void**)&ts.result, MAXRESULTS*sizeof(*ts.result));
         ts.buffer_size = 128*1024*1024;
         CU(cuMemAlloc, &ts.buffer_d, ts.buffer_size);
         CU(cuMemsetD8Async, ts.params_d, 0, sizeof(CudaParameterData), ts.stream);
@@ -538,16 +784,6 @@ parse_uint()
     return (uint64_t)x;
 }
 
-static int64_t
-parse_int()
-{
-    char *end = NULL;
-    long long x = strtoll(G.input_p, &end, 10);
-    if (unlikely(G.input_p == end)) parse_fail();
-    G.input_p = end;
-    return (int64_t)x;
-}
-
 static real_t
 parse_real()
 {
@@ -615,161 +851,6 @@ parse_str(char *str, size_t maxn)
     }
 }
 
-// GiNaC-related code
-
-struct FixedStreamBuf : public std::streambuf {
-    FixedStreamBuf(char* s, size_t n) { setg(s, s, s + n); }
-};
-
-static GiNaC::ex
-ginac_read_string(GiNaC::parser &reader, char *str, size_t size)
-{
-    FixedStreamBuf buf(str, size);
-    std::istream i(&buf);
-    return reader(i);
-}
-
-static GiNaC::ex
-ginac_read_string(GiNaC::parser &reader, char *str)
-{
-    return ginac_read_string(reader, str, strlen(str));
-}
-
-template <typename F> void
-term_iter(const GiNaC::ex &e, F yield)
-{
-    if (GiNaC::is_a<GiNaC::add>(e)) {
-        for (const auto &t : e) {
-            yield(t);
-        }
-    } else {
-        yield(e);
-    }
-}
-
-template <typename F> void
-factor_iter(const GiNaC::ex &e, F yield)
-{
-    if (GiNaC::is_a<GiNaC::mul>(e)) {
-        for (const auto &f : e) {
-            if (GiNaC::is_a<GiNaC::power>(f)) {
-                yield(f.op(0), GiNaC::ex_to<GiNaC::numeric>(f.op(1)).to_int());
-            } else {
-                yield(f, 1);
-            }
-        }
-    } else {
-        if (GiNaC::is_a<GiNaC::power>(e)) {
-            yield(e.op(0), GiNaC::ex_to<GiNaC::numeric>(e.op(1)).to_int());
-        } else {
-            yield(e, 1);
-        }
-    }
-}
-
-static std::map<std::vector<int>, GiNaC::ex>
-ginac_bracket(const GiNaC::ex &expr, const GiNaC::exvector &X)
-{
-    std::map<std::vector<int>, GiNaC::ex> result;
-    std::map<GiNaC::ex, int, GiNaC::ex_is_less> x2id;
-    for (unsigned i = 0; i < X.size(); i++) {
-        x2id[X[i]] = i;
-    }
-    term_iter(expr.expand(), [&](const GiNaC::ex &term) {
-        std::vector<int> stemidx(X.size());
-        GiNaC::exvector coef;
-        factor_iter(term, [&](const GiNaC::ex &factor, int power) {
-            auto it = x2id.find(factor);
-            if (it != x2id.end()) {
-                stemidx[it->second] = power;
-            } else {
-                if (power == 1) {
-                    coef.push_back(factor);
-                } else {
-                    coef.push_back(pow(factor, power));
-                }
-            }
-        });
-        result[stemidx] += GiNaC::mul(coef);
-    });
-    return result;
-}
-
-static void
-parse_cmd_evalf(uint64_t token)
-{
-    char filename[MAXPATH];
-    parse_str(filename, sizeof(filename));
-    GiNaC::parser reader;
-    double t1 = timestamp();
-    std::ifstream inf(filename);
-    if (!inf) {
-        printf("@[%" PRIu64 ",null,\"failed to open '%s'\"]\n", token, filename);
-        exit(1);
-    }
-    GiNaC::ex expr = reader(inf);
-    GiNaC::exmap table;
-    match_str(",{");
-    char varname[MAXNAME];
-    if (input_peekchar() != '}') {
-        char value[MAXPATH];
-        for (;;) {
-            parse_str(varname, sizeof(varname));
-            match_c(':');
-            parse_str(value, sizeof(value));
-            table[ginac_read_string(reader, varname)] = ginac_read_string(reader, value);
-            if (input_peekchar() != ',') break;
-            input_getchar();
-        }
-    }
-    match_str("},[");
-    expr = expr.subs(table);
-    GiNaC::exvector varlist;
-    for (;;) {
-        match_c('[');
-        parse_str(varname, sizeof(varname));
-        match_c(',');
-        int64_t order = parse_int();
-        match_c(']');
-        auto x = ginac_read_string(reader, varname);
-        varlist.push_back(x);
-        expr = GiNaC::series_to_poly(expr.series(x, order+1));
-        if (input_peekchar() != ',') break;
-        input_getchar();
-    }
-    match_str("]]]\n");
-    auto br = ginac_bracket(expr.expand(), varlist);
-    std::map<std::vector<int>, complex_t> brc;
-    for (auto &&kv : br) {
-        GiNaC::ex val = kv.second.evalf();
-        GiNaC::ex val_re = val.real_part();
-        GiNaC::ex val_im = val.imag_part();
-        if (GiNaC::is_a<GiNaC::numeric>(val_re) && GiNaC::is_a<GiNaC::numeric>(val_im)) {
-            double re = GiNaC::ex_to<GiNaC::numeric>(val_re).to_double();
-            double im = GiNaC::ex_to<GiNaC::numeric>(val_im).to_double();
-            brc[kv.first] = complex_t{re, im};
-        } else {
-            printf("@[%" PRIu64 ",null,\"the coefficient is not numeric after substitution\"]\n", token);
-            return;
-        }
-    }
-    double t2 = timestamp();
-    printf("@[%" PRIu64 ",[", token);
-    bool first = true;
-    for (auto &&kv : brc) {
-        if (first) { first = false; } else { putchar(','); }
-        printf("[[");
-        bool first2 = true;
-        for (auto &&i : kv.first) {
-            if (first2) { first2 = false; } else { putchar(','); }
-            printf("%d", i);
-        }
-        printf("],[%.16e,%.16e]]", kv.second.re, kv.second.im);
-    }
-    printf("],null]\n");
-    G.useful_time += t2 - t1;
-}
-
 // Main RPC cycle
 
 static void
@@ -781,7 +862,10 @@ handle_one_command()
     int c = input_getchar();
     if (c == 'i') {
         IntegrateCmd c = {token};
-        match_str("ntegrate\",[");
+        match_str("ntegrate");
+        c.multishift = input_peekchar() == '_';
+        if (c.multishift) match_str("_shifts");
+        match_str("\",[");
         c.kernelidx = parse_uint();
         match_c(',');
         c.lattice = parse_uint();
@@ -792,7 +876,18 @@ handle_one_command()
         match_c(',');
         parse_uint_array(c.genvec, MAXDIM);
         match_c(',');
-        parse_real_array(c.shift, MAXDIM);
+        if (c.multishift) {
+            match_c('[');
+            while (input_peekchar() != ']') {
+                if (unlikely(c.nshifts >= MAXSHIFTS)) parse_fail();
+                parse_real_array(c.shift[c.nshifts++], MAXDIM);
+                if (input_peekchar() == ',') input_getchar();
+            }
+            match_c(']');
+        } else {
+            c.nshifts = 1;
+            parse_real_array(c.shift[0], MAXDIM);
+        }
         match_c(',');
         parse_real_array(c.deformp, MAXDIM);
         match_str("]]\n");
@@ -815,7 +910,7 @@ handle_one_command()
     }
     if (c == 'p') {
         match_str("ing\",[]]\n");
-        printf("@[%" PRIu64 ",null,null]\n", token);
+        reply_json(token, "null,null");
         return;
     }
     if (c == 'f') {
@@ -861,16 +956,114 @@ handle_one_command()
         StartCmd c = {};
         match_str("tart\",[");
         parse_str(c.dirname, sizeof(c.dirname));
+        if (input_peekchar() == ',') {
+            // Protocol negotiation: a list of protocol names.
+            c.negotiate = true;
+            match_str(",[");
+            char protocol[MAXNAME];
+            while (input_peekchar() != ']') {
+                parse_str(protocol, sizeof(protocol));
+                if (strcmp(protocol, "binary") == 0) c.binary = true;
+                if (input_peekchar() == ',') input_getchar();
+            }
+            match_c(']');
+        }
         match_str("]]\n");
         return cmd_start(token, c);
     }
-    if (c == 'e') {
-        match_str("valf\",[");
-        return parse_cmd_evalf(token);
-    }
     parse_fail();
 }
 
+static void
+frame_fail(const FrameHeader &h)
+{
+    fprintf(stderr, "%s] malformed frame: kind=%" PRIu32 ", size=%" PRIu32 "\n", G.workername, h.kind, h.size);
+    exit(1);
+}
+
+static void
+handle_one_frame(const FrameHeader &h)
+{
+    const char *p = G.input_line;
+    if (h.kind == METHOD_INTEGRATE) {
+        IntegrateFrame f;
+        IntegrateCmd c = {h.token};
+        if (unlikely(h.size < sizeof(f))) frame_fail(h);
+        memcpy(&f, p, sizeof(f)); p += sizeof(f);
+        if (unlikely(f.ndim > MAXDIM || f.ndeformp > MAXDIM)) frame_fail(h);
+        if (unlikely(h.size != sizeof(f) + f.ndim*(sizeof(uint64_t) + sizeof(real_t)) + f.ndeformp*sizeof(real_t))) frame_fail(h);
+        c.kernelidx = f.kernelidx;
+        c.lattice = f.lattice;
+        c.i1 = f.i1;
+        c.i2 = f.i2;
+        c.nshifts = 1;
+        memcpy(c.genvec, p, f.ndim*sizeof(uint64_t)); p += f.ndim*sizeof(uint64_t);
+        memcpy(c.shift[0], p, f.ndim*sizeof(real_t)); p += f.ndim*sizeof(real_t);
+        memcpy(c.deformp, p, f.ndeformp*sizeof(real_t));
+        return cmd_integrate(h.token, c);
+    }
+    if (h.kind == METHOD_INTEGRATE_SHIFTS) {
+        IntegrateShiftsFrame f;
+        IntegrateCmd c = {h.token};
+        if (unlikely(h.size < sizeof(f))) frame_fail(h);
+        memcpy(&f, p, sizeof(f)); p += sizeof(f);
+        if (unlikely(f.ndim > MAXDIM || f.ndeformp > MAXDIM || f.nshifts > MAXSHIFTS)) frame_fail(h);
+        if (unlikely(h.size != sizeof(f) + f.ndim*sizeof(uint64_t) + f.nshifts*f.ndim*sizeof(real_t) + f.ndeformp*sizeof(real_t))) frame_fail(h);
+        c.kernelidx = f.kernelidx;
+        c.lattice = f.lattice;
+        c.i1 = f.i1;
+        c.i2 = f.i2;
+        c.multishift = true;
+        c.nshifts = f.nshifts;
+        memcpy(c.genvec, p, f.ndim*sizeof(uint64_t)); p += f.ndim*sizeof(uint64_t);
+        for (uint64_t sh = 0; sh < f.nshifts; sh++) {
+            memcpy(c.shift[sh], p, f.ndim*sizeof(real_t)); p += f.ndim*sizeof(real_t);
+        }
+        memcpy(c.deformp, p, f.ndeformp*sizeof(real_t));
+        return cmd_integrate(h.token, c);
+    }
+    if (h.kind == METHOD_MAXDEFORMP) {
+        MaxdeformpFrame f;
+        PresampleCmd c = {};
+        if (unlikely(h.size < sizeof(f))) frame_fail(h);
+        memcpy(&f, p, sizeof(f)); p += sizeof(f);
+        if (unlikely(f.ndim > MAXDIM || f.ndeformp > MAXDIM)) frame_fail(h);
+        if (unlikely(h.size != sizeof(f) + f.ndim*(sizeof(uint64_t) + sizeof(real_t)))) frame_fail(h);
+        c.kernelidx = f.kernelidx;
+        c.ndeformp = f.ndeformp;
+        c.lattice = f.lattice;
+        memcpy(c.genvec, p, f.ndim*sizeof(uint64_t)); p += f.ndim*sizeof(uint64_t);
+        memcpy(c.shift, p, f.ndim*sizeof(real_t));
+        return cmd_presample(h.token, c);
+    }
+    if (h.kind == METHOD_PING) {
+        reply_json(h.token, "null,null");
+        return;
+    }
+    if (h.kind == METHOD_JSON) {
+        G.input_p = G.input_line;
+        return handle_one_command();
+    }
+    frame_fail(h);
+}
+
+// Read one message from stdin into input_line; return false on EOF.
+static bool
+read_message(FrameHeader &h)
+{
+    if (!G.binary_protocol) {
+        return getline(&G.input_line, &G.input_linesize, stdin) >= 0;
+    }
+    if (fread(&h, sizeof(h), 1, stdin) != 1) return false;
+    if (G.input_linesize < (size_t)h.size + 1) {
+        G.input_linesize = (size_t)h.size + 1;
+        G.input_line = (char*)realloc(G.input_line, G.input_linesize);
+    }
+    if (fread(G.input_line, 1, h.size, stdin) != h.size) return false;
+    G.input_line[h.size] = 0;
+    return true;
+}
+
 static void
 fill_workername()
 {
@@ -902,7 +1095,7 @@ main(int argc, char *argv[])
     load_minicuda();
     init(devindex);
     setvbuf(stdin, NULL, _IOFBF, 1024*1024);
-    setvbuf(stdout, NULL, _IOLBF, 1024*1024);
+    setvbuf(stdout, NULL, _IOFBF, 1024*1024);
     setvbuf(stderr, NULL, _IOLBF, 1024*1024);
     double readt = 0;
     double lastt = 0;
@@ -910,10 +1103,15 @@ main(int argc, char *argv[])
     bool quit = false;
     while (!quit) {
         lastt = timestamp();
-        if (getline(&G.input_line, &G.input_linesize, stdin) < 0) break;
+        FrameHeader h;
+        if (!read_message(h)) break;
         readt += timestamp() - lastt;
-        G.input_p = G.input_line;
-        handle_one_command();
+        if (G.binary_protocol) {
+            handle_one_frame(h);
+        } else {
+            G.input_p = G.input_line;
+            handle_one_command();
+        }
     }
     double t2 = timestamp();
     for (int i = 0; i < NTHREADS; i++)